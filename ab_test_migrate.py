@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Перенос данных A/B теста между JSON-файлами и SQLite.
+
+    python ab_test_migrate.py import [--account NAME ...]   # AB_TEST_DIR/*.json -> ab_test.sqlite3
+    python ab_test_migrate.py export [--account NAME ...] [--out DIR]
+                                                            # ab_test.sqlite3 -> DIR/<account>.json
+
+Экспорт воспроизводит прежнюю структуру файла аккаунта (users + stats), но не побайтно:
+отступы задаёт LEADS_JSON_INDENT (по умолчанию компактная запись; 2 — как в прежних файлах).
+Импорт заменяет данные аккаунта в БД целиком, поэтому его можно повторять.
+После импорта запускайте сервис с AB_TEST_BACKEND=sqlite.
+"""
+import argparse
+import logging
+from pathlib import Path
+
+import main
+
+
+def _import(accounts: list) -> None:
+    source = main.JsonAbStore(main.AB_TEST_DIR)
+    target = main.SqliteAbStore(main.AB_TEST_DB_FILE)
+    for account in accounts or source.accounts():
+        data = source.export_account(account)
+        target.import_account(account, data)
+        logging.info(f"✅ {account}: импортировано пользователей {len(data.get('users', {}))}")
+
+
+def _export(accounts: list, out_dir: Path) -> None:
+    source = main.SqliteAbStore(main.AB_TEST_DB_FILE)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    target = main.JsonAbStore(out_dir)
+    for account in accounts or source.accounts():
+        data = source.export_account(account)
+        target.import_account(account, data)
+        logging.info(f"✅ {account}: выгружено пользователей {len(data['users'])} в {out_dir}")
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("import", "export"))
+    parser.add_argument("--account", action="append", default=[], help="аккаунт (по умолчанию — все)")
+    parser.add_argument("--out", type=Path, default=main.AB_TEST_DIR / "export",
+                        help="каталог для export (по умолчанию AB_TEST_DIR/export)")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        _import(args.account)
+    else:
+        _export(args.account, args.out)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк колоночного формата: размер на диске и агрегирующие запросы по закрытым файлам.
+
+Генерирует день traffic_bh (JSON-lines) и неделю stat_lt_income (JSON-массив в прежнем
+формате с indent=2), перекладывает их через write_columnar и сравнивает:
+    - размер исходного файла и .col;
+    - сумму sum по sub1/status за неделю: разбор JSON целиком против чтения трёх колонок;
+    - число показов по banner_id за день: разбор всех строк против чтения одной колонки.
+
+Запуск (из корня репозитория):
+    python benchmarks/bench_columnar.py --traffic 200000 --income 100000
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _setup_env() -> Path:
+    tmp = Path(tempfile.mkdtemp(prefix="bench_columnar_"))
+    os.environ["LEADS_DATA_DIR"] = str(tmp / "data")
+    os.environ["LEADS_LOG_FILE"] = str(tmp / "postback.log")
+    sys.path.insert(0, str(ROOT))
+    return tmp
+
+
+def _traffic_lines(count: int) -> list:
+    rnd = random.Random(1)
+    start = datetime.datetime(2026, 10, 16).astimezone()
+    lines = []
+    for i in range(count):
+        record = {
+            "timestamp": (start + datetime.timedelta(seconds=86400 * i / count, microseconds=rnd.randint(0, 999))).isoformat(),
+            "banner_id": str(100000 + rnd.randint(0, 2000)),
+            "user_id": str(rnd.randint(1, 10 ** 9)),
+        }
+        if i % 2:
+            record.update(sub1=f"krolik_campaign_{i % 40}", utm_source="vk")
+        lines.append(json.dumps(record, ensure_ascii=False))
+    return lines
+
+
+def _income_records(count: int) -> list:
+    rnd = random.Random(2)
+    start = datetime.datetime(2026, 10, 12)
+    return [
+        {
+            "sub1": rnd.choice(["krolik_vk", "banknota_vk", "zaim_tg", "kredit_ok", "nalichka_vk"]) + f"_{rnd.randint(1, 30)}",
+            "sub2": rnd.choice(["", "ad1", "ad2", "ad3"]),
+            "sub5": str(rnd.randint(1, 5000)),
+            "sub6": f"{rnd.getrandbits(64):016x}",
+            "sum": rnd.choice(["0", "150", "200.5", "75.25", "1200", "310.8"]),
+            "status": rnd.choice(["approved", "rejected", "pending", ""]),
+            "date": (start + datetime.timedelta(seconds=7 * 86400 * i / count)).strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        for i in range(count)
+    ]
+
+
+def _best(fn, repeat: int = 3) -> tuple:
+    best, result = None, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--traffic", type=int, default=200000)
+    parser.add_argument("--income", type=int, default=100000)
+    args = parser.parse_args()
+    tmp = _setup_env()
+
+    import logging
+    import main as app_main
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    traffic_file = tmp / "traffic_bh_2026-10-16.jsonl"
+    traffic_file.write_text("\n".join(_traffic_lines(args.traffic)) + "\n", encoding="utf-8")
+    income_file = tmp / "stat_lt_income_2026_W42.json"
+    income_file.write_text(json.dumps(_income_records(args.income), indent=2, ensure_ascii=False), encoding="utf-8")
+
+    def income_json():
+        totals = defaultdict(float)
+        for record in app_main.json_loads(income_file.read_bytes()):
+            totals[(record["sub1"], record["status"])] += float(record["sum"])
+        return dict(totals)
+
+    def income_columnar():
+        cf = app_main.ColumnarFile(app_main.get_columnar_file(income_file))
+        sub1_values, sub1_codes = cf.codes("sub1")
+        status_values, status_codes = cf.codes("status")
+        totals = defaultdict(float)
+        for sub1, status, value in zip(sub1_codes, status_codes, cf.numbers("sum")):
+            totals[(sub1, status)] += value
+        return {(sub1_values[a], status_values[b]): value for (a, b), value in totals.items()}
+
+    def traffic_json():
+        with open(traffic_file, "rb") as f:
+            return Counter(app_main.json_loads(line)["banner_id"] for line in f)
+
+    def traffic_columnar():
+        cf = app_main.ColumnarFile(app_main.get_columnar_file(traffic_file))
+        values, codes = cf.codes("banner_id")
+        return Counter({values[code]: count for code, count in Counter(codes).items()})
+
+    print(f"{'файл':<30}{'исходный, байт':>16}{'.col, байт':>14}{'сжатие':>9}{'запись, с':>11}")
+    for path, kind in ((traffic_file, "traffic_bh"), (income_file, "stat_lt_income")):
+        lines = path.read_bytes()
+        records = app_main.json_loads(lines) if kind == "stat_lt_income" else [app_main.json_loads(line) for line in lines.splitlines()]
+        t0 = time.perf_counter()
+        size = app_main.write_columnar(app_main.get_columnar_file(path), records, kind)
+        elapsed = time.perf_counter() - t0
+        cf = app_main.ColumnarFile(app_main.get_columnar_file(path))
+        assert list(cf.scan()) == records
+        types = ", ".join(f"{name}:{cf.column_type(name)}" for name in cf.columns)
+        print(f"{path.name:<30}{len(lines):>16}{size:>14}{len(lines) / size:>8.1f}x{elapsed:>11.2f}   {types}")
+
+    print(f"\n{'запрос':<34}{'JSON, мс':>10}{'.col, мс':>10}{'ускорение':>11}")
+    for title, legacy, columnar in (
+        ("sum по sub1 x status (неделя)", income_json, income_columnar),
+        ("показы по banner_id (день)", traffic_json, traffic_columnar),
+    ):
+        before, expected = _best(legacy)
+        after, result = _best(columnar)
+        assert result == expected
+        print(f"{title:<34}{before * 1000:>10.1f}{after * 1000:>10.1f}{before / after:>10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
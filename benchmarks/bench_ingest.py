@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный/регрессионный бенчмарк приёма событий: /postback, /traffic_bh, /traffic_bh/ab_test.
+
+Для каждого размера данных (--sizes) поднимается отдельный процесс с временным DATA_DIR,
+файлы заранее «выращиваются» до нужного объёма, после чего приложение получает смесь
+запросов (--mix) от --concurrency параллельных клиентов. Размер N означает:
+    stat_lt_income (журнал недели)  — N записей
+    leads_sub6 за сегодня           — N строк
+    traffic_bh за сегодня           — N строк
+    krolik, сегодняшний день        — N/10 sub5
+    A/B аккаунт bench               — N/10 пользователей (часть запросов — их повторные шаги)
+
+Режимы: --server inprocess (по умолчанию; вызовы ASGI-приложения напрямую, без сети и без
+сторонних пакетов) или --server uvicorn (настоящий сервер на 127.0.0.1, один воркер; нужен httpx
+из requirements-dev.txt).
+
+Результат — пропускная способность и p50/p99 задержки по эндпоинтам для каждого размера.
+Сравнение с сохранённым baseline (benchmarks/baseline_ingest.json): ухудшение p50/p99 или
+пропускной способности больше --tolerance помечается REGRESSION, код выхода — 1.
+baseline зависит от машины: после смены железа перезапишите его с --save-baseline.
+
+Запуск (из корня репозитория):
+    python benchmarks/bench_ingest.py
+    python benchmarks/bench_ingest.py --sizes 0,100000 --requests 5000 --server uvicorn
+    python benchmarks/bench_ingest.py --save-baseline
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from json import dumps as json_dumps
+from pathlib import Path
+from urllib.parse import urlencode
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINE_FILE = Path(__file__).resolve().parent / "baseline_ingest.json"
+
+ENDPOINTS = ("postback", "traffic_bh", "ab_test")
+AB_ACCOUNT = "bench"
+SUB1_VALUES = ("krolik_vk", "monzi_tg", "karas_ads", "insta_kud", "unknown_src")
+
+
+# === Подготовка данных ===
+
+def _pregrow(app_main, size: int) -> None:
+    """Дописывает файлы хранилищ до объёма size прямо на диск (без HTTP)."""
+    now = datetime.datetime.now()
+    stat_file = app_main.get_stat_income_file()
+    with open(app_main.get_stat_income_journal(stat_file), "w", encoding="utf-8") as f:
+        for i in range(size):
+            f.write(json.dumps({
+                "sub1": SUB1_VALUES[i % len(SUB1_VALUES)], "sub2": "", "sub5": str(i), "sub6": str(i),
+                "sum": "100", "status": "1", "date": f"{now:%Y-%m-%d} 00:00:00",
+            }, ensure_ascii=False) + "\n")
+
+    with open(app_main.get_today_filename(), "w") as f:
+        f.writelines(f"{i}\n" for i in range(size))
+
+    with open(app_main._get_traffic_filename(), "w", encoding="utf-8") as f:
+        ts = now.astimezone().isoformat()
+        for i in range(size):
+            f.write(json.dumps({"timestamp": ts, "banner_id": str(i % 500), "user_id": str(i)}) + "\n")
+
+    krolik = app_main.DATA_DIR / "krolik.json"
+    for i in range(size // 10):
+        app_main.daily_sums.add(krolik, now.strftime("%d.%m.%Y"), str(i), 100.0)
+    app_main.daily_sums.flush()
+
+    users = {}
+    ts = now.isoformat()
+    for i in range(size // 10):
+        users[str(i)] = {
+            "banner_id": str(i % 500),
+            "branch": i % 2 + 1,
+            "steps": [
+                {"step": 0, "timestamp": ts, "time_from_prev": None},
+                {"step": 1, "timestamp": ts, "time_from_prev": 30.0},
+            ],
+            "first_seen": ts,
+            "last_seen": ts,
+        }
+    data = {"users": users, "stats": {"total_users": 0, "by_branch": {}, "by_step": {}}}
+    app_main._update_stats(data)
+    app_main.ab_store.import_account(AB_ACCOUNT, data)
+
+
+# === Нагрузка ===
+
+class Workload:
+    """Поток запросов заданной смеси. 2% постбэков — повторы (проверяется дедупликация)."""
+
+    def __init__(self, mix: dict, size: int, seed: int = 1):
+        self.rng = random.Random(seed)
+        self.endpoints = list(mix)
+        self.weights = [mix[e] for e in self.endpoints]
+        self.ab_users = max(1, size // 10)
+        self.seq = 0
+        self.sent_postbacks: list = []
+
+    def next(self):
+        self.seq += 1
+        endpoint = self.rng.choices(self.endpoints, self.weights)[0]
+        if endpoint == "postback":
+            if self.sent_postbacks and self.rng.random() < 0.02:
+                params = self.rng.choice(self.sent_postbacks)
+            else:
+                params = {
+                    "sub1": self.rng.choice(SUB1_VALUES),
+                    "sub5": str(self.rng.randrange(10 ** 6)),
+                    "sub6": str(10 ** 7 + self.seq),
+                    "sum": self.rng.choice(("0", "150", "300.5")),
+                    "status": self.rng.choice(("1", "1", "1", "0")),
+                    "date": f"bench-{self.seq}",
+                }
+                if len(self.sent_postbacks) < 1000:
+                    self.sent_postbacks.append(params)
+            return endpoint, "GET", "/postback", {"params": params}
+        if endpoint == "traffic_bh":
+            body = {"banner_id": str(self.rng.randrange(500)), "user_id": str(self.seq), "sub1": "krolik_vk"}
+            return endpoint, "POST", "/traffic_bh", {"json": body}
+        # A/B: половина — повторные шаги уже известных пользователей
+        if self.rng.random() < 0.5:
+            user_id, step = str(self.rng.randrange(self.ab_users)), self.rng.choice((2, 2.1, 3))
+        else:
+            user_id, step = f"new{self.seq}", 0
+        body = {"banner_id": "7", "user_id": user_id, "step": step, "account_name": AB_ACCOUNT, "count": 2}
+        return endpoint, "POST", "/traffic_bh/ab_test", {"json": body}
+
+
+async def _drive(client, workload: Workload, requests: int, concurrency: int) -> dict:
+    latencies = {e: [] for e in ENDPOINTS}
+    errors = {e: 0 for e in ENDPOINTS}
+    queue = [workload.next() for _ in range(requests)]
+    position = 0
+
+    async def worker() -> None:
+        nonlocal position
+        while position < len(queue):
+            endpoint, method, url, kwargs = queue[position]
+            position += 1
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                if response.status_code >= 400:
+                    errors[endpoint] += 1
+            except Exception:
+                errors[endpoint] += 1
+            latencies[endpoint].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    result = {"total": {"rps": requests / elapsed, "requests": requests}}
+    for endpoint, samples in latencies.items():
+        if not samples:
+            continue
+        samples.sort()
+        result[endpoint] = {
+            "requests": len(samples),
+            "rps": len(samples) / elapsed,
+            "p50_ms": samples[len(samples) // 2] * 1000,
+            "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+            "errors": errors[endpoint],
+        }
+    return result
+
+
+class AsgiResponse:
+    def __init__(self, status_code: int, body: bytes):
+        self.status_code = status_code
+        self.content = body
+
+
+class AsgiClient:
+    """Минимальный клиент для режима inprocess: request(method, url, params=..., json=...)
+    собирает HTTP-scope и вызывает ASGI-приложение напрямую."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, url: str, params: dict = None, json: dict = None) -> AsgiResponse:
+        body = b"" if json is None else json_dumps(json).encode()
+        headers = [(b"host", b"bench")]
+        if json is not None:
+            headers += [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+            "scheme": "http", "path": url, "raw_path": url.encode(), "root_path": "",
+            "query_string": urlencode(params or {}).encode(), "headers": headers,
+            "client": ("127.0.0.1", 0), "server": ("bench", 80),
+        }
+        request_sent = False
+        response_done = asyncio.Event()
+        status, chunks = 500, []
+
+        async def receive() -> dict:
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await response_done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message: dict) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    response_done.set()
+
+        await self.app(scope, receive, send)
+        return AsgiResponse(status, b"".join(chunks))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _run_child(args) -> dict:
+    sys.path.insert(0, str(ROOT))
+    import logging
+    import main as app_main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    _pregrow(app_main, args.size)
+    workload = Workload(args.mix, args.size)
+
+    if args.server == "inprocess":
+        async with app_main.app.router.lifespan_context(app_main.app):
+            return await _drive(AsgiClient(app_main.app), workload, args.requests, args.concurrency)
+
+    import httpx  # только для режима uvicorn: pip install -r requirements-dev.txt
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=ROOT, env=os.environ.copy(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits) as client:
+            for _ in range(100):
+                try:
+                    await client.get("/")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("uvicorn не запустился")
+            return await _drive(client, workload, args.requests, args.concurrency)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+# === Отчёт и baseline ===
+
+def _compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Строки отчёта и список регрессий относительно baseline."""
+    regressions = []
+    for key, by_endpoint in results.items():
+        base = baseline.get(key, {})
+        for endpoint in ENDPOINTS:
+            current, previous = by_endpoint.get(endpoint), base.get(endpoint)
+            if not current or not previous:
+                continue
+            for metric in ("p50_ms", "p99_ms"):
+                if current[metric] > previous[metric] * (1 + tolerance):
+                    regressions.append(f"{key} {endpoint} {metric}: {previous[metric]:.2f} -> {current[metric]:.2f}")
+            if current["rps"] < previous["rps"] * (1 - tolerance):
+                regressions.append(f"{key} {endpoint} rps: {previous['rps']:.0f} -> {current['rps']:.0f}")
+    return regressions
+
+
+def _print_results(results: dict, baseline: dict) -> None:
+    print(f"{'режим:размер':<22}{'эндпоинт':<12}{'запросов':>9}{'rps':>9}{'p50, мс':>9}{'p99, мс':>9}"
+          f"{'ошибок':>8}{'p99 base':>10}")
+    for key, by_endpoint in results.items():
+        for endpoint in ENDPOINTS:
+            r = by_endpoint.get(endpoint)
+            if not r:
+                continue
+            base = baseline.get(key, {}).get(endpoint)
+            base_p99 = f"{base['p99_ms']:.2f}" if base else "-"
+            print(f"{key:<22}{endpoint:<12}{r['requests']:>9}{r['rps']:>9.0f}{r['p50_ms']:>9.2f}"
+                  f"{r['p99_ms']:>9.2f}{r['errors']:>8}{base_p99:>10}")
+        print(f"{key:<22}{'всего':<12}{by_endpoint['total']['requests']:>9}{by_endpoint['total']['rps']:>9.0f}")
+
+
+def _parse_mix(value: str) -> dict:
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"неизвестный эндпоинт в --mix: {name}")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="0,10000,50000", help="размеры данных через запятую")
+    parser.add_argument("--requests", type=int, default=2000, help="запросов на каждый размер")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mix", type=_parse_mix, default=_parse_mix("postback=3,traffic_bh=6,ab_test=1"))
+    parser.add_argument("--server", choices=("inprocess", "uvicorn"), default="inprocess")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="допустимое ухудшение (доля)")
+    parser.add_argument("--save-baseline", action="store_true", help="записать результаты как baseline")
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)  # внутренний: запуск одного размера
+    args = parser.parse_args()
+
+    if args.size is not None:
+        print(json.dumps(asyncio.run(_run_child(args))))
+        return
+
+    results = {}
+    for size in (int(s) for s in args.sizes.split(",")):
+        tmp = Path(tempfile.mkdtemp(prefix="bench_ingest_"))
+        env = {
+            **os.environ,
+            "LEADS_DATA_DIR": str(tmp / "data"),
+            "LEADS_LOG_FILE": str(tmp / "postback.log"),
+        }
+        mix = ",".join(f"{k}={v}" for k, v in args.mix.items())
+        out = subprocess.run(
+            [sys.executable, __file__, "--size", str(size), "--requests", str(args.requests),
+             "--concurrency", str(args.concurrency), "--mix", mix, "--server", args.server],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, text=True,
+        ).stdout
+        results[f"{args.server}:{size}"] = json.loads(out.strip().splitlines()[-1])
+
+    baseline = {}
+    if BASELINE_FILE.exists():
+        with open(BASELINE_FILE, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    _print_results(results, baseline)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, ensure_ascii=False)
+        print(f"baseline записан: {BASELINE_FILE}")
+        return
+
+    regressions = _compare(results, baseline, args.tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк логирования горячих эндпоинтов: сколько времени запрос тратит на строку лога.
+
+Сценарии (каждый — в отдельном процессе, т.к. логирование настраивается при импорте main):
+    legacy         — прежняя схема: синхронные FileHandler + StreamHandler, f-строка с repr записи
+    sync_event     — log_event, синхронные обработчики
+    async          — log_event через очередь (QueueListener), текстовый формат
+    async_json     — то же, формат JSON-lines
+    async_sampled  — то же, LEADS_LOG_SAMPLE=traffic_bh=0.01
+
+Меряется задержка одного вызова в потоке запроса (p50/p99/среднее) и общее время,
+включая дописывание очереди в файл. stderr дочернего процесса уходит в /dev/null.
+
+Запуск (из корня репозитория):
+    python benchmarks/bench_logging.py --records 50000
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+SCENARIOS = {
+    "legacy": {"LEADS_LOG_ASYNC": "0"},
+    "sync_event": {"LEADS_LOG_ASYNC": "0"},
+    "async": {"LEADS_LOG_ASYNC": "1"},
+    "async_json": {"LEADS_LOG_ASYNC": "1", "LEADS_LOG_FORMAT": "json"},
+    "async_sampled": {"LEADS_LOG_ASYNC": "1", "LEADS_LOG_SAMPLE": "traffic_bh=0.01"},
+}
+
+
+def _record(i: int) -> dict:
+    return {
+        "timestamp": datetime.datetime.now().astimezone().isoformat(),
+        "banner_id": str(100000 + i % 5000),
+        "user_id": str(i),
+        "sub1": "krolik_campaign",
+        "utm_source": "vk",
+    }
+
+
+def _child(scenario: str, records: int) -> None:
+    sys.path.insert(0, str(ROOT))
+    import logging
+    import main as app_main
+
+    samples = []
+    t0 = time.perf_counter()
+    for i in range(records):
+        record = _record(i)
+        t = time.perf_counter()
+        if scenario == "legacy":
+            logging.info(f"[traffic_bh] saved: {record}")
+        else:
+            app_main.log_event("traffic_bh", "[traffic_bh] saved", record)
+        samples.append(time.perf_counter() - t)
+    if app_main.log_listener is not None:
+        app_main.log_listener.stop()  # дожидаемся записи очереди
+    total = time.perf_counter() - t0
+
+    samples.sort()
+    print(json.dumps({
+        "p50_us": samples[len(samples) // 2] * 1e6,
+        "p99_us": samples[int(len(samples) * 0.99)] * 1e6,
+        "mean_us": statistics.fmean(samples) * 1e6,
+        "total_s": total,
+    }))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=50000)
+    parser.add_argument("--child", choices=sorted(SCENARIOS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args.child, args.records)
+        return
+
+    print(f"{'сценарий':<15}{'p50, мкс':>10}{'p99, мкс':>10}{'среднее':>10}{'всего, с':>10}")
+    for scenario, env in SCENARIOS.items():
+        tmp = Path(tempfile.mkdtemp(prefix="bench_logging_"))
+        child_env = {
+            **os.environ, **env,
+            "LEADS_DATA_DIR": str(tmp / "data"),
+            "LEADS_LOG_FILE": str(tmp / "postback.log"),
+        }
+        out = subprocess.run(
+            [sys.executable, __file__, "--child", scenario, "--records", str(args.records)],
+            env=child_env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, text=True,
+        ).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        print(f"{scenario:<15}{r['p50_us']:>10.1f}{r['p99_us']:>10.1f}{r['mean_us']:>10.1f}{r['total_s']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
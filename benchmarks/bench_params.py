@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк разбора параметров запроса и JSON-кодека: прежний код против текущего.
+
+1. Извлечение параметров для /traffic_bh и /traffic_bh/ab_test (JSON и форма):
+   прежняя цепочка request.json() -> request.form() -> query против read_request_params.
+2. Сериализация: строка traffic_bh / stat_lt_income и файл A/B аккаунта (запись и чтение)
+   через stdlib json с indent=2 против json_dumps_bytes/json_loads (orjson, если установлен,
+   и компактный формат).
+
+Запуск (из корня репозитория):
+    python benchmarks/bench_params.py --iterations 20000 --ab-users 20000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _setup_env() -> Path:
+    tmp = Path(tempfile.mkdtemp(prefix="bench_params_"))
+    os.environ["LEADS_DATA_DIR"] = str(tmp / "data")
+    os.environ["LEADS_LOG_FILE"] = str(tmp / "postback.log")
+    sys.path.insert(0, str(ROOT))
+    return tmp
+
+
+def _make_request(Request, path: str, query: dict, body: bytes, content_type: str):
+    scope = {
+        "type": "http", "method": "POST", "path": path, "raw_path": path.encode(),
+        "query_string": urlencode(query).encode(), "root_path": "", "scheme": "http",
+        "server": ("bench", 80), "client": ("127.0.0.1", 1),
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+    }
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            return {"type": "http.disconnect"}
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return Request(scope, receive)
+
+
+async def _legacy_traffic_params(request) -> tuple:
+    """Прежний разбор /traffic_bh: JSON, затем форма, затем query."""
+    banner_id = user_id = None
+    extra = {}
+    try:
+        body = await request.json()
+        if isinstance(body, dict):
+            banner_id = body.get("banner_id") or body.get("bannerId")
+            user_id = body.get("user_id") or body.get("userId")
+            for k, v in body.items():
+                if k not in ("banner_id", "bannerId", "user_id", "userId"):
+                    extra[k] = v
+    except Exception:
+        pass
+    if not banner_id or not user_id:
+        try:
+            form = await request.form()
+            if not banner_id:
+                banner_id = form.get("banner_id") or form.get("bannerId")
+            if not user_id:
+                user_id = form.get("user_id") or form.get("userId")
+            for k in form.keys():
+                if k not in ("banner_id", "bannerId", "user_id", "userId"):
+                    extra[k] = form.get(k)
+        except Exception:
+            pass
+    params = dict(request.query_params)
+    if not banner_id:
+        banner_id = params.get("banner_id") or params.get("bannerId")
+    if not user_id:
+        user_id = params.get("user_id") or params.get("userId")
+    for k, v in params.items():
+        if k not in ("banner_id", "bannerId", "user_id", "userId"):
+            extra.setdefault(k, v)
+    return banner_id, user_id, extra
+
+
+async def _legacy_ab_params(request) -> dict:
+    """Прежний разбор /traffic_bh/ab_test: query + JSON или форма по content-type."""
+    all_params = dict(request.query_params)
+    content_type = request.headers.get("content-type", "")
+    if "application/json" in content_type:
+        try:
+            body = await request.json()
+            if isinstance(body, dict):
+                all_params.update(body)
+        except Exception:
+            pass
+    else:
+        try:
+            form = await request.form()
+            for key in form.keys():
+                all_params[key.strip()] = form.get(key)
+        except Exception:
+            pass
+    return all_params
+
+
+async def _new_traffic_params(app_main, request) -> tuple:
+    params = await app_main.read_request_params(request, app_main.TRAFFIC_PARAM_ALIASES)
+    return params.pop("banner_id", None), params.pop("user_id", None), params
+
+
+async def _new_ab_params(app_main, request) -> dict:
+    return await app_main.read_request_params(request, app_main.AB_TEST_PARAM_ALIASES)
+
+
+async def _time_async(fn, make, iterations: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        await fn(make())
+    return (time.perf_counter() - t0) / iterations * 1e6
+
+
+def _time(fn, iterations: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - t0) / iterations * 1e6
+
+
+def _ab_account(users: int) -> dict:
+    ts = "2026-01-01T12:00:00+04:00"
+    return {
+        "users": {
+            str(i): {
+                "banner_id": str(i % 500), "branch": i % 2 + 1,
+                "steps": [{"step": 0, "timestamp": ts, "time_from_prev": None},
+                          {"step": 1, "timestamp": ts, "time_from_prev": 31.5}],
+                "first_seen": ts, "last_seen": ts,
+            }
+            for i in range(users)
+        },
+        "stats": {"total_users": users, "by_branch": {"1": users // 2, "2": users - users // 2}, "by_step": {}},
+    }
+
+
+async def _run(args) -> None:
+    import logging
+    from starlette.requests import Request
+    import main as app_main
+
+    logging.getLogger().setLevel(logging.ERROR)
+    n = args.iterations
+    traffic = {"banner_id": "123", "user_id": "456", "sub1": "krolik_vk", "utm_source": "vk"}
+    ab = {"banner_id": "123", "user_id": "456", "step": "2.1", "account_name": "acc", "count": "2"}
+    cases = [
+        ("traffic_bh JSON", "/traffic_bh", json.dumps(traffic).encode(), "application/json",
+         _legacy_traffic_params, lambda r: _new_traffic_params(app_main, r)),
+        ("traffic_bh form", "/traffic_bh", urlencode(traffic).encode(), "application/x-www-form-urlencoded",
+         _legacy_traffic_params, lambda r: _new_traffic_params(app_main, r)),
+        ("ab_test JSON", "/traffic_bh/ab_test", json.dumps(ab).encode(), "application/json",
+         _legacy_ab_params, lambda r: _new_ab_params(app_main, r)),
+        ("ab_test form", "/traffic_bh/ab_test", urlencode(ab).encode(), "application/x-www-form-urlencoded",
+         _legacy_ab_params, lambda r: _new_ab_params(app_main, r)),
+    ]
+
+    codec = "orjson" if app_main.orjson is not None else "stdlib json"
+    print(f"Кодек JSON: {codec}, LEADS_JSON_INDENT={app_main.JSON_INDENT}")
+    print(f"{'разбор параметров':<28}{'прежний, мкс':>14}{'текущий, мкс':>14}{'ускорение':>11}")
+    for title, path, body, content_type, legacy, new in cases:
+        make = lambda: _make_request(Request, path, {"x": "1"}, body, content_type)  # noqa: E731
+        before = await _time_async(legacy, make, n)
+        after = await _time_async(new, make, n)
+        print(f"{title:<28}{before:>14.1f}{after:>14.1f}{before / after:>10.1f}x")
+
+    record = {"timestamp": "2026-01-01T12:00:00.000000+04:00", **traffic}
+    account = _ab_account(args.ab_users)
+    legacy_file = json.dumps(account, indent=2, ensure_ascii=False).encode("utf-8")
+    new_file = app_main.json_dumps_bytes(account, app_main.JSON_INDENT)
+    rows = [
+        ("строка traffic_bh", n,
+         lambda: json.dumps(record, ensure_ascii=False) + "\n",
+         lambda: app_main.json_dumps(record) + "\n"),
+        (f"A/B файл: запись ({args.ab_users})", 5,
+         lambda: json.dumps(account, indent=2, ensure_ascii=False).encode("utf-8"),
+         lambda: app_main.json_dumps_bytes(account, app_main.JSON_INDENT)),
+        (f"A/B файл: чтение ({args.ab_users})", 5,
+         lambda: json.loads(legacy_file),
+         lambda: app_main.json_loads(new_file)),
+    ]
+    print(f"\n{'сериализация':<28}{'прежний, мкс':>14}{'текущий, мкс':>14}{'ускорение':>11}")
+    for title, iterations, legacy, new in rows:
+        before = _time(legacy, iterations)
+        after = _time(new, iterations)
+        print(f"{title:<28}{before:>14.1f}{after:>14.1f}{before / after:>10.1f}x")
+    print(f"\nРазмер A/B файла: {len(legacy_file)} -> {len(new_file)} байт")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--ab-users", type=int, default=20000)
+    args = parser.parse_args()
+    _setup_env()
+    asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк маршрутизации sub1 -> файл партнёра.
+
+Сравнивает прежнюю цепочку `elif "kw" in sub1_lower` с KeywordMatcher (Ахо–Корасик)
+на 15, 100 и 1000 партнёрах. Кроме 15 реальных правил добавляются синтетические.
+
+Запуск (из корня репозитория):
+    python benchmarks/bench_routing.py
+    python benchmarks/bench_routing.py --partners 15 100 1000 5000 --lookups 200000
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _setup_env() -> None:
+    tmp = Path(tempfile.mkdtemp(prefix="bench_routing_"))
+    os.environ["LEADS_DATA_DIR"] = str(tmp / "data")
+    os.environ["LEADS_LOG_FILE"] = str(tmp / "postback.log")
+    sys.path.insert(0, str(ROOT))
+
+
+def _make_rules(base: list, n: int, rnd: random.Random) -> list:
+    rules = [(r["keywords"], r["file"]) for r in base][:n]
+    while len(rules) < n:
+        name = "".join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(6, 12)))
+        rules.append(([name], f"{name}.json"))
+    return rules
+
+
+def _chain(rules: list, sub1: str):
+    sub1_lower = sub1.lower()
+    for keywords, target in rules:
+        for keyword in keywords:
+            if keyword in sub1_lower:
+                return target
+    return None
+
+
+def _make_inputs(rules: list, count: int, rnd: random.Random) -> list:
+    """Смесь: совпадение с партнёром из начала/середины/конца таблицы и промахи."""
+    inputs = []
+    for _ in range(count):
+        kind = rnd.random()
+        if kind < 0.7:
+            keyword = rnd.choice(rnd.choice(rules)[0])
+        elif kind < 0.9:
+            keyword = rnd.choice(rules[-1][0])
+        else:
+            keyword = "unknownpartner"
+        inputs.append(f"{keyword}_{rnd.randint(1, 999)}_vk_{rnd.choice(['ads', 'tg', 'bot'])}")
+    return inputs
+
+
+def _bench(fn, inputs: list) -> float:
+    t0 = time.perf_counter()
+    for sub1 in inputs:
+        fn(sub1)
+    return (time.perf_counter() - t0) / len(inputs)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--partners", type=int, nargs="+", default=[15, 100, 1000])
+    parser.add_argument("--lookups", type=int, default=100_000)
+    args = parser.parse_args()
+
+    _setup_env()
+    import logging
+    import main as app_main
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rnd = random.Random(42)
+    print(f"{'partners':>9} {'chain, us':>10} {'matcher, us':>12} {'speedup':>8} {'build, ms':>10}")
+    for n in args.partners:
+        rules = _make_rules(app_main._DEFAULT_PARTNER_ROUTES, n, rnd)
+        inputs = _make_inputs(rules, args.lookups, rnd)
+
+        t0 = time.perf_counter()
+        matcher = app_main.KeywordMatcher(rules)
+        build = time.perf_counter() - t0
+
+        mismatches = sum(1 for s in inputs[:10_000] if _chain(rules, s) != matcher.match(s.lower()))
+        if mismatches:
+            raise SystemExit(f"{n} партнёров: результаты расходятся в {mismatches} случаях")
+
+        chain_t = _bench(lambda s: _chain(rules, s), inputs)
+        matcher_t = _bench(lambda s: matcher.match(s.lower()), inputs)
+        print(f"{n:>9} {chain_t * 1e6:>10.2f} {matcher_t * 1e6:>12.2f} {chain_t / matcher_t:>7.1f}x {build * 1e3:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
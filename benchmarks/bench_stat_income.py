@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк save_stat_income: задержка одной записи по мере роста недельного файла.
+
+Запуск (из корня репозитория):
+    python benchmarks/bench_stat_income.py --records 500000
+    python benchmarks/bench_stat_income.py --records 20000 --legacy
+
+--legacy дополнительно прогоняет старую схему (перечитать JSON, дописать, переписать целиком)
+для сравнения; на больших объёмах она квадратичная, поэтому держите --records небольшим.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _setup_env() -> Path:
+    tmp = Path(tempfile.mkdtemp(prefix="bench_stat_income_"))
+    os.environ["LEADS_DATA_DIR"] = str(tmp / "data")
+    os.environ["LEADS_LOG_FILE"] = str(tmp / "postback.log")
+    sys.path.insert(0, str(ROOT))
+    return tmp
+
+
+def _legacy_save(stat_file: Path, record: dict) -> None:
+    data = []
+    if stat_file.exists():
+        with open(stat_file, "r") as f:
+            data = json.load(f)
+    data.append(record)
+    with open(stat_file, "w") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+
+
+def _report(title: str, latencies: list, windows: int) -> None:
+    print(title)
+    print(f"{'records':>18} {'p50, us':>10} {'p99, us':>10} {'max, us':>10}")
+    n = len(latencies)
+    size = max(1, min(1000, n // windows))
+    starts = sorted({int(i * (n - size) / max(1, windows - 1)) for i in range(windows)})
+    for start in starts:
+        window = sorted(latencies[start:start + size])
+        p50 = statistics.median(window)
+        p99 = window[min(len(window) - 1, int(len(window) * 0.99))]
+        print(f"{start + 1:>8}-{start + size:<9} {p50 * 1e6:>10.1f} {p99 * 1e6:>10.1f} {window[-1] * 1e6:>10.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=500_000)
+    parser.add_argument("--windows", type=int, default=6, help="сколько окон по 1000 записей показать")
+    parser.add_argument("--legacy", action="store_true", help="прогнать и старую схему")
+    args = parser.parse_args()
+
+    tmp = _setup_env()
+
+    import logging
+    import main as app_main
+    logging.getLogger().setLevel(logging.WARNING)
+
+    latencies = []
+    for i in range(args.records):
+        t0 = time.perf_counter()
+        app_main.save_stat_income(
+            sub1_name="krolik_bench", sub5=str(100000 + i), date_str="",
+            sum_value="150.5", sub6=str(i), sub2="ad", status="1",
+        )
+        latencies.append(time.perf_counter() - t0)
+    _report(f"journal: {args.records} записей", latencies, args.windows)
+
+    if args.legacy:
+        stat_file = tmp / "legacy.json"
+        latencies = []
+        for i in range(args.records):
+            record = {"sub1": "krolik_bench", "sub2": "ad", "sub5": str(100000 + i), "sub6": str(i),
+                      "sum": "150.5", "status": "1", "date": "2026-01-01 00:00:00"}
+            t0 = time.perf_counter()
+            _legacy_save(stat_file, record)
+            latencies.append(time.perf_counter() - t0)
+        _report(f"legacy full rewrite: {args.records} записей", latencies, args.windows)
+
+    print(f"данные: {tmp}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк записи traffic_bh: прежняя схема (open/write/fsync на каждую запись прямо
+в обработчике) против TrafficWriter с групповой записью и разными политиками fsync.
+
+Нагрузка — N параллельных корутин, каждая вызывает append_traffic_record в цикле
+(так же конкурируют запросы в одном воркере uvicorn).
+
+Запуск (из корня репозитория):
+    python benchmarks/bench_traffic_writer.py --records 20000 --concurrency 64
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _setup_env() -> Path:
+    tmp = Path(tempfile.mkdtemp(prefix="bench_traffic_"))
+    os.environ["LEADS_DATA_DIR"] = str(tmp / "data")
+    os.environ["LEADS_LOG_FILE"] = str(tmp / "postback.log")
+    sys.path.insert(0, str(ROOT))
+    return tmp
+
+
+def _legacy_append(file_path: Path, banner_id: str, user_id: str) -> None:
+    record = {
+        "timestamp": datetime.datetime.now().astimezone().isoformat(),
+        "banner_id": banner_id,
+        "user_id": user_id,
+    }
+    with open(file_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+async def _drive(fn, records: int, concurrency: int) -> float:
+    per_worker = records // concurrency
+
+    async def worker(w: int) -> None:
+        for i in range(per_worker):
+            await fn(str(w), str(i))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(concurrency)))
+    return per_worker * concurrency / (time.perf_counter() - t0)
+
+
+async def _run(args, tmp: Path) -> None:
+    import main as app_main
+
+    legacy_file = tmp / "legacy.jsonl"
+
+    async def legacy(banner_id, user_id):
+        _legacy_append(legacy_file, banner_id, user_id)
+
+    print(f"{'mode':<28} {'records/s':>12}")
+    rate = await _drive(legacy, args.records, args.concurrency)
+    print(f"{'legacy fsync per record':<28} {rate:>12.0f}")
+
+    for policy in ("always", "interval", "count", "none"):
+        for wait in (True, False):
+            app_main.traffic_writer = app_main.TrafficWriter(
+                policy, app_main.TRAFFIC_FSYNC_INTERVAL_MS, app_main.TRAFFIC_FSYNC_EVERY,
+                wait, app_main.TRAFFIC_QUEUE_MAX, app_main.TRAFFIC_BATCH_MAX,
+            )
+            app_main.traffic_writer.start()
+            t0 = time.perf_counter()
+            await _drive(lambda b, u: app_main.append_traffic_record(b, u), args.records, args.concurrency)
+            await app_main.traffic_writer.stop()
+            rate = args.records // args.concurrency * args.concurrency / (time.perf_counter() - t0)
+            print(f"{'writer ' + policy + (' wait' if wait else ' nowait'):<28} {rate:>12.0f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    tmp = _setup_env()
+    import logging
+    import main  # noqa: F401 — настраивает логирование
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(_run(args, tmp))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Стресс-тест нескольких воркеров: N процессов одновременно пишут в одни и те же файлы
+хранилищ (общий временный DATA_DIR), после чего проверяется, что ни одно обновление не потеряно.
+
+Каждый воркер выполняет --ops итераций; в каждой:
+    суммы партнёра  — save_daily_sum(krolik, +1) и сброс на диск каждые --flush-every итераций
+    stat_lt_income  — одна запись; каждые --compact-every итераций — свёртка журнала недели
+    A/B             — шаг одного из --ab-users общих пользователей (с переносом в холодные сегменты)
+    sub6            — уникальное значение
+    traffic_bh      — одна запись через TrafficWriter (с индексом)
+    дедупликация    — один из --ops общих для всех воркеров ключей постбэка
+
+Проверки: сумма партнёра = N * ops; в stat_lt_income, sub6 и traffic_bh ровно N * ops
+уникальных записей без оборванных строк; индекс traffic_bh указывает ровно на эти строки;
+у A/B пользователей N * ops шагов и stats совпадают с пересчётом; каждый ключ постбэка
+принят как новый ровно одним воркером. При ошибке код выхода — 1.
+
+Запуск (из корня репозитория):
+    python benchmarks/stress_workers.py
+    python benchmarks/stress_workers.py --workers 16 --ops 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+AB_ACCOUNT = "stress"
+
+
+# === Воркер ===
+
+def _wait_for(path: Path, timeout: float = 120) -> None:
+    deadline = time.monotonic() + timeout
+    while not path.exists():
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"не дождались {path}")
+        time.sleep(0.01)
+
+
+async def _run_worker(args) -> dict:
+    sys.path.insert(0, str(ROOT))
+    import logging
+    import main as app_main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    krolik = app_main.DATA_DIR / "krolik.json"
+    stat_file = app_main.get_stat_income_file()
+    fresh_postbacks = 0
+
+    run_dir = Path(args.run_dir)
+    (run_dir / f"ready_{args.worker}").touch()
+    _wait_for(run_dir / "go")
+
+    for j in range(args.ops):
+        app_main.save_daily_sum(krolik, f"s{j % 10}", "1", log=False)
+        if j % args.flush_every == 0:
+            app_main.daily_sums.flush()
+
+        app_main.save_stat_income_records([
+            app_main.make_stat_income_record("krolik_vk", str(j), "", "1", f"{args.worker}-{j}")
+        ])
+        if j % args.compact_every == args.worker % args.compact_every:
+            app_main.compact_stat_income(stat_file)
+
+        app_main.process_ab_test_event("7", f"u{(j + args.worker) % args.ab_users}", j % 3, AB_ACCOUNT, 2)
+        app_main.sub6_index.append(str(args.worker * args.ops + j))
+        await app_main.append_traffic_record("1", f"{args.worker}-{j}")
+        if not app_main.postback_dedup.check_and_add(f"krolik_vk\x1f{j}\x1f1"):
+            fresh_postbacks += 1
+
+    app_main.daily_sums.flush()
+    await app_main.traffic_writer.stop()
+    return {"fresh_postbacks": fresh_postbacks}
+
+
+# === Проверки ===
+
+def _check(workers: int, ops: int) -> list:
+    """Проверяет общий DATA_DIR после прогона. Возвращает список ошибок."""
+    sys.path.insert(0, str(ROOT))
+    import datetime
+    import logging
+    import main as app_main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    expected = workers * ops
+    errors = []
+
+    def expect(name: str, actual, wanted) -> None:
+        status = "ok" if actual == wanted else "FAIL"
+        print(f"{name:<36}{str(actual):>12}{str(wanted):>12}  {status}")
+        if actual != wanted:
+            errors.append(f"{name}: {actual} != {wanted}")
+
+    print(f"{'проверка':<36}{'факт':>12}{'ожидалось':>12}")
+
+    today = datetime.date.today()
+    blocks = app_main.daily_sums.read_range(app_main.DATA_DIR / "krolik.json", today, today)
+    expect("суммы партнёра", round(sum(sum(b["data"].values()) for b in blocks)), expected)
+
+    records = json.loads("".join(app_main.iter_stat_income_json(app_main.get_stat_income_file())))
+    expect("stat_lt_income: записей", len(records), expected)
+    expect("stat_lt_income: уникальных", len({r["sub6"] for r in records}), expected)
+
+    with open(app_main.get_today_filename(), "r") as f:
+        lines = f.read().splitlines()
+    expect("sub6: строк", len(lines), expected)
+    expect("sub6: уникальных", len(set(lines)), expected)
+
+    data_file = app_main._get_traffic_filename()
+    with open(data_file, "rb") as f:
+        raw = f.read()
+    traffic = [json.loads(line) for line in raw.splitlines()]
+    expect("traffic_bh: уникальных записей", len({r["user_id"] for r in traffic}), expected)
+    with open(app_main.get_traffic_index_file(data_file), "rb") as f:
+        index = [line.split(b"\t") for line in f.read().splitlines()]
+    indexed = set()
+    for offset, length, *_ in index:
+        line = raw[int(offset):int(offset) + int(length)]
+        if line.endswith(b"\n"):
+            indexed.add(json.loads(line)["user_id"])
+    expect("traffic_bh: строк индекса", len(index), expected)
+    expect("traffic_bh: записей по индексу", len(indexed), expected)
+
+    account = app_main.ab_store.export_account(AB_ACCOUNT)
+    expect("A/B: шагов", sum(len(u["steps"]) for u in account["users"].values()), expected)
+    with app_main.ab_store.session(AB_ACCOUNT) as session:
+        expect("A/B: stats совпадают с пересчётом", session.verify_stats(AB_ACCOUNT), True)
+    return errors
+
+
+# === Запуск ===
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=max(2, os.cpu_count() or 1))
+    parser.add_argument("--ops", type=int, default=300, help="итераций на воркер")
+    parser.add_argument("--flush-every", type=int, default=7, help="сброс сумм партнёра каждые N итераций")
+    parser.add_argument("--compact-every", type=int, default=50, help="свёртка журнала stat_lt_income")
+    parser.add_argument("--ab-users", type=int, default=60, help="общих A/B пользователей")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)  # внутренний: запуск воркера
+    parser.add_argument("--run-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--check", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        print(json.dumps(asyncio.run(_run_worker(args))))
+        return
+    if args.check:
+        sys.exit(1 if _check(args.workers, args.ops) else 0)
+
+    tmp = Path(tempfile.mkdtemp(prefix="stress_workers_"))
+    env = {
+        **os.environ,
+        "LEADS_DATA_DIR": str(tmp / "data"),
+        "LEADS_LOG_FILE": str(tmp / "postback.log"),
+        # Маленький горячий набор, чтобы переносы в холодные сегменты и их слияние шли постоянно
+        "AB_HOT_MAX_USERS": str(max(1, args.ab_users // 3)),
+        "AB_TIER_CHECK_INTERVAL": "0",
+        "AB_COLD_MAX_SEGMENTS": "3",
+        "PARTNER_LEGACY_EXPORT_INTERVAL": "0",
+        "POSTBACK_DEDUP": "1",  # по умолчанию выключена
+    }
+    common = ["--ops", str(args.ops), "--flush-every", str(args.flush_every),
+              "--compact-every", str(args.compact_every), "--ab-users", str(args.ab_users)]
+    children = [
+        subprocess.Popen(
+            [sys.executable, __file__, "--worker", str(i), "--run-dir", str(tmp), *common],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        )
+        for i in range(args.workers)
+    ]
+    for i in range(args.workers):
+        _wait_for(tmp / f"ready_{i}")
+    started = time.perf_counter()
+    (tmp / "go").touch()
+
+    fresh_postbacks = 0
+    for i, child in enumerate(children):
+        out, _ = child.communicate()
+        if child.returncode != 0:
+            print(f"воркер {i} завершился с кодом {child.returncode}")
+            sys.exit(1)
+        fresh_postbacks += json.loads(out.strip().splitlines()[-1])["fresh_postbacks"]
+    elapsed = time.perf_counter() - started
+    print(f"{args.workers} воркеров × {args.ops} итераций за {elapsed:.1f} с, данные: {tmp / 'data'}")
+
+    check = subprocess.run(
+        [sys.executable, __file__, "--check", "--workers", str(args.workers), "--ops", str(args.ops)], env=env,
+    )
+    status = "ok" if fresh_postbacks == args.ops else "FAIL"
+    print(f"{'дедупликация: принято новыми':<36}{fresh_postbacks:>12}{args.ops:>12}  {status}")
+    if check.returncode != 0 or fresh_postbacks != args.ops:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Перекладывает закрытые файлы в колоночный формат (.col, см. «Колоночный формат» в main.py).
+
+    python columnar_compact.py                       # traffic_bh прошедших дней и stat_lt_income прошедших недель
+    python columnar_compact.py --only traffic_bh
+    python columnar_compact.py --keep-source         # не удалять исходные файлы
+    python columnar_compact.py --dry-run             # только показать, что будет переложено
+
+Закрытый файл — тот, в который сервис больше не пишет: traffic_bh_YYYY-MM-DD.jsonl за прошедший
+день, не менявшийся дольше --grace секунд, и stat_lt_income_YYYY_Wnn.json прошедшей недели
+со свёрнутым журналом. Колоночная копия читается обратно и сравнивается с исходными записями;
+исходный файл (и индекс .idx) удаляется только при полном совпадении. traffic_bh, хвост которого
+ещё не выгружен upload_to_s3.py (файл есть в .s3_sync_state.json), остаётся до выгрузки.
+Неделя stat_lt_income перекладывается под её блокировкой и только без журнала; если запись
+за неделю всё же придёт позже, свёртка журнала соберёт полный JSON и удалит устаревший .col.
+
+Сервис читает .col сам (/traffic_bh/query, /stat_lt_income), так что запускать можно на работающем
+сервисе — например, cron раз в сутки после upload_to_s3.py.
+"""
+import argparse
+import datetime
+import logging
+import time
+from pathlib import Path
+
+import main
+
+# Файл состояния upload_to_s3.py --sync
+SYNC_STATE_FILE = main.DATA_DIR / ".s3_sync_state.json"
+
+
+def _pending_uploads() -> set:
+    if not SYNC_STATE_FILE.exists():
+        return set()
+    try:
+        return set(main.json_loads(SYNC_STATE_FILE.read_bytes()))
+    except ValueError:
+        logging.warning(f"Файл {SYNC_STATE_FILE.name} повреждён — traffic_bh не удаляем")
+        return {path.name for path in main.TRAFFIC_DIR.glob("traffic_bh_*.jsonl")}
+
+
+def sealed_files(only: str, grace: float) -> list:
+    """(kind, исходный файл) для закрытых файлов без колоночной копии."""
+    files = []
+    if only in ("all", "traffic_bh"):
+        today_file = main.TrafficIndex.data_file(datetime.date.today())
+        for path in sorted(main.TRAFFIC_DIR.glob("traffic_bh_*.jsonl")):
+            if path.name < today_file.name and time.time() - path.stat().st_mtime > grace:
+                files.append(("traffic_bh", path))
+    if only in ("all", "stat_lt_income"):
+        current = main.get_stat_income_file()
+        for path in sorted(main.STAT_INCOME_DIR.glob("stat_lt_income_*.json")):
+            if path != current and not main.get_stat_income_journal(path).exists():
+                files.append(("stat_lt_income", path))
+    return [(kind, path) for kind, path in files if not main.get_columnar_file(path).exists()]
+
+
+def read_records(kind: str, path: Path) -> list:
+    """Записи исходного файла. ValueError — файл нельзя переложить без потерь."""
+    raw = path.read_bytes()
+    if kind == "stat_lt_income":
+        records = main.json_loads(raw)
+        if not isinstance(records, list):
+            raise ValueError("ожидался JSON-массив")
+    else:
+        records = [main.json_loads(line) for line in raw.splitlines() if line.strip()]
+    if not all(isinstance(record, dict) for record in records):
+        raise ValueError("не все записи — JSON-объекты")
+    return records
+
+
+def compact_file(kind: str, path: Path, keep_source: bool, pending: set) -> tuple:
+    """Перекладывает файл. Возвращает (размер исходного, размер .col)."""
+    if kind == "stat_lt_income":
+        # Под блокировкой недели сервис не допишет журнал и не свернёт его посреди перекладки
+        with main.file_lock(path):
+            if main.get_stat_income_journal(path).exists():
+                raise ValueError("у недели есть несвёрнутый журнал")
+            return _compact_file(kind, path, keep_source, pending)
+    return _compact_file(kind, path, keep_source, pending)
+
+
+def _compact_file(kind: str, path: Path, keep_source: bool, pending: set) -> tuple:
+    records = read_records(kind, path)
+    source_size = path.stat().st_size
+    columnar_file = main.get_columnar_file(path)
+    size = main.write_columnar(columnar_file, records, kind)
+
+    if list(main.ColumnarFile(columnar_file).scan()) != records:
+        columnar_file.unlink()
+        raise ValueError("колоночная копия не совпала с исходными записями")
+
+    if keep_source:
+        pass
+    elif path.name in pending:
+        logging.info(f"{path.name}: ждёт выгрузки в S3, исходный файл оставлен")
+    else:
+        path.unlink()
+        if kind == "traffic_bh":
+            main.get_traffic_index_file(path).unlink(missing_ok=True)
+    return source_size, size
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", choices=["all", "traffic_bh", "stat_lt_income"], default="all")
+    parser.add_argument("--grace", type=float, default=600, help="сколько секунд файл не должен меняться")
+    parser.add_argument("--keep-source", action="store_true", help="не удалять исходные файлы")
+    parser.add_argument("--dry-run", action="store_true", help="только показать файлы")
+    args = parser.parse_args()
+
+    files = sealed_files(args.only, args.grace)
+    if args.dry_run:
+        for kind, path in files:
+            logging.info(f"{kind}: {path.name} ({path.stat().st_size} байт)")
+        return
+
+    pending = _pending_uploads()
+    total_source = total_columnar = converted = 0
+    for kind, path in files:
+        try:
+            source_size, size = compact_file(kind, path, args.keep_source, pending)
+        except (ValueError, OSError) as e:
+            logging.error(f"❌ {path.name}: не переложен: {e}")
+            continue
+        converted += 1
+        total_source += source_size
+        total_columnar += size
+        logging.info(f"✅ {path.name}: {source_size} -> {size} байт ({source_size / max(size, 1):.1f}x)")
+    if converted:
+        logging.info(f"Итого: {total_source} -> {total_columnar} байт, файлов: {converted}")
+
+
+if __name__ == "__main__":
+    main_cli()
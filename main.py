@@ -1,160 +1,2231 @@
+import time
+_IMPORT_STARTED = time.perf_counter()  # начало отчёта о времени запуска (см. StartupReport)
+
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 import os
 import datetime
-import boto3
 import logging
+import logging.handlers
 from pathlib import Path
 import json
 from typing import Optional
 import threading
+import atexit
+import asyncio
+import sqlite3
+import copy
+import math
+import mmap
+import hashlib
+import sys
+import zlib
+from array import array
+import bisect
+import heapq
+import functools
+import queue
+import random
+import fcntl
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+import importlib
+
+VERSION="1.21"
+
+
+class StartupReport:
+    """Время запуска по компонентам: сколько заняли импорты и инициализация каждого блока
+    main.py, а также отложенная загрузка подключаемых приложений. Пишется в лог при старте
+    и отдаётся в /metrics (leads_startup_seconds). Детальнее по модулям: python -X importtime."""
+
+    def __init__(self, started: float):
+        self.started = started
+        self._last = started
+        self.components: dict = {}
+
+    def mark(self, component: str) -> None:
+        """Закрывает компонент: время с предыдущей отметки."""
+        now = time.perf_counter()
+        self.components[component] = now - self._last
+        self._last = now
+
+    def add(self, component: str, seconds: float) -> None:
+        self.components[component] = seconds
+
+    def summary(self) -> str:
+        parts = ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in self.components.items())
+        return f"Запуск: {(self._last - self.started) * 1000:.0f} мс ({parts})"
+
+
+startup_report = StartupReport(_IMPORT_STARTED)
+startup_report.mark("imports")
+
+# === Логи ===
+# Запись в файл и stderr выполняет отдельный поток (QueueListener): обработчик запроса только
+# кладёт запись в очередь и не ждёт диска. LEADS_LOG_ASYNC=0 — прежняя синхронная запись.
+# LEADS_LOG_FORMAT=json — по объекту JSON на строку (ts, level, msg, channel, data).
+# События горячих эндпоинтов (log_event) можно прореживать по каналам:
+#   LEADS_LOG_SAMPLE="traffic_bh=0.01,ab_test=0.1"  — доля событий, попадающих в лог;
+#   LEADS_LOG_RATE_LIMIT="traffic_bh=50"            — не больше N событий канала в секунду.
+# Каналы: postback, traffic_bh, ab_test. По умолчанию пишется всё.
+LOG_FILE = os.getenv("LEADS_LOG_FILE", "/opt/leads_postback/postback.log")
+LOG_FORMAT = os.getenv("LEADS_LOG_FORMAT", "text")
+LOG_ASYNC = os.getenv("LEADS_LOG_ASYNC", "1") == "1"
+
+
+def _parse_log_channels(value: str) -> dict:
+    """"канал=число,канал=число" -> {канал: число}."""
+    result = {}
+    for item in value.split(","):
+        channel, sep, number = item.partition("=")
+        if sep and channel.strip():
+            result[channel.strip()] = float(number)
+    return result
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+        }
+        channel = getattr(record, "channel", None)
+        if channel is not None:
+            entry["channel"] = channel
+            entry["msg"] = record.event
+            entry["data"] = record.data
+        else:
+            entry["msg"] = record.getMessage()
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует события log_event в потоке запроса:
+    их data — свежий словарь, который после логирования не меняется, поэтому repr/JSON
+    строится уже в потоке QueueListener."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if getattr(record, "channel", None) is not None and not record.exc_info:
+            return record
+        return super().prepare(record)
+
+
+class LogSampler:
+    """Прореживание событий по каналам: доля (sample) и лимит в секунду (rate_limit)."""
+
+    def __init__(self, sample: dict, rate_limit: dict):
+        self.sample = sample
+        self.rate_limit = rate_limit
+        self._lock = threading.Lock()
+        self._windows: dict = {}  # канал -> [секунда, событий в ней]
+        self.dropped: dict = {}
+
+    def allow(self, channel: str) -> bool:
+        rate = self.sample.get(channel, 1.0)
+        limit = self.rate_limit.get(channel)
+        if rate >= 1.0 and limit is None:
+            return True
+        allowed = rate >= 1.0 or random.random() < rate
+        if allowed and limit is not None:
+            second = int(time.monotonic())
+            with self._lock:
+                window = self._windows.setdefault(channel, [second, 0])
+                if window[0] != second:
+                    window[0], window[1] = second, 0
+                window[1] += 1
+                allowed = window[1] <= limit
+        if not allowed:
+            with self._lock:
+                self.dropped[channel] = self.dropped.get(channel, 0) + 1
+        return allowed
+
+
+def _setup_logging() -> Optional[logging.handlers.QueueListener]:
+    formatter = (
+        JsonLinesFormatter() if LOG_FORMAT == "json"
+        else logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+    )
+    handlers = [logging.FileHandler(LOG_FILE), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    if not LOG_ASYNC:
+        logging.basicConfig(level=logging.INFO, handlers=handlers)
+        return None
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _DeferredQueueHandler(log_queue)
+    # В очередь уходит только текст сообщения; время и уровень добавит formatter слушателя
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # дописать очередь при завершении процесса
+    return listener
+
+
+log_listener = _setup_logging()
+startup_report.mark("logging")
+log_sampler = LogSampler(
+    _parse_log_channels(os.getenv("LEADS_LOG_SAMPLE", "")),
+    _parse_log_channels(os.getenv("LEADS_LOG_RATE_LIMIT", "")),
+)
+
+
+def log_event(channel: str, message: str, data=None, level: int = logging.INFO) -> None:
+    """Событие горячего эндпоинта: проходит прореживание канала, data пишется структурно
+    (в текстовом формате — как "message: data")."""
+    if not log_sampler.allow(channel):
+        return
+    if data is None:
+        logging.log(level, "%s", message, extra={"channel": channel, "event": message, "data": None})
+    else:
+        logging.log(level, "%s: %s", message, data, extra={"channel": channel, "event": message, "data": data})
+
+# === JSON ===
+# Если установлен orjson, сериализация и разбор JSON идут через него (в разы быстрее stdlib),
+# иначе — stdlib json; формат данных одинаковый. Файлы хранилищ пишутся компактно, без отступов;
+# LEADS_JSON_INDENT=2 — с отступами, как раньше (orjson поддерживает только отступ 2).
+try:
+    import orjson
+except ImportError:  # orjson — опционально
+    orjson = None
+
+JSON_INDENT = int(os.getenv("LEADS_JSON_INDENT", "0")) or None
+
+
+def json_dumps_bytes(obj, indent: Optional[int] = None) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0))
+        except TypeError:
+            pass  # то, что orjson не умеет (например, int больше 64 бит), сериализует stdlib
+    return json.dumps(obj, indent=indent, ensure_ascii=False).encode("utf-8")
+
+
+def json_dumps(obj, indent: Optional[int] = None) -> str:
+    if orjson is None:
+        return json.dumps(obj, indent=indent, ensure_ascii=False)
+    return json_dumps_bytes(obj, indent).decode("utf-8")
+
+
+def json_loads(data):
+    """Разбор str/bytes. Ошибка — json.JSONDecodeError (orjson.JSONDecodeError — её подкласс)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# === Межпроцессные блокировки ===
+# Хранилища пишутся из нескольких воркеров uvicorn (uvicorn main:app --workers N), поэтому
+# каждое чтение-изменение-запись файла идёт под flock, а сам файл заменяется атомарно
+# (запись во временный файл + os.replace) — читатель без блокировки видит либо старую,
+# либо новую версию целиком. Блокировка берётся на соседний файл <имя>.lock, который
+# никогда не удаляется и не заменяется (иначе процессы держали бы блокировки разных inode).
+# flock привязан к открытому файлу, поэтому блокировка исключает и потоки одного процесса;
+# повторно брать ту же блокировку во вложенном вызове нельзя — это самоблокировка.
+def get_lock_file(path: Path) -> Path:
+    return path.with_name(path.name + ".lock")
+
+
+@contextmanager
+def file_lock(path: Path, shared: bool = False):
+    """Блокировка path между процессами и потоками (shared=True — для чтения)."""
+    with open(get_lock_file(path), "ab") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# === Метрики ===
+# Счётчики и гистограммы в памяти процесса, отдаются в /metrics в текстовом формате Prometheus.
+# Запись метрики — несколько операций со словарём под общей блокировкой, поэтому сбор включён
+# всегда. Значения — на процесс: при нескольких воркерах uvicorn каждый считает своё (метка pid).
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: dict = {}        # имя -> (тип, описание)
+        self._counters: dict = {}    # (имя, метки) -> значение
+        self._histograms: dict = {}  # (имя, метки) -> [счётчики корзин..., сумма, количество]
+        self._collectors: list = []
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, labels: tuple, value: float = 1) -> None:
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        key = (name, labels)
+        index = bisect.bisect_left(self.BUCKETS, value)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0, 0]
+            hist[index] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def add_bytes(self, op: str, direction: str, n: int) -> None:
+        self.inc("leads_storage_bytes_total", (("op", op), ("direction", direction)), n)
+
+    def timed(self, op: str):
+        """Декоратор: время выполнения функции хранилища -> leads_storage_seconds{op}."""
+        labels = (("op", op),)
+
+        def decorator(fn):
+            if asyncio.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return await fn(*args, **kwargs)
+                    finally:
+                        self.observe("leads_storage_seconds", labels, time.perf_counter() - started)
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe("leads_storage_seconds", labels, time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def collector(self, fn):
+        """Регистрирует функцию, которая при чтении /metrics возвращает
+        [(имя, тип, описание, [(метки, значение), ...]), ...]."""
+        self._collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        escaped = (f'{k}="{_escape_label_value(v)}"' for k, v in pairs)
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self) -> str:
+        families: dict = {}
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [(key, list(hist)) for key, hist in self._histograms.items()]
+        for (name, labels), value in counters:
+            families.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), hist in histograms:
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + (float("inf"),), hist):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist[-1]}")
+        for collect in self._collectors:
+            try:
+                for name, kind, help_text, samples in collect():
+                    self._meta.setdefault(name, (kind, help_text))
+                    lines = families.setdefault(name, [])
+                    lines.extend(f"{name}{self._labels(labels)} {value}" for labels, value in samples)
+            except Exception as e:
+                logging.warning(f"Ошибка сбора метрик {getattr(collect, '__name__', collect)}: {e}")
+
+        out = []
+        for name in sorted(families):
+            kind, help_text = self._meta.get(name, ("untyped", ""))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(families[name])
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("leads_http_requests_total", "counter", "HTTP requests by route and status")
+metrics.describe("leads_http_request_duration_seconds", "histogram", "HTTP request latency by route")
+metrics.describe("leads_storage_seconds", "histogram", "Time spent in storage functions")
+metrics.describe("leads_storage_bytes_total", "counter", "Bytes read/written by storage functions")
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: число запросов и гистограмма задержки по шаблону маршрута."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            route = getattr(scope.get("route"), "path", None)
+            # Шаблон маршрута (/partners/{partner}/days), а не путь — иначе метки не ограничены
+            route = scope.get("root_path", "") + route if route else "unmatched"
+            method = scope["method"]
+            metrics.observe("leads_http_request_duration_seconds", (("method", method), ("route", route)), elapsed)
+            metrics.inc("leads_http_requests_total", (("method", method), ("route", route), ("status", str(status[0]))))
+
+
+# === Колоночный формат (.col) для закрытых файлов ===
+# Закрытые файлы (traffic_bh прошедших дней, stat_lt_income прошедших недель) больше не
+# дописываются, поэтому их можно переложить по колонкам (columnar_compact.py):
+#   dict — строки и прочие значения: словарь уникальных значений + коды (1/2/4 байта);
+#   ts   — ISO-время: микросекунды от эпохи (разности соседних) + смещение пояса в минутах;
+#   num  — числа в строках ("150.5"): float64, обратно форматируются в ту же строку;
+#   int  — целые: int64.
+# Каждый блок сжат zlib отдельно, поэтому чтение одной колонки (проекция) не трогает остальные.
+# Тип колонки берётся из COLUMNAR_SCHEMAS; если хоть одно значение не переводится в него
+# без потерь (другой формат даты, "1e5" в сумме), колонка сохраняется как dict.
+# Файл: COLUMNAR_MAGIC, блоки, сжатый JSON-оглавление, длина оглавления (8 байт), COLUMNAR_MAGIC.
+COLUMNAR_MAGIC = b"LBCOL1\n"
+COLUMNAR_SCHEMAS = {
+    "traffic_bh": {"timestamp": "ts"},
+    "stat_lt_income": {"date": "ts", "sum": "num"},
+}
+_COLUMNAR_EPOCH = datetime.datetime(1970, 1, 1)
+_COLUMNAR_EPOCH_UTC = _COLUMNAR_EPOCH.replace(tzinfo=datetime.timezone.utc)
+_COLUMNAR_NAIVE = -32768  # смещение пояса у времени без пояса
+_MISSING = object()       # поля нет в записи (отличается от null)
+
+
+def get_columnar_file(source: Path) -> Path:
+    """Колоночная копия закрытого файла: traffic_bh_2026-10-16.jsonl -> traffic_bh_2026-10-16.col."""
+    return source.with_suffix(".col")
+
+
+@functools.lru_cache(maxsize=None)
+def _columnar_tz(minutes: int) -> datetime.timezone:
+    return datetime.timezone(datetime.timedelta(minutes=minutes))
+
+
+def _encode_ts(value: str) -> tuple:
+    moment = datetime.datetime.fromisoformat(value)
+    offset = moment.utcoffset()
+    if offset is None:
+        return (moment - _COLUMNAR_EPOCH) // datetime.timedelta(microseconds=1), _COLUMNAR_NAIVE
+    return (moment - _COLUMNAR_EPOCH_UTC) // datetime.timedelta(microseconds=1), int(offset.total_seconds() // 60)
+
+
+def _decode_ts(micros: int, tz: int, sep: str) -> str:
+    if tz == _COLUMNAR_NAIVE:
+        return (_COLUMNAR_EPOCH + datetime.timedelta(microseconds=micros)).isoformat(sep)
+    moment = _COLUMNAR_EPOCH_UTC + datetime.timedelta(microseconds=micros)
+    return moment.astimezone(_columnar_tz(tz)).isoformat(sep)
+
+
+def _format_num(value: float) -> str:
+    text = repr(value)
+    return text[:-2] if text.endswith(".0") else text
+
+
+def _codes_typecode(size: int) -> str:
+    return "B" if size <= 0xFF else "H" if size <= 0xFFFF else "I"
+
+
+def _encode_column(name: str, values: list, hint: Optional[str]) -> tuple:
+    """Описание колонки и её блоки (несжатые байты) в порядке записи."""
+    present = _MISSING not in values
+    if hint == "ts" and present and values and all(type(v) is str for v in values):
+        sep = values[0][10:11] or "T"
+        try:
+            encoded = [_encode_ts(v) for v in values]
+            if all(_decode_ts(m, tz, sep) == v for (m, tz), v in zip(encoded, values)):
+                micros = array("q", (m for m, _ in encoded))
+                for i in range(len(micros) - 1, 0, -1):
+                    micros[i] -= micros[i - 1]  # разности: время в файле почти упорядочено
+                return {"name": name, "type": "ts", "sep": sep}, [micros.tobytes(), array("h", (tz for _, tz in encoded)).tobytes()]
+        except (ValueError, OverflowError):
+            pass
+    if hint == "num" and present and all(type(v) is str for v in values):
+        try:
+            numbers = array("d", (float(v) for v in values))
+            if all(_format_num(x) == v for x, v in zip(numbers, values)):
+                return {"name": name, "type": "num"}, [numbers.tobytes()]
+        except ValueError:
+            pass
+    if present and values and all(type(v) is int for v in values):
+        try:
+            return {"name": name, "type": "int"}, [array("q", values).tobytes()]
+        except OverflowError:
+            pass
+
+    # Код 0 — поля нет; строки и остальные JSON-значения различаются ключом словаря
+    dictionary, index = [None], {}
+    codes = []
+    for value in values:
+        if value is _MISSING:
+            codes.append(0)
+            continue
+        key = value if type(value) is str else ("json", json_dumps(value))
+        code = index.get(key)
+        if code is None:
+            code = index[key] = len(dictionary)
+            dictionary.append(value)
+        codes.append(code)
+    typecode = _codes_typecode(len(dictionary))
+    return {"name": name, "type": "dict", "codes": typecode}, [json_dumps_bytes(dictionary), array(typecode, codes).tobytes()]
+
+
+@metrics.timed("columnar_write")
+def write_columnar(file_path: Path, records: list, kind: str) -> int:
+    """Записывает записи в колоночный файл (атомарно). Возвращает размер файла."""
+    names = list(dict.fromkeys(key for record in records for key in record))
+    schema = COLUMNAR_SCHEMAS.get(kind, {})
+    columns = []
+    tmp_file = file_path.with_name(file_path.name + ".tmp")
+    with open(tmp_file, "wb") as f:
+        f.write(COLUMNAR_MAGIC)
+        for name in names:
+            meta, blocks = _encode_column(name, [record.get(name, _MISSING) for record in records], schema.get(name))
+            meta["blocks"] = []
+            for block in blocks:
+                packed = zlib.compress(block, 6)
+                meta["blocks"].append([f.tell(), len(packed)])
+                f.write(packed)
+            columns.append(meta)
+        footer = zlib.compress(json_dumps_bytes({
+            "version": 1, "kind": kind, "rows": len(records), "byteorder": sys.byteorder, "columns": columns,
+        }))
+        f.write(footer)
+        f.write(len(footer).to_bytes(8, "little") + COLUMNAR_MAGIC)
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+    os.replace(tmp_file, file_path)
+    metrics.add_bytes("columnar_write", "write", size)
+    return size
+
+
+class ColumnarFile:
+    """Чтение колоночного файла с проекцией: читаются и распаковываются только нужные колонки.
+    Распакованные колонки кешируются в объекте; bytes_read — сколько байт прочитано с диска.
+    Файл остаётся открытым, пока жив объект: удаление или подмена .col его не затрагивают."""
+
+    def __init__(self, file_path: Path):
+        self.path = file_path
+        self.bytes_read = 0
+        self._file = f = open(file_path, "rb")
+        f.seek(-8 - len(COLUMNAR_MAGIC), os.SEEK_END)
+        trailer = f.read()
+        if not trailer.endswith(COLUMNAR_MAGIC) or f.tell() < 2 * len(COLUMNAR_MAGIC) + 8:
+            f.close()
+            raise ValueError(f"{file_path.name}: не колоночный файл")
+        footer_size = int.from_bytes(trailer[:8], "little")
+        f.seek(-8 - len(COLUMNAR_MAGIC) - footer_size, os.SEEK_END)
+        footer = json_loads(zlib.decompress(f.read(footer_size)))
+        self.bytes_read += footer_size + len(trailer)
+        self.kind = footer["kind"]
+        self.rows = footer["rows"]
+        self._swap = footer["byteorder"] != sys.byteorder
+        self._columns = {meta["name"]: meta for meta in footer["columns"]}
+        self._cache = {}
+
+    @property
+    def columns(self) -> list:
+        return list(self._columns)
+
+    def column_type(self, name: str) -> str:
+        return self._columns[name]["type"]
+
+    def _blocks(self, name: str) -> list:
+        meta = self._columns[name]
+        blocks = []
+        for offset, length in meta["blocks"]:
+            blocks.append(zlib.decompress(os.pread(self._file.fileno(), length, offset)))
+            self.bytes_read += length
+        metrics.add_bytes("columnar", "read", sum(length for _, length in meta["blocks"]))
+        return blocks
+
+    def _array(self, typecode: str, data: bytes) -> array:
+        values = array(typecode, data)
+        if self._swap:
+            values.byteswap()
+        return values
+
+    def _load(self, name: str) -> tuple:
+        cached = self._cache.get(name)
+        if cached is None:
+            meta = self._columns[name]
+            blocks = self._blocks(name)
+            if meta["type"] == "ts":
+                micros = self._array("q", blocks[0])
+                for i in range(1, len(micros)):
+                    micros[i] += micros[i - 1]
+                cached = (micros, self._array("h", blocks[1]))
+            elif meta["type"] == "num":
+                cached = (self._array("d", blocks[0]),)
+            elif meta["type"] == "int":
+                cached = (self._array("q", blocks[0]),)
+            else:
+                cached = (json_loads(blocks[0]), self._array(meta["codes"], blocks[1]))
+            self._cache[name] = cached
+        return cached
+
+    def _value(self, name: str, row: int):
+        """Значение в исходном виде; _MISSING — поля в записи не было."""
+        meta = self._columns[name]
+        data = self._load(name)
+        if meta["type"] == "ts":
+            return _decode_ts(data[0][row], data[1][row], meta["sep"])
+        if meta["type"] == "num":
+            return _format_num(data[0][row])
+        if meta["type"] == "int":
+            return data[0][row]
+        code = data[1][row]
+        return data[0][code] if code else _MISSING
+
+    def codes(self, name: str) -> tuple:
+        """(словарь, коды) dict-колонки — для фильтров и группировок без декодирования строк.
+        Код 0 — поля нет. Для колонок других типов — ValueError."""
+        if self._columns[name]["type"] != "dict":
+            raise ValueError(f"{name}: колонка не словарная")
+        return self._load(name)
+
+    def numbers(self, name: str) -> array:
+        """Числовая колонка: float64 для num, int64 для int, микросекунды UTC для ts
+        (для времени без пояса — микросекунды «как в UTC»)."""
+        if self._columns[name]["type"] == "dict":
+            raise ValueError(f"{name}: колонка не числовая")
+        return self._load(name)[0]
+
+    def column(self, name: str) -> list:
+        """Значения колонки в исходном виде (None, если поля в записи не было)."""
+        meta = self._columns[name]
+        data = self._load(name)
+        if meta["type"] == "dict":
+            dictionary, codes = data
+            return [dictionary[code] if code else None for code in codes]
+        if meta["type"] == "int":
+            return data[0].tolist()
+        return [self._value(name, row) for row in range(self.rows)]
+
+    def scan(self, columns: Optional[list] = None, rows=None):
+        """Записи только с полями из columns (по умолчанию — все); rows — номера строк."""
+        names = [name for name in (columns or self.columns) if name in self._columns]
+        for row in (range(self.rows) if rows is None else rows):
+            record = {}
+            for name in names:
+                value = self._value(name, row)
+                if value is not _MISSING:
+                    record[name] = value
+            yield record
+
+
+# === Настройки ===
+load_dotenv()
+S3_ENDPOINT = os.getenv("S3_ENDPOINT")
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
+S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
+
+DATA_DIR = Path(os.getenv("LEADS_DATA_DIR", "/opt/leads_postback/data"))
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+
+STAT_INCOME_DIR = DATA_DIR / "stat_lt_income"
+STAT_INCOME_DIR.mkdir(parents=True, exist_ok=True)
+
+def get_stat_income_file() -> Path:
+    """Возвращает путь к файлу stat_lt_income с еженедельной ротацией.
+    Неделя считается по ISO (понедельник = начало недели).
+    Формат имени: stat_lt_income_YYYY_W<номер_недели>.json
+    """
+    now = datetime.datetime.now()
+    year, week, _ = now.isocalendar()
+    return STAT_INCOME_DIR / f"stat_lt_income_{year}_W{week:02d}.json"
+
+# === Маршрутизация постбэков по sub1 ===
+# Таблица "ключевое слово в sub1 -> файл партнёра" читается из PARTNER_ROUTES_FILE:
+#   [{"file": "krolik.json", "keywords": ["krolik", "banknota"]}, ...]
+# Порядок правил = приоритет (первое подходящее правило выигрывает, как в прежней цепочке elif).
+# Файл перечитывается на лету при изменении (проверка mtime не чаще PARTNER_ROUTES_RELOAD_INTERVAL).
+PARTNER_ROUTES_FILE = Path(os.getenv("PARTNER_ROUTES_FILE", str(Path(__file__).with_name("partner_routes.json"))))
+PARTNER_ROUTES_RELOAD_INTERVAL = float(os.getenv("PARTNER_ROUTES_RELOAD_INTERVAL", "5"))
+
+# Используется, если файла конфигурации нет
+_DEFAULT_PARTNER_ROUTES = [
+    {"file": "krolik.json", "keywords": ["krolik", "banknota"]},
+    {"file": "karakoz_karas.json", "keywords": ["karakoz", "karas"]},
+    {"file": "1russ.json", "keywords": ["1russ", "darya", "vadimtop", "clickchirik"]},
+    {"file": "vydavayka.json", "keywords": ["vydavayka"]},
+    {"file": "insta.json", "keywords": ["insta", "kud"]},
+    {"file": "utkavalutkarf.json", "keywords": ["utkavalutkarf"]},
+    {"file": "monzi.json", "keywords": ["monzi"]},
+    {"file": "lisicka.json", "keywords": ["lisicka"]},
+    {"file": "ptichka.json", "keywords": ["ptichka"]},
+    {"file": "kupr.json", "keywords": ["kupr"]},
+    {"file": "nalickinrf.json", "keywords": ["nalickinrf"]},
+    {"file": "zarplatkinrf.json", "keywords": ["zarplatkinrf"]},
+    {"file": "zaymdozp.json", "keywords": ["zaymdozp"]},
+    {"file": "pchelkazaim.json", "keywords": ["pchelkazaim"]},
+    {"file": "orel.json", "keywords": ["orel"]},
+]
+
+
+class KeywordMatcher:
+    """Автомат Ахо–Корасик по ключевым словам всех правил.
+
+    Один проход по строке находит все вхождения; возвращается правило с наименьшим
+    номером (наивысшим приоритетом) — тот же результат, что у цепочки `elif kw in s`.
+    """
+
+    def __init__(self, rules: list):
+        self.targets: list = []
+        self._goto: list[dict] = [{}]
+        self._best: list[int] = [len(rules)]
+
+        for priority, (keywords, target) in enumerate(rules):
+            self.targets.append(target)
+            for keyword in keywords:
+                keyword = keyword.lower()
+                if not keyword:
+                    continue
+                state = 0
+                for ch in keyword:
+                    nxt = self._goto[state].get(ch)
+                    if nxt is None:
+                        nxt = len(self._goto)
+                        self._goto[state][ch] = nxt
+                        self._goto.append({})
+                        self._best.append(len(rules))
+                    state = nxt
+                self._best[state] = min(self._best[state], priority)
+
+        # Ссылки неудач (BFS); лучший приоритет наследуется по ним,
+        # чтобы вхождение-суффикс не терялось
+        self._fail = [0] * len(self._goto)
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                candidate = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = candidate if candidate != nxt else 0
+                self._best[nxt] = min(self._best[nxt], self._best[self._fail[nxt]])
+                queue.append(nxt)
+
+    def match(self, text: str):
+        goto, fail, best_at = self._goto, self._fail, self._best
+        best = len(self.targets)
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if best_at[state] < best:
+                best = best_at[state]
+                if best == 0:
+                    break
+        return self.targets[best] if best < len(self.targets) else None
+
+
+class PartnerRouter:
+    """Сопоставление sub1 -> файл партнёра с горячей перезагрузкой конфигурации."""
+
+    def __init__(self, config_file: Path, reload_interval: float):
+        self.config_file = config_file
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0.0
+        self.matcher = self._compile(_DEFAULT_PARTNER_ROUTES)
+        self.reload()
+
+    @staticmethod
+    def _compile(routes: list) -> KeywordMatcher:
+        rules = []
+        for route in routes:
+            keywords = route["keywords"]
+            if not isinstance(keywords, list) or not route["file"]:
+                raise ValueError(f"некорректное правило: {route}")
+            rules.append((keywords, DATA_DIR / Path(route["file"]).name))
+        return KeywordMatcher(rules)
+
+    def reload(self) -> None:
+        """Перечитывает конфигурацию, если файл изменился. При ошибке остаётся прежняя таблица."""
+        try:
+            mtime = self.config_file.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+
+        if mtime is None:
+            logging.warning(f"{self.config_file} не найден, используется встроенная таблица партнёров")
+            self.matcher = self._compile(_DEFAULT_PARTNER_ROUTES)
+            return
+        try:
+            with open(self.config_file, "r", encoding="utf-8") as f:
+                self.matcher = self._compile(json.load(f))
+            logging.info(f"Таблица партнёров загружена из {self.config_file}: {len(self.matcher.targets)} правил")
+        except Exception as e:
+            logging.exception(f"Ошибка в {self.config_file}, оставлена прежняя таблица: {e}")
+
+    def route(self, sub1: str) -> Optional[Path]:
+        now = time.monotonic()
+        if now - self._checked_at >= self.reload_interval:
+            with self._lock:
+                if now - self._checked_at >= self.reload_interval:
+                    self._checked_at = now
+                    self.reload()
+        return self.matcher.match(sub1.lower())
+
+
+# === Запуск и остановка ===
+# Обработчики регистрируются декораторами on_startup/on_shutdown рядом со своими компонентами
+# и вызываются из lifespan приложения в порядке регистрации (вместо устаревшего app.on_event).
+_startup_hooks: list = []
+_shutdown_hooks: list = []
+
+
+def on_startup(func):
+    _startup_hooks.append(func)
+    return func
+
+
+def on_shutdown(func):
+    _shutdown_hooks.append(func)
+    return func
+
+
+async def _run_hook(func) -> None:
+    result = func()
+    if asyncio.iscoroutine(result):
+        await result
+
+
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    for func in _startup_hooks:
+        await _run_hook(func)
+    try:
+        yield
+    finally:
+        for func in _shutdown_hooks:
+            await _run_hook(func)
+
+
+app = FastAPI(lifespan=_lifespan)
+app.add_middleware(MetricsMiddleware)
+
+partner_router = PartnerRouter(PARTNER_ROUTES_FILE, PARTNER_ROUTES_RELOAD_INTERVAL)
+
+startup_report.mark("routing")
+
+# === S3 ===
+# Обработчикам клиент не нужен, а импорт boto3 и создание клиента — треть времени запуска,
+# поэтому он создаётся при первом обращении (get_s3_client() или прежнее main.s3).
+@functools.lru_cache(maxsize=None)
+def get_s3_client():
+    import boto3
+    return boto3.client(
+        "s3",
+        endpoint_url=S3_ENDPOINT,
+        aws_access_key_id=S3_ACCESS_KEY,
+        aws_secret_access_key=S3_SECRET_KEY,
+    )
+
+
+def __getattr__(name: str):
+    if name == "s3":
+        return get_s3_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_sub6_filename(day: datetime.date) -> Path:
+    return DATA_DIR / f"leads_sub6_{day:%d.%m.%Y}.txt"
+
+def get_today_filename() -> Path:
+    return get_sub6_filename(datetime.date.today())
+
+# === Суммы по партнёрам (write-behind, партиции по дням) ===
+# Постбэк только добавляет сумму в память; на диск изменения сбрасываются фоновым потоком
+# раз в PARTNER_FLUSH_INTERVAL секунд, при накоплении PARTNER_FLUSH_THRESHOLD обновлений
+# и при остановке приложения. Окно потери данных при аварийном падении процесса —
+# не больше одного интервала.
+#
+# Хранение: PARTNERS_DIR/<партнёр>/
+#   day_YYYY-MM-DD.json — «горячий» день: {"day": "DD.MM.YYYY", "data": {sub5: sum}}
+#   month_YYYY-MM.json  — запечатанные дни месяца (компактный JSON-массив блоков дня)
+# Прошедшие дни при сбросе переезжают из day_* в month_*, поэтому запись и чтение
+# сегодняшнего дня не зависят от объёма истории.
+# Прежний общий файл (krolik.json и т.п.) пересобирается из партиций не чаще, чем раз
+# в PARTNER_LEGACY_EXPORT_INTERVAL секунд (0 — не собирать).
+PARTNER_FLUSH_INTERVAL = float(os.getenv("PARTNER_FLUSH_INTERVAL", "1.0"))
+PARTNER_FLUSH_THRESHOLD = int(os.getenv("PARTNER_FLUSH_THRESHOLD", "1000"))
+PARTNER_LEGACY_EXPORT_INTERVAL = float(os.getenv("PARTNER_LEGACY_EXPORT_INTERVAL", "60"))
+
+PARTNERS_DIR = DATA_DIR / "partners"
+PARTNERS_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def _parse_day(day: str) -> datetime.date:
+    return datetime.datetime.strptime(day, "%d.%m.%Y").date()
+
+
+def _fsync_dir(directory: Path) -> None:
+    """fsync каталога: без него os.replace может не пережить сбой питания
+    (на диске останется старая запись каталога)."""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_json_atomic(file_path: Path, data, indent: Optional[int] = JSON_INDENT) -> None:
+    """Атомарная запись: содержимое tmp — на диске до rename, сам rename — после fsync каталога."""
+    tmp_file = file_path.with_name(file_path.name + ".tmp")
+    payload = json_dumps_bytes(data, indent)
+    with open(tmp_file, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    metrics.add_bytes("json_atomic", "write", len(payload))
+    os.replace(tmp_file, file_path)
+    _fsync_dir(file_path.parent)
+
+
+def _merge_sums(target: dict, sums: dict) -> None:
+    for sub5, value in sums.items():
+        try:
+            old_sum = float(target.get(sub5, 0))
+        except ValueError:
+            old_sum = 0
+        target[sub5] = round(old_sum + float(value), 2)
+
+
+class PartnerDayStore:
+    """Партиционированное по дням хранилище сумм одного партнёра.
+    Партнёр определяется по имени прежнего файла: DATA_DIR/krolik.json -> PARTNERS_DIR/krolik.
+    Изменения файлов партнёра (сброс, запечатывание, сборка прежнего файла) — под lock().
+    """
+
+    def __init__(self, legacy_file: Path):
+        self.legacy_file = legacy_file
+        self.name = legacy_file.stem
+        self.dir = PARTNERS_DIR / self.name
+
+    def day_file(self, day: datetime.date) -> Path:
+        return self.dir / f"day_{day:%Y-%m-%d}.json"
+
+    def month_file(self, day: datetime.date) -> Path:
+        return self.dir / f"month_{day:%Y-%m}.json"
+
+    def lock(self, shared: bool = False):
+        """Блокировка всех файлов партнёра между воркерами (PARTNERS_DIR/<партнёр>.lock)."""
+        return file_lock(self.dir, shared)
+
+    def ensure(self) -> None:
+        """Создаёт каталог партнёра; при первом запуске переносит данные из прежнего файла."""
+        if self.dir.exists():
+            return
+        with self.lock():
+            if not self.dir.exists():  # пока ждали блокировку, мог перенести другой воркер
+                self._migrate()
+
+    def _migrate(self) -> None:
+        tmp_dir = self.dir.with_name(self.dir.name + ".migrating")
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+
+        blocks = []
+        if self.legacy_file.exists():
+            try:
+                with open(self.legacy_file, "rb") as f:
+                    blocks = json_loads(f.read())
+            except json.JSONDecodeError:
+                logging.warning(f"Файл {self.legacy_file.name} повреждён, пропускаем миграцию.")
+
+        months: dict[str, dict] = {}
+        for block in blocks:
+            day = _parse_day(block["day"])
+            days = months.setdefault(f"{day:%Y-%m}", {})
+            merged = days.setdefault(block["day"], {"day": block["day"], "data": {}})
+            _merge_sums(merged["data"], block.get("data", {}))
+        for month, days in months.items():
+            ordered = sorted(days.values(), key=lambda b: _parse_day(b["day"]))
+            _write_json_atomic(tmp_dir / f"month_{month}.json", ordered, indent=None)
+
+        os.replace(tmp_dir, self.dir)
+        if blocks:
+            logging.info(f"[partners/{self.name}] Перенесено дней из {self.legacy_file.name}: {len(blocks)}")
+
+    @staticmethod
+    def _read(file_path: Path, default):
+        if not file_path.exists():
+            return default
+        try:
+            with open(file_path, "rb") as f:
+                raw = f.read()
+            metrics.add_bytes("partners", "read", len(raw))
+            return json_loads(raw)
+        except json.JSONDecodeError:
+            logging.warning(f"Файл {file_path} повреждён, пересоздаём.")
+            return default
+
+    def read_day_file(self, day: datetime.date) -> dict:
+        return self._read(self.day_file(day), {"day": f"{day:%d.%m.%Y}", "data": {}})
+
+    def write_day_file(self, day: datetime.date, block: dict) -> None:
+        _write_json_atomic(self.day_file(day), block)
+
+    def read_month(self, day: datetime.date) -> list:
+        return self._read(self.month_file(day), [])
+
+    def seal(self, today: datetime.date) -> None:
+        """Переносит все дни раньше today из day_*.json в месячные сегменты."""
+        for day_file in sorted(self.dir.glob("day_*.json")):
+            day = datetime.datetime.strptime(day_file.stem[4:], "%Y-%m-%d").date()
+            if day >= today:
+                continue
+            block = self._read(day_file, None)
+            if block is not None:
+                month = self.read_month(day)
+                target = next((b for b in month if b["day"] == block["day"]), None)
+                if target is None:
+                    month.append(block)
+                    month.sort(key=lambda b: _parse_day(b["day"]))
+                else:
+                    # День уже запечатан, а запоздалые суммы записались в новый day_* — доливаем
+                    _merge_sums(target["data"], block["data"])
+                _write_json_atomic(self.month_file(day), month, indent=None)
+            day_file.unlink()
+            logging.info(f"[partners/{self.name}] День {day:%d.%m.%Y} запечатан")
+
+    def read_range(self, date_from: datetime.date, date_to: datetime.date) -> list:
+        """Блоки дней за [date_from, date_to] в прежнем формате; читаются только нужные партиции."""
+        result: dict[datetime.date, dict] = {}
+        month_start = date_from.replace(day=1)
+        while month_start <= date_to:
+            for block in self.read_month(month_start):
+                day = _parse_day(block["day"])
+                if date_from <= day <= date_to:
+                    result[day] = {"day": block["day"], "data": dict(block["data"])}
+            month_start = (month_start + datetime.timedelta(days=32)).replace(day=1)
+
+        for day_file in self.dir.glob("day_*.json"):
+            day = datetime.datetime.strptime(day_file.stem[4:], "%Y-%m-%d").date()
+            if date_from <= day <= date_to:
+                block = self._read(day_file, None)
+                if block is None:
+                    continue
+                target = result.setdefault(day, {"day": block["day"], "data": {}})
+                _merge_sums(target["data"], block["data"])
+
+        return [result[day] for day in sorted(result)]
+
+    def export_legacy(self) -> None:
+        """Пересобирает прежний общий файл партнёра из всех партиций."""
+        blocks = []
+        for month_file in sorted(self.dir.glob("month_*.json")):
+            blocks.extend(self._read(month_file, []))
+        by_day = {b["day"]: b for b in blocks}
+        for day_file in sorted(self.dir.glob("day_*.json")):
+            block = self._read(day_file, None)
+            if block is None:
+                continue
+            if block["day"] in by_day:
+                _merge_sums(by_day[block["day"]]["data"], block["data"])
+            else:
+                by_day[block["day"]] = block
+                blocks.append(block)
+        _write_json_atomic(self.legacy_file, blocks)
+
+
+class DailySumAggregator:
+    """Держит в памяти суммы sub5 по дням для каждого партнёра.
+
+    Хранятся несброшенные приращения (pending) и копия горячего дня. Сброс идёт под
+    блокировкой партнёра; копия переиспользуется, если day-файл на диске не менялся с нашей
+    последней записи (сверка по inode/mtime/size), иначе файл перечитывается — поэтому
+    приращения не теряются, даже если файл переписал другой воркер.
+    """
+
+    def __init__(self, interval: float, threshold: int, legacy_export_interval: float = 0):
+        self.interval = interval
+        self.threshold = threshold
+        self.legacy_export_interval = legacy_export_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # file_path -> day -> sub5 -> приращение
+        self._pending: dict[Path, dict[str, dict[str, float]]] = {}
+        self._pending_count = 0
+        # day-файл -> (подпись файла, блок дня)
+        self._cache: dict[Path, tuple] = {}
+        self._stores: dict[Path, PartnerDayStore] = {}
+        self._stores_lock = threading.Lock()
+        self._sealed_on: dict[Path, datetime.date] = {}
+        self._legacy_dirty: set[Path] = set()
+        self._legacy_exported_at = 0.0
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def store(self, file_path: Path) -> PartnerDayStore:
+        with self._stores_lock:
+            store = self._stores.get(file_path)
+            if store is None:
+                store = PartnerDayStore(file_path)
+                store.ensure()
+                self._stores[file_path] = store
+            return store
+
+    def add(self, file_path: Path, day: str, sub5: str, value: float) -> None:
+        with self._lock:
+            days = self._pending.setdefault(file_path, {})
+            sums = days.setdefault(day, {})
+            sums[sub5] = sums.get(sub5, 0.0) + value
+            self._pending_count += 1
+            if self._pending_count >= self.threshold:
+                self._wakeup.set()
+
+    def pending_for(self, file_path: Path) -> dict:
+        with self._lock:
+            return {day: dict(sums) for day, sums in self._pending.get(file_path, {}).items()}
+
+    @staticmethod
+    def _signature(file_path: Path):
+        try:
+            st = file_path.stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    @metrics.timed("partner_flush")
+    def _flush_file(self, file_path: Path, days: dict) -> None:
+        store = self.store(file_path)
+        with store.lock():
+            self._flush_locked(store, file_path, days)
+
+    def _flush_locked(self, store: PartnerDayStore, file_path: Path, days: dict) -> None:
+        today = datetime.date.today()
+
+        for day_str, sums in days.items():
+            day = _parse_day(day_str)
+            day_file = store.day_file(day)
+            cached = self._cache.get(day_file)
+            if cached and cached[0] == self._signature(day_file):
+                block = cached[1]
+            else:
+                block = store.read_day_file(day)
+            _merge_sums(block["data"], sums)
+            store.write_day_file(day, block)
+            if day == today:
+                self._cache[day_file] = (self._signature(day_file), block)
+            else:
+                self._cache.pop(day_file, None)
+
+        if self._sealed_on.get(file_path) != today:
+            store.seal(today)
+            self._sealed_on[file_path] = today
+            for day_file in [p for p in self._cache if not p.exists()]:
+                del self._cache[day_file]
+
+        self._legacy_dirty.add(file_path)
+        logging.info(f"[partners/{store.name}] Сброшено обновлений sub5: {sum(len(v) for v in days.values())}")
+
+    def export_legacy(self, force: bool = False) -> None:
+        """Пересобирает прежние общие файлы партнёров, изменившихся с прошлой сборки."""
+        if not force and (
+            self.legacy_export_interval <= 0
+            or time.monotonic() - self._legacy_exported_at < self.legacy_export_interval
+        ):
+            return
+        self._legacy_exported_at = time.monotonic()
+        dirty, self._legacy_dirty = self._legacy_dirty, set()
+        for file_path in dirty:
+            try:
+                store = self.store(file_path)
+                with store.lock():
+                    store.export_legacy()
+            except Exception as e:
+                logging.exception(f"Не удалось собрать {file_path.name}: {e}")
+
+    def flush(self, export_legacy: bool = False) -> None:
+        """Сбрасывает накопленные приращения на диск (атомарно: tmp + rename)."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._pending_count = 0
+
+            for file_path, days in pending.items():
+                try:
+                    self._flush_file(file_path, days)
+                except Exception as e:
+                    logging.exception(f"Не удалось сохранить {file_path.name}: {e}")
+                    # Возвращаем приращения обратно, чтобы не потерять их до следующей попытки
+                    for day, sums in days.items():
+                        for sub5, value in sums.items():
+                            self.add(file_path, day, sub5, value)
+
+            self.export_legacy(force=export_legacy and self.legacy_export_interval > 0)
+
+    @metrics.timed("partner_read_range")
+    def read_range(self, file_path: Path, date_from: datetime.date, date_to: datetime.date) -> list:
+        """Суммы партнёра за период с учётом ещё не сброшенных приращений этого процесса
+        (приращения других воркеров видны после их сброса)."""
+        store = self.store(file_path)
+        with store.lock(shared=True):  # не попасть между чтением дня и его запечатыванием
+            partitions = store.read_range(date_from, date_to)
+        blocks = {_parse_day(b["day"]): b for b in partitions}
+        for day_str, sums in self.pending_for(file_path).items():
+            day = _parse_day(day_str)
+            if date_from <= day <= date_to:
+                block = blocks.setdefault(day, {"day": day_str, "data": {}})
+                _merge_sums(block["data"], sums)
+        return [blocks[day] for day in sorted(blocks)]
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="daily-sum-flush", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush(export_legacy=True)
+
+
+daily_sums = DailySumAggregator(PARTNER_FLUSH_INTERVAL, PARTNER_FLUSH_THRESHOLD, PARTNER_LEGACY_EXPORT_INTERVAL)
+atexit.register(daily_sums.flush, export_legacy=True)
+startup_report.mark("partner_sums")
+
+
+@on_startup
+def _start_daily_sums() -> None:
+    daily_sums.start()
+
+
+@on_shutdown
+def _stop_daily_sums() -> None:
+    daily_sums.stop()
+
+
+@metrics.timed("partner_sum_add")
+def save_daily_sum(file_path: Path, sub5: str, sum_value: str, log: bool = True):
+    """Сохраняет данные в JSON по дням. Если sub5 повторяется — суммирует.
+    Запись на диск отложенная, см. DailySumAggregator.
+    """
+    today = datetime.datetime.now().strftime("%d.%m.%Y")
+
+    # Преобразуем сумму
+    try:
+        sum_float = float(sum_value)
+    except ValueError:
+        logging.warning(f"Некорректное значение sum: {sum_value}")
+        return
+
+    daily_sums.add(file_path, today, sub5, sum_float)
+
+    if log:
+        log_event("postback", f"[{file_path.name}] Добавлено к sub5={sub5}", sum_float)
+
+
+def _parse_query_date(value: str) -> datetime.date:
+    """Дата из query: DD.MM.YYYY (как в файлах партнёров) или YYYY-MM-DD."""
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(value)
+
+
+@app.get("/partners/{partner}/days")
+async def get_partner_days(
+    partner: str,
+    day: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+):
+    """
+    Суммы sub5 партнёра за день или период (в формате прежнего файла партнёра).
+    - day: один день; иначе date_from/date_to (по умолчанию — сегодня).
+    Даты: DD.MM.YYYY или YYYY-MM-DD.
+    """
+    safe_name = "".join(c for c in partner if c.isalnum() or c in ("_", "-"))
+    file_path = DATA_DIR / f"{safe_name}.json"
+    if not safe_name or not ((PARTNERS_DIR / safe_name).exists() or file_path.exists()):
+        return JSONResponse({"status": "error", "message": "partner not found"}, status_code=404)
+
+    try:
+        today = datetime.date.today()
+        if day:
+            start = end = _parse_query_date(day)
+        else:
+            start = _parse_query_date(date_from) if date_from else today
+            end = _parse_query_date(date_to) if date_to else max(start, today)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": f"bad date: {e}"}, status_code=400)
+
+    if start > end:
+        return JSONResponse({"status": "error", "message": "date_from is after date_to"}, status_code=400)
+
+    days = await asyncio.to_thread(daily_sums.read_range, file_path, start, end)
+    return {"status": "ok", "partner": safe_name, "days": days}
+
+
+def get_stat_income_journal(stat_file: Path) -> Path:
+    """Журнал (jsonl) для недельного файла stat_lt_income.
+    Текущая неделя пишется только в журнал — одна строка на постбэк, O(1).
+    Недельный JSON-массив собирается из журнала при ротации (compact_stat_income).
+    Дописывание и свёртка — под исключительной file_lock(stat_file), чтение журнала —
+    под разделяемой: запись, дописанная другим воркером во время свёртки, не теряется.
+    """
+    return stat_file.with_suffix(".jsonl")
+
+
+_stat_income_lock = threading.Lock()
+_stat_income_current: Optional[Path] = None
+
+
+def _read_stat_income_json(stat_file: Path, fields: Optional[list] = None) -> list:
+    """Записи закрытой части недели: из колоночной копии, если неделя уже переложена
+    (columnar_compact.py), иначе из JSON-массива. fields — оставить только эти поля."""
+    return _snapshot_stat_income_json(stat_file)(fields)
+
+
+def _snapshot_stat_income_json(stat_file: Path):
+    """Фиксирует закрытую часть недели и возвращает функцию fields -> записи.
+    Вызывается под блокировкой недели; саму функцию можно звать уже без неё:
+    открытый файл не подменит свёртка (os.replace), а .col после записи не меняется."""
+    columnar_file = get_columnar_file(stat_file)
+    if columnar_file.exists():
+        columnar = ColumnarFile(columnar_file)
+        return lambda fields=None: list(columnar.scan(fields))
+    try:
+        f = open(stat_file, "rb")
+    except FileNotFoundError:
+        return lambda fields=None: []
+
+    def read(fields: Optional[list] = None) -> list:
+        with f:
+            raw = f.read()
+        metrics.add_bytes("stat_income", "read", len(raw))
+        try:
+            data = json_loads(raw)
+        except json.JSONDecodeError:
+            logging.warning(f"Файл {stat_file.name} повреждён, пропускаем его содержимое.")
+            return []
+        if not isinstance(data, list):
+            return []
+        if fields:
+            data = [{key: record[key] for key in fields if key in record} for record in data]
+        return data
+    return read
+
+
+def _read_stat_income_journal(journal: Path) -> list:
+    records = []
+    if not journal.exists():
+        return records
+    with open(journal, "r", encoding="utf-8") as f:
+        metrics.add_bytes("stat_income", "read", os.fstat(f.fileno()).st_size)
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json_loads(line))
+            except json.JSONDecodeError:
+                # Оборванная последняя строка (например, после падения процесса)
+                logging.warning(f"[{journal.name}] Пропущена повреждённая строка журнала")
+    return records
+
+
+@metrics.timed("stat_income_compact")
+def compact_stat_income(stat_file: Path) -> int:
+    """Сворачивает журнал недели в привычный JSON-массив stat_lt_income_YYYY_Wnn.json.
+    Записи из уже существующего JSON (до перехода на журнал) сохраняются первыми.
+    Возвращает количество записей в итоговом файле.
+    """
+    with file_lock(stat_file):
+        return _compact_stat_income_locked(stat_file)
+
+
+def _compact_stat_income_locked(stat_file: Path) -> int:
+    journal = get_stat_income_journal(stat_file)
+    if not journal.exists():
+        return 0  # уже свернул другой воркер
+
+    data = _read_stat_income_json(stat_file) + _read_stat_income_journal(journal)
+
+    tmp_file = stat_file.with_name(stat_file.name + ".tmp")
+    payload = json_dumps_bytes(data, JSON_INDENT)
+    with open(tmp_file, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    metrics.add_bytes("stat_income_compact", "write", len(payload))
+    os.replace(tmp_file, stat_file)
+    _fsync_dir(stat_file.parent)  # журнал удаляется только после того, как итоговый файл на диске
+    journal.unlink()
+    # Запоздавшие записи недели, уже переложенной в .col: теперь полный набор — в JSON,
+    # устаревшую колоночную копию убираем (читатели предпочитают .col); её пересоздаст columnar_compact.py
+    columnar_file = get_columnar_file(stat_file)
+    if columnar_file.exists():
+        columnar_file.unlink()
+        logging.warning(f"[{stat_file.name}] Колоночная копия устарела и удалена")
+
+    logging.info(f"[{stat_file.name}] Журнал свёрнут, записей: {len(data)}")
+    return len(data)
+
+
+def compact_sealed_stat_income() -> None:
+    """Сворачивает журналы всех завершённых недель (всё, кроме текущей)."""
+    current = get_stat_income_journal(get_stat_income_file())
+    for journal in sorted(STAT_INCOME_DIR.glob("stat_lt_income_*.jsonl")):
+        if journal == current:
+            continue
+        try:
+            compact_stat_income(journal.with_suffix(".json"))
+        except Exception as e:
+            logging.exception(f"Не удалось свернуть журнал {journal.name}: {e}")
+
+
+def make_stat_income_record(sub1_name: str, sub5: str, date_str: str, sum_value: str, sub6: str, sub2: str = "", status: str = "",
+                            duplicate: bool = False) -> dict:
+    """Запись stat_lt_income. Поля: sub1, sub2, sub5, sub6, sum, status, date;
+    у повтора постбэка — ещё "duplicate": true."""
+    record = {
+        "sub1": sub1_name,
+        "sub2": sub2,
+        "sub5": sub5,
+        "sub6": sub6,
+        "sum": sum_value,
+        "status": status,
+        "date": date_str or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+    if duplicate:
+        record["duplicate"] = True
+    return record
+
+
+@metrics.timed("stat_income_append")
+def save_stat_income_records(records: list) -> Path:
+    """Дописывает записи в журнал текущей недели одной записью в файл."""
+    global _stat_income_current
+
+    stat_file = get_stat_income_file()
+    data = b"".join(json_dumps_bytes(record) + b"\n" for record in records)
+
+    with _stat_income_lock:
+        if _stat_income_current != stat_file:
+            # Началась новая неделя (или первый вызов после старта) —
+            # сворачиваем прошлые журналы в фоне, не задерживая постбэк
+            _stat_income_current = stat_file
+            threading.Thread(target=compact_sealed_stat_income, daemon=True).start()
+
+        with file_lock(stat_file), open(get_stat_income_journal(stat_file), "ab") as f:
+            f.write(data)
+    metrics.add_bytes("stat_income", "write", len(data))
+
+    return stat_file
+
+
+def save_stat_income(sub1_name: str, sub5: str, date_str: str, sum_value: str, sub6: str, sub2: str = "", status: str = "",
+                     duplicate: bool = False):
+    """Сохраняет все постбэки в stat_lt_income (еженедельный журнал в отдельной директории).
+    Поля — см. make_stat_income_record.
+    """
+    record = make_stat_income_record(sub1_name, sub5, date_str, sum_value, sub6, sub2, status, duplicate)
+    stat_file = save_stat_income_records([record])
+    log_event("postback", f"[{stat_file.name}] Добавлена запись", record)
+
+
+def iter_stat_income_json(stat_file: Path, fields: Optional[list] = None):
+    """Отдаёт недельный файл в формате JSON-массива по частям.
+    Для текущей недели склеивает старый JSON (если был) и строки журнала без повторного разбора
+    (строки журнала разбираются, только если нужна проекция fields).
+    """
+    journal = get_stat_income_journal(stat_file)
+    # Оба источника открываются под одной блокировкой (свёртка между ними дала бы повтор
+    # или пропуск записей); дальше читается уже открытый файл, блокировку не держим
+    with file_lock(stat_file, shared=True):
+        legacy = _snapshot_stat_income_json(stat_file)
+        try:
+            journal_file = open(journal, "r", encoding="utf-8")
+        except FileNotFoundError:
+            journal_file = None
+
+    yield "["
+    first = True
+    for record in legacy(fields):
+        yield ("" if first else ",") + json_dumps(record)
+        first = False
+    if journal_file is not None:
+        with journal_file as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if fields:
+                    try:
+                        record = json_loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    line = json_dumps({key: record[key] for key in fields if key in record})
+                yield ("" if first else ",") + line
+                first = False
+    yield "]"
+
+
+@app.get("/stat_lt_income")
+async def get_stat_income(week: Optional[str] = None, fields: Optional[str] = None):
+    """
+    Недельный stat_lt_income в прежнем формате (JSON-массив).
+    week: "YYYY_Wnn", по умолчанию — текущая неделя.
+    fields: "sub1,sum" — только эти поля записей (для переложенных в колоночный формат недель
+    читаются только эти колонки).
+    """
+    if week:
+        safe_week = "".join(c for c in week if c.isalnum() or c == "_")
+        stat_file = STAT_INCOME_DIR / f"stat_lt_income_{safe_week}.json"
+    else:
+        stat_file = get_stat_income_file()
+
+    if not any(path.exists() for path in (stat_file, get_stat_income_journal(stat_file), get_columnar_file(stat_file))):
+        return JSONResponse({"status": "error", "message": "week not found"}, status_code=404)
+
+    projection = [name.strip() for name in fields.split(",") if name.strip()] if fields else None
+    return StreamingResponse(iter_stat_income_json(stat_file, projection), media_type="application/json")
+
+
+# === Свёртки выручки по stat_lt_income ===
+# Таблица revenue_rollup (SQLite): день × sub1 × sub2 × status -> число постбэков и сумма.
+# Обновляется инкрементально: фоновый поток раз в REVENUE_ROLLUP_INTERVAL секунд (и отчёт
+# перед ответом) дочитывает новые строки журнала текущей недели от сохранённой отметки.
+# Приращения и отметка (revenue_rollup_sources) пишутся в одной транзакции BEGIN IMMEDIATE,
+# поэтому каждая запись учитывается ровно один раз — при нескольких воркерах и после падения.
+# При первом запуске тем же путём досчитываются все прошлые недели (JSON, журнал или .col).
+# День берётся из поля date записи; если дата не разбирается — день обработки, но в пределах
+# недели файла. Повторы постбэков (duplicate) в суммы не входят.
+REVENUE_ROLLUP_FILE = Path(os.getenv("REVENUE_ROLLUP_FILE", str(STAT_INCOME_DIR / "revenue_rollup.sqlite3")))
+REVENUE_ROLLUP_INTERVAL = float(os.getenv("REVENUE_ROLLUP_INTERVAL", "5"))
+REVENUE_ROLLUP_DIMENSIONS = ("day", "sub1", "sub2", "status")
+
+_REVENUE_ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS revenue_rollup (
+    day TEXT NOT NULL,
+    sub1 TEXT NOT NULL,
+    sub2 TEXT NOT NULL,
+    status TEXT NOT NULL,
+    records INTEGER NOT NULL,
+    revenue REAL NOT NULL,
+    PRIMARY KEY (day, sub1, sub2, status)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS revenue_rollup_sources (
+    source TEXT PRIMARY KEY,
+    records INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    sealed INTEGER NOT NULL,
+    -- какой журнал дочитан до offset: "inode:размер итогового JSON" (см. RevenueRollup._refresh_source)
+    journal TEXT NOT NULL DEFAULT ''
+);
+"""
+
+
+def _parse_record_day(value) -> Optional[datetime.date]:
+    if not isinstance(value, str) or not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value).date()
+    except ValueError:
+        pass
+    for fmt in ("%d.%m.%Y %H:%M:%S", "%d.%m.%Y"):
+        try:
+            return datetime.datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+class RevenueRollup:
+    """Свёртки выручки по дням в SQLite, досчитываемые из журналов stat_lt_income."""
+
+    def __init__(self, db_file: Path, interval: float):
+        self.db_file = db_file
+        self.interval = interval
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+        self._sealed: set = set()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._connect().executescript(_REVENUE_ROLLUP_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _sources() -> list:
+        """Недели, по которым есть данные: stat_lt_income_YYYY_Wnn (в любом из форматов)."""
+        return sorted({
+            path.stem for path in STAT_INCOME_DIR.glob("stat_lt_income_*")
+            if path.suffix in (".json", ".jsonl", ".col")
+        })
+
+    @staticmethod
+    def _add(totals: dict, record, week: tuple) -> None:
+        if not isinstance(record, dict) or record.get("duplicate"):
+            return
+        day = _parse_record_day(record.get("date"))
+        if day is None:
+            day = min(max(datetime.date.today(), week[0]), week[1])
+        try:
+            value = float(record.get("sum") or 0)
+        except (TypeError, ValueError):
+            value = 0.0
+        if not math.isfinite(value):
+            value = 0.0
+        key = (day.isoformat(), str(record.get("sub1", "")), str(record.get("sub2", "")), str(record.get("status", "")))
+        entry = totals.get(key)
+        if entry is None:
+            totals[key] = [1, value]
+        else:
+            entry[0] += 1
+            entry[1] += value
+
+    def _refresh_source(self, conn: sqlite3.Connection, source: str, current: str) -> int:
+        """Досчитывает новые записи недели. Возвращает число учтённых записей."""
+        stat_file = STAT_INCOME_DIR / f"{source}.json"
+        journal = get_stat_income_journal(stat_file)
+        try:
+            year, week_number = int(source[-8:-4]), int(source[-2:])
+            monday = datetime.date.fromisocalendar(year, week_number, 1)
+        except ValueError:
+            self._sealed.add(source)  # чужой файл с похожим именем
+            return 0
+        week = (monday, monday + datetime.timedelta(days=6))
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT records, offset, sealed, journal FROM revenue_rollup_sources WHERE source = ?", (source,)
+            ).fetchone()
+            records, offset, sealed, journal_id = row or (0, 0, 0, "")
+            totals: dict = {}
+            added = 0
+            closed = journal_file = None
+            # Под разделяемой блокировкой недели только открываются файлы и запоминается размер
+            # журнала: разбор идёт уже без неё, чтобы не задерживать запись постбэков
+            with file_lock(stat_file, shared=True):
+                try:
+                    journal_file = open(journal, "rb")
+                except FileNotFoundError:
+                    if not sealed:
+                        closed = _snapshot_stat_income_json(stat_file)
+                else:
+                    stat = os.fstat(journal_file.fileno())
+                    end = stat.st_size
+                    # Журнал узнаётся по inode и размеру итогового JSON: inode удалённого журнала
+                    # может достаться новому, а каждая свёртка меняет размер JSON
+                    try:
+                        closed_size = stat_file.stat().st_size
+                    except FileNotFoundError:
+                        closed_size = -1
+                    current_id = f"{stat.st_ino}:{closed_size}"
+                    if journal_id != current_id:
+                        # Новый журнал (первый или после свёртки прежнего): сначала дочитываем
+                        # итоговый файл после учтённых записей, затем журнал с начала
+                        closed = _snapshot_stat_income_json(stat_file)
+                        offset = 0
+                    journal_id = current_id
+                    sealed = 0  # запоздавшие записи закрытой недели
+
+            if closed is not None:
+                # В итоговом файле записи в порядке поступления — пропускаем учтённые
+                for record in closed()[records:]:
+                    self._add(totals, record, week)
+                    added += 1
+            if journal_file is not None:
+                # Свёртка могла удалить журнал после снятия блокировки — открытый файл дочитывается
+                with journal_file as f:
+                    f.seek(offset)
+                    chunk = f.read(max(end - offset, 0))
+                metrics.add_bytes("revenue_rollup", "read", len(chunk))
+                cut = chunk.rfind(b"\n") + 1  # незавершённая строка — в следующий раз
+                for line in chunk[:cut].splitlines():
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json_loads(line)
+                    except json.JSONDecodeError:
+                        continue  # compact_stat_income пропустит её так же
+                    self._add(totals, record, week)
+                    added += 1
+                offset += cut
+            elif closed is not None:
+                offset, journal_id = 0, ""
+                sealed = int(source != current)
+
+            conn.executemany(
+                "INSERT INTO revenue_rollup (day, sub1, sub2, status, records, revenue) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (day, sub1, sub2, status) DO UPDATE SET "
+                "records = records + excluded.records, revenue = revenue + excluded.revenue",
+                [(*key, count, value) for key, (count, value) in totals.items()],
+            )
+            conn.execute(
+                "INSERT INTO revenue_rollup_sources (source, records, offset, sealed, journal) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (source) DO UPDATE SET "
+                "records = excluded.records, offset = excluded.offset, sealed = excluded.sealed, "
+                "journal = excluded.journal",
+                (source, records + added, offset, sealed, journal_id),
+            )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        if sealed:
+            self._sealed.add(source)
+        else:
+            self._sealed.discard(source)
+        return added
+
+    @metrics.timed("revenue_rollup_refresh")
+    def refresh(self) -> int:
+        """Досчитывает все недели. Возвращает число новых учтённых записей."""
+        with self._refresh_lock:
+            conn = self._connect()
+            current = get_stat_income_file().stem
+            added = 0
+            for source in self._sources():
+                if source in self._sealed and not get_stat_income_journal(STAT_INCOME_DIR / f"{source}.json").exists():
+                    continue  # закрытая неделя без запоздавших записей
+                try:
+                    added += self._refresh_source(conn, source, current)
+                except FileNotFoundError:
+                    continue  # неделю как раз сворачивают — дочитаем при следующем обновлении
+            if added:
+                logging.info(f"[revenue_rollup] Учтено записей stat_lt_income: {added}")
+            return added
+
+    def query(self, date_from: datetime.date, date_to: datetime.date, filters: dict, group_by: list) -> list:
+        """Строки свёртки за [date_from, date_to] с фильтрами {измерение: значение},
+        сгруппированные по group_by (подмножество REVENUE_ROLLUP_DIMENSIONS)."""
+        dims = [dim for dim in REVENUE_ROLLUP_DIMENSIONS if dim in group_by]
+        where = ["day BETWEEN ? AND ?"] + [f"{dim} = ?" for dim in REVENUE_ROLLUP_DIMENSIONS if dim in filters]
+        args = [date_from.isoformat(), date_to.isoformat()] + [filters[dim] for dim in REVENUE_ROLLUP_DIMENSIONS if dim in filters]
+        sql = f"SELECT {', '.join(dims + ['SUM(records)', 'SUM(revenue)'])} FROM revenue_rollup WHERE {' AND '.join(where)}"
+        if dims:
+            sql += f" GROUP BY {', '.join(dims)} ORDER BY {', '.join(dims)}"
+        rows = []
+        for row in self._connect().execute(sql, args):
+            if row[-2] is None:
+                continue  # пустой период без группировки
+            rows.append({**dict(zip(dims, row)), "count": row[-2], "sum": round(row[-1], 2)})
+        return rows
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.exception(f"[revenue_rollup] Ошибка обновления: {e}")
+            self._stopped.wait(self.interval)
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="revenue-rollup", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+revenue_rollup = RevenueRollup(REVENUE_ROLLUP_FILE, REVENUE_ROLLUP_INTERVAL)
+startup_report.mark("revenue_rollup")
+
+
+@on_startup
+def _start_revenue_rollup() -> None:
+    revenue_rollup.start()
+
+
+@on_shutdown
+def _stop_revenue_rollup() -> None:
+    revenue_rollup.stop()
+
 
-VERSION="1.21"
+@app.get("/stat_lt_income/rollup")
+async def get_revenue_rollup(
+    day: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    sub1: Optional[str] = None,
+    sub2: Optional[str] = None,
+    status: Optional[str] = None,
+    group_by: str = "day,sub1,sub2,status",
+):
+    """
+    Выручка (число постбэков и сумма) за день или период из свёрток stat_lt_income.
+    - day: один день; иначе date_from/date_to (по умолчанию — сегодня). Даты: DD.MM.YYYY или YYYY-MM-DD.
+    - sub1/sub2/status: точные фильтры (status=1 — подтверждённые).
+    - group_by: измерения через запятую из day, sub1, sub2, status; пусто — один итог.
+    """
+    try:
+        today = datetime.date.today()
+        if day:
+            start = end = _parse_query_date(day)
+        else:
+            start = _parse_query_date(date_from) if date_from else today
+            end = _parse_query_date(date_to) if date_to else max(start, today)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": f"bad date: {e}"}, status_code=400)
 
-# === Логи ===
-LOG_FILE = "/opt/leads_postback/postback.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
+    if start > end:
+        return JSONResponse({"status": "error", "message": "date_from is after date_to"}, status_code=400)
 
-# === Настройки ===
-load_dotenv()
-S3_ENDPOINT = os.getenv("S3_ENDPOINT")
-S3_BUCKET = os.getenv("S3_BUCKET")
-S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
-S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
+    dims = [dim.strip() for dim in group_by.split(",") if dim.strip()]
+    unknown = [dim for dim in dims if dim not in REVENUE_ROLLUP_DIMENSIONS]
+    if unknown:
+        return JSONResponse({"status": "error", "message": f"unknown group_by: {', '.join(unknown)}"}, status_code=400)
 
-DATA_DIR = Path("/opt/leads_postback/data")
-DATA_DIR.mkdir(parents=True, exist_ok=True)
+    filters = {name: value for name, value in (("sub1", sub1), ("sub2", sub2), ("status", status)) if value is not None}
+    await asyncio.to_thread(revenue_rollup.refresh)
+    rows = await asyncio.to_thread(revenue_rollup.query, start, end, filters, dims)
+    return {
+        "status": "ok",
+        "date_from": start.isoformat(),
+        "date_to": end.isoformat(),
+        "total": {"count": sum(row["count"] for row in rows), "sum": round(sum(row["sum"] for row in rows), 2)},
+        "rows": rows,
+    }
 
-STAT_INCOME_DIR = DATA_DIR / "stat_lt_income"
-STAT_INCOME_DIR.mkdir(parents=True, exist_ok=True)
 
-def get_stat_income_file() -> Path:
-    """Возвращает путь к файлу stat_lt_income с еженедельной ротацией.
-    Неделя считается по ISO (понедельник = начало недели).
-    Формат имени: stat_lt_income_YYYY_W<номер_недели>.json
-    """
-    now = datetime.datetime.now()
-    year, week, _ = now.isocalendar()
-    return STAT_INCOME_DIR / f"stat_lt_income_{year}_W{week:02d}.json"
-KROLIK_FILE = DATA_DIR / "krolik.json"
-KARAKOZ_FILE = DATA_DIR / "karakoz_karas.json"
-INSTA_FILE = DATA_DIR / "insta.json"
-UTKAVALUTKA_FILE = DATA_DIR / "utkavalutkarf.json"
-MONZI_FILE = DATA_DIR / "monzi.json"
-LISICKA_FILE = DATA_DIR / "lisicka.json"
-PTICHKA_FILE = DATA_DIR / "ptichka.json"
-KUPR_FILE = DATA_DIR / "kupr.json"
-ZAYMDOZP_FILE = DATA_DIR / "zaymdozp.json"
-PCHELKA_FILE = DATA_DIR / "pchelkazaim.json"
-NALICKINRF_FILE = DATA_DIR / "nalickinrf.json"
-BANKNOTA_FILE = DATA_DIR / "banknota.json"
-ONERUSS_FILE = DATA_DIR / "1russ.json"
-VYDAVAYKA_FILE = DATA_DIR / "vydavayka.json"
-ZARPLATKINRF_FILE = DATA_DIR / "zarplatkinrf.json"
-OREL_FILE = DATA_DIR / "orel.json"
-
-app = FastAPI()
+# === Индекс sub6 ===
+# Для каждого дня в памяти держится множество sub6 из leads_sub6_<DD.MM.YYYY>.txt: проверка
+# «есть ли лид» — O(1) вместо построчного поиска по файлам. Файл остаётся источником истины:
+# индекс дня помнит прочитанное смещение и при обращении дочитывает только новый хвост,
+# поэтому видит и строки, дописанные другими воркерами или восстановленные вручную.
+# При старте прогреваются последние SUB6_INDEX_WARM_DAYS дней, остальные дни загружаются
+# по запросу; в памяти не больше SUB6_INDEX_MAX_DAYS дней (вытесняются давно не нужные).
+# SUB6_DEDUP=1 — не дописывать sub6, уже записанный за сегодня (проверка и запись под flock
+# файла, так что повторов нет и при нескольких воркерах).
+SUB6_DEDUP = os.getenv("SUB6_DEDUP", "0") == "1"
+SUB6_INDEX_WARM_DAYS = int(os.getenv("SUB6_INDEX_WARM_DAYS", "7"))
+SUB6_INDEX_MAX_DAYS = int(os.getenv("SUB6_INDEX_MAX_DAYS", "62"))
+SUB6_QUERY_MAX_DAYS = 366
 
-# === S3 ===
-s3 = boto3.client(
-    "s3",
-    endpoint_url=S3_ENDPOINT,
-    aws_access_key_id=S3_ACCESS_KEY,
-    aws_secret_access_key=S3_SECRET_KEY,
-)
 
-def get_today_filename() -> Path:
-    today = datetime.datetime.now().strftime("%d.%m.%Y")
-    return DATA_DIR / f"leads_sub6_{today}.txt"
+class Sub6DayIndex:
+    """sub6 одного дня: множество значений, число строк в файле и прочитанное смещение.
+    Значения хранятся строками как в файле: "0123" и "123" — разные sub6."""
 
-def save_daily_sum(file_path: Path, sub5: str, sum_value: str):
-    """Сохраняет данные в JSON по дням. Если sub5 повторяется — суммирует."""
-    today = datetime.datetime.now().strftime("%d.%m.%Y")
+    __slots__ = ("values", "lines", "offset")
 
-    # Загружаем существующие данные
-    data = []
-    if file_path.exists():
-        try:
-            with open(file_path, "r") as f:
-                data = json.load(f)
-        except json.JSONDecodeError:
-            logging.warning(f"Файл {file_path.name} повреждён, пересоздаём.")
-            data = []
+    def __init__(self):
+        self.values: set = set()
+        self.lines = 0
+        self.offset = 0
 
-    # Находим блок для сегодняшнего дня
-    today_block = next((item for item in data if item["day"] == today), None)
-    if not today_block:
-        today_block = {"day": today, "data": {}}
-        data.append(today_block)
+    def feed(self, chunk: bytes) -> None:
+        for line in chunk.decode("utf-8", "replace").split("\n"):
+            line = line.strip()
+            if line.isdigit():
+                self.values.add(line)
+                self.lines += 1
 
-    # Преобразуем сумму
-    try:
-        sum_float = float(sum_value)
-    except ValueError:
-        logging.warning(f"Некорректное значение sum: {sum_value}")
-        return
 
-    # Суммируем при повторном sub5
-    if sub5 in today_block["data"]:
+class Sub6Index:
+    """Индекс sub6 по дням поверх файлов leads_sub6_*.txt."""
+
+    def __init__(self, max_days: int, dedup: bool):
+        self.max_days = max_days
+        self.dedup = dedup
+        self._days: "OrderedDict[datetime.date, Sub6DayIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _refresh(self, day: datetime.date, f=None) -> Sub6DayIndex:
+        """Индекс дня, дочитанный до конца файла. Вызывается под self._lock."""
+        entry = self._days.get(day)
+        if entry is None:
+            entry = self._days[day] = Sub6DayIndex()
+        self._days.move_to_end(day)
+        while len(self._days) > self.max_days:
+            self._days.popitem(last=False)
+
+        path = get_sub6_filename(day)
         try:
-            old_sum = float(today_block["data"][sub5])
-        except ValueError:
-            old_sum = 0
-        new_sum = old_sum + sum_float
-    else:
-        new_sum = sum_float
+            size = os.fstat(f.fileno()).st_size if f is not None else path.stat().st_size
+        except FileNotFoundError:
+            size = 0
+        if size < entry.offset:
+            # Файл пересоздан или усечён — перечитываем день целиком
+            entry = self._days[day] = Sub6DayIndex()
+        if size > entry.offset:
+            with open(path, "rb") as src:
+                src.seek(entry.offset)
+                chunk = src.read(size - entry.offset)
+            metrics.add_bytes("sub6", "read", len(chunk))
+            cut = chunk.rfind(b"\n") + 1  # недописанную строку оставляем на следующий раз
+            entry.feed(chunk[:cut])
+            entry.offset += cut
+        return entry
 
-    today_block["data"][sub5] = round(new_sum, 2)
+    def warm(self, days: int) -> None:
+        today = datetime.date.today()
+        with self._lock:
+            for i in range(days - 1, -1, -1):
+                day = today - datetime.timedelta(days=i)
+                if get_sub6_filename(day).exists():
+                    self._refresh(day)
 
-    # Сохраняем обратно
-    with open(file_path, "w") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    def append(self, sub6: str) -> bool:
+        """Дописывает sub6 в файл текущего дня. False — значение уже было (только при dedup)."""
+        return self.append_many([sub6])[0]
 
-    logging.info(f"[{file_path.name}] {sub5} -> {new_sum}")
+    @metrics.timed("sub6_append")
+    def append_many(self, values: list) -> list:
+        """Дописывает sub6 в файл текущего дня одной записью. Для каждого значения —
+        True, если записано, False, если уже было за день (только при dedup)."""
+        day = datetime.date.today()
+        with self._lock, open(get_sub6_filename(day), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # пачка не перемешается со строками других воркеров
+            try:
+                if not self.dedup:
+                    data = "".join(f"{sub6}\n" for sub6 in values)
+                    f.write(data)
+                    f.flush()
+                    metrics.add_bytes("sub6", "write", len(data))
+                    return [True] * len(values)
+                entry = self._refresh(day, f)
+                saved, lines = [], []
+                for sub6 in values:
+                    if sub6 in entry.values:
+                        saved.append(False)
+                        continue
+                    entry.values.add(sub6)
+                    lines.append(f"{sub6}\n")
+                    saved.append(True)
+                data = "".join(lines)
+                f.write(data)
+                f.flush()
+                metrics.add_bytes("sub6", "write", len(data))
+                entry.lines += len(lines)
+                entry.offset += len(data)
+                return saved
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @metrics.timed("sub6_lookup")
+    def lookup(self, values: list, start: datetime.date, end: datetime.date) -> dict:
+        """Дни, в которых встречается каждое из values, и счётчики по дням периода."""
+        found = {v: [] for v in values}
+        counts = {}
+        day = start
+        while day <= end:
+            if get_sub6_filename(day).exists():
+                with self._lock:
+                    entry = self._refresh(day)
+                    label = day.strftime("%d.%m.%Y")
+                    counts[label] = {"lines": entry.lines, "unique": len(entry.values)}
+                    for v in values:
+                        if v in entry.values:
+                            found[v].append(label)
+            day += datetime.timedelta(days=1)
+        return {"found": found, "counts": counts}
+
+
+sub6_index = Sub6Index(SUB6_INDEX_MAX_DAYS, SUB6_DEDUP)
+startup_report.mark("stat_income_sub6")
 
-def save_stat_income(sub1_name: str, sub5: str, date_str: str, sum_value: str, sub6: str, sub2: str = "", status: str = ""):
-    """Сохраняет все постбэки в stat_lt_income (еженедельный файл в отдельной директории).
-    Поля: sub1, sub2, sub5, sub6, sum, status, date.
+
+@on_startup
+async def _warm_sub6_index() -> None:
+    await asyncio.to_thread(sub6_index.warm, SUB6_INDEX_WARM_DAYS)
+
+
+@app.get("/sub6")
+async def get_sub6(
+    sub6: Optional[str] = None,
+    day: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+):
     """
-    stat_file = get_stat_income_file()
+    Поиск sub6 по файлам leads_sub6 за день или период.
+    - sub6: одно или несколько значений через запятую (без него — только счётчики по дням).
+    - day или date_from/date_to (по умолчанию — сегодня), даты DD.MM.YYYY или YYYY-MM-DD.
+    Ответ: found {sub6: [дни]} и counts {день: {"lines", "unique"}}.
+    """
+    values = []
+    for raw in (sub6 or "").split(","):
+        raw = raw.strip()
+        if not raw:
+            continue
+        if not raw.isdigit():
+            return JSONResponse({"status": "error", "message": f"bad sub6: {raw}"}, status_code=400)
+        values.append(raw)
+
+    try:
+        today = datetime.date.today()
+        if day:
+            start = end = _parse_query_date(day)
+        else:
+            start = _parse_query_date(date_from) if date_from else today
+            end = _parse_query_date(date_to) if date_to else max(start, today)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": f"bad date: {e}"}, status_code=400)
+
+    if start > end:
+        return JSONResponse({"status": "error", "message": "date_from is after date_to"}, status_code=400)
+    if (end - start).days >= SUB6_QUERY_MAX_DAYS:
+        return JSONResponse(
+            {"status": "error", "message": f"period is longer than {SUB6_QUERY_MAX_DAYS} days"}, status_code=400
+        )
+
+    result = await asyncio.to_thread(sub6_index.lookup, values, start, end)
+    return {"status": "ok", **result}
 
-    record = {
-        "sub1": sub1_name,
-        "sub2": sub2,
-        "sub5": sub5,
-        "sub6": sub6,
-        "sum": sum_value,
-        "status": status,
-        "date": date_str or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }
 
-    data = []
-    if stat_file.exists():
+# === Дедупликация постбэков ===
+# Партнёрские сети повторяют /postback при таймаутах; повтор не должен ещё раз писать
+# sub6 и суммы. Включается POSTBACK_DEDUP=1 и касается только постбэков с sub6: без него
+# повтор не отличить от нового постбэка с теми же полями. Повтор не отбрасывается бесследно:
+# он пишется в stat_lt_income с пометкой "duplicate": true (по ней видно и ложное
+# срабатывание фильтра), но без sub6 и сумм партнёру.
+# Индекс — вращающийся фильтр Блума: поколение покрывает POSTBACK_DEDUP_WINDOW секунд,
+# проверяются текущее и предыдущее поколения, то есть повтор распознаётся в течение
+# от одного до двух окон. Поколения лежат в mmap-файлах
+# DATA_DIR/dedup/postback_<номер>.bloom — общие для всех воркеров и переживают перезапуск.
+# Память на поколение: ~ -capacity * ln(fp) / ln(2)^2 бит (2 млн ключей при 1e-6 — ~7 МБ).
+# Ложное срабатывание (постбэк ошибочно принят за повтор) — с вероятностью POSTBACK_DEDUP_FP_RATE,
+# пока в поколении не больше POSTBACK_DEDUP_CAPACITY ключей. Проверка и установка битов идут
+# под file_lock каталога, поэтому одновременная запись из разных воркеров не теряет биты.
+POSTBACK_DEDUP = os.getenv("POSTBACK_DEDUP", "0") == "1"
+POSTBACK_DEDUP_WINDOW = int(os.getenv("POSTBACK_DEDUP_WINDOW", str(12 * 3600)))
+POSTBACK_DEDUP_CAPACITY = int(os.getenv("POSTBACK_DEDUP_CAPACITY", "2000000"))
+POSTBACK_DEDUP_FP_RATE = float(os.getenv("POSTBACK_DEDUP_FP_RATE", "1e-6"))
+POSTBACK_DEDUP_FIELDS = tuple(
+    f.strip() for f in os.getenv("POSTBACK_DEDUP_FIELDS", "sub1,sub2,sub5,sub6,sum,status,date").split(",") if f.strip()
+)
+
+
+class RotatingBloomFilter:
+    """Фильтр Блума из двух поколений по времени, хранящийся в mmap-файлах."""
+
+    def __init__(self, directory: Path, capacity: int, fp_rate: float, window: int):
+        self.directory = directory
+        self.window = window
+        self.bits = max(8, int(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.size = (self.bits + 7) // 8
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self._lock = threading.Lock()
+        self._generations: dict[int, mmap.mmap] = {}
+        self._missing: set[int] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _open(self, generation: int) -> mmap.mmap:
+        mm = self._generations.get(generation)
+        if mm is not None:
+            return mm
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"postback_{generation}.bloom"
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
         try:
-            with open(stat_file, "r") as f:
-                data = json.load(f)
-        except json.JSONDecodeError:
-            logging.warning(f"Файл {stat_file.name} повреждён, пересоздаём.")
-            data = []
+            if os.fstat(fd).st_size != self.size:
+                # Новый файл (или параметры фильтра поменялись) — поколение начинается с нуля
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+            mm = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self._generations[generation] = mm
+        self._drop_old(generation)
+        return mm
 
-    data.append(record)
+    def _drop_old(self, current: int) -> None:
+        for generation in [g for g in self._generations if g < current - 1]:
+            self._generations.pop(generation).close()
+        for path in self.directory.glob("postback_*.bloom"):
+            try:
+                if int(path.stem.split("_", 1)[1]) < current - 1:
+                    path.unlink(missing_ok=True)
+            except ValueError:
+                continue
 
-    with open(stat_file, "w") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    def _positions(self, key: str) -> list:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
 
-    logging.info(f"[{stat_file.name}] Добавлена запись: {record}")
+    @staticmethod
+    def _contains(mm: mmap.mmap, positions: list) -> bool:
+        return all(mm[p >> 3] & (1 << (p & 7)) for p in positions)
 
+    def _previous(self, generation: int) -> Optional[mmap.mmap]:
+        """Предыдущее поколение, если его файл есть (например, создан другим воркером)."""
+        previous = generation - 1
+        if previous in self._generations:
+            return self._generations[previous]
+        if previous in self._missing:
+            return None
+        path = self.directory / f"postback_{previous}.bloom"
+        if not path.exists() or path.stat().st_size != self.size:
+            self._missing.add(previous)
+            return None
+        return self._open(previous)
+
+    def _seen(self, current: mmap.mmap, generation: int, positions: list) -> bool:
+        if self._contains(current, positions):
+            return True
+        previous = self._previous(generation)
+        return previous is not None and self._contains(previous, positions)
+
+    @staticmethod
+    def _set(mm: mmap.mmap, positions: list) -> None:
+        for p in positions:
+            mm[p >> 3] |= 1 << (p & 7)
+
+    def contains(self, key: str) -> bool:
+        """True, если ключ уже встречался в окне (повтор). Ключ не добавляется."""
+        positions = self._positions(key)
+        generation = int(time.time() // self.window)
+        with self._lock, file_lock(self.directory):
+            seen = self._seen(self._open(generation), generation, positions)
+            if seen:
+                self.hits += 1
+            return seen
+
+    def add_many(self, keys: list) -> None:
+        """Добавляет ключи в текущее поколение (после того как постбэки записаны)."""
+        generation = int(time.time() // self.window)
+        with self._lock, file_lock(self.directory):
+            current = self._open(generation)
+            for key in keys:
+                self._set(current, self._positions(key))
+            self.misses += len(keys)
+
+    def check_and_add(self, key: str) -> bool:
+        """True, если ключ уже встречался в окне (повтор); иначе добавляет его и возвращает False."""
+        positions = self._positions(key)
+        generation = int(time.time() // self.window)
+        with self._lock, file_lock(self.directory):
+            current = self._open(generation)
+            if self._seen(current, generation, positions):
+                self.hits += 1
+                return True
+            self._set(current, positions)
+            self.misses += 1
+            return False
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "window_seconds": self.window,
+            "bytes_per_generation": self.size,
+            "hashes": self.hashes,
+            "generations_open": len(self._generations),
+        }
+
+
+postback_dedup = RotatingBloomFilter(
+    DATA_DIR / "dedup", POSTBACK_DEDUP_CAPACITY, POSTBACK_DEDUP_FP_RATE, POSTBACK_DEDUP_WINDOW
+) if POSTBACK_DEDUP else None
+startup_report.mark("postback_dedup")
+
+
+def _postback_identity(params: dict) -> Optional[str]:
+    """Ключ постбэка для дедупликации: значения POSTBACK_DEDUP_FIELDS через \x1f.
+    None — постбэк без sub6, такие не дедуплицируются."""
+    if not params.get("sub6"):
+        return None
+    return "\x1f".join(str(params.get(field) or "") for field in POSTBACK_DEDUP_FIELDS)
+
+
+def is_duplicate_postback(params: dict) -> bool:
+    """Проверка без записи: ключ запоминается только после успешной записи постбэка
+    (remember_postbacks), иначе повтор после ошибки записи был бы отброшен и постбэк потерян.
+    Повтор, пришедший, пока оригинал ещё пишется, при этом может пройти — это лучше потери."""
+    key = _postback_identity(params)
+    if postback_dedup is None or key is None:
+        return False
+    return postback_dedup.contains(key)
+
+
+def remember_postbacks(plans: list) -> None:
+    """Запоминает ключи записанных постбэков (планов prepare_postback)."""
+    keys = [plan["key"] for plan in plans if plan["key"] is not None]
+    if postback_dedup is not None and keys:
+        postback_dedup.add_many(keys)
+
+
+@app.get("/postback/dedup")
+async def get_postback_dedup_stats():
+    """Счётчики индекса дедупликации постбэков (hits — повторы, записанные только в stat_lt_income)."""
+    if postback_dedup is None:
+        return {"status": "ok", "enabled": False}
+    return {"status": "ok", "enabled": True, **postback_dedup.stats()}
+
+
+def _duplicate_plan(record: dict) -> dict:
+    """План повтора: только запись stat_lt_income с пометкой duplicate, без sub6 и суммы партнёру.
+    sub6 и сумма уже записаны оригиналом."""
+    return {"record": {**record, "duplicate": True}, "sub6": None, "partner": None, "key": None, "duplicate": True}
+
+
+def prepare_postback(params: dict) -> dict:
+    """Проверки и маршрутизация одного постбэка без записи на диск. План записи:
+    {"record": запись stat_lt_income, "sub6": sub6 или None, "partner": (файл, sub5, sum) или None,
+     "key": ключ дедупликации или None — запомнить после записи (remember_postbacks),
+     "duplicate": повтор — пишется только record с пометкой duplicate}.
+    """
+    duplicate = is_duplicate_postback(params)
 
-@app.api_route("/postback", methods=["GET", "POST"])
-async def receive_postback(request: Request):
-    params = dict(request.query_params)
     sub1 = params.get("sub1")
     sub2 = params.get("sub2") or ""
     sub5 = params.get("sub5")
@@ -164,8 +2235,8 @@ async def receive_postback(request: Request):
     date_str = params.get("date") or ""
     #date_str = params.get("date") or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    # === Сохраняем ВСЕ постбэки в stat_lt_income (еженедельная ротация) ===
-    save_stat_income(
+    # === ВСЕ постбэки идут в stat_lt_income (еженедельная ротация) ===
+    record = make_stat_income_record(
         sub1_name=sub1 or "",
         sub5=sub5 or "",
         date_str=date_str,
@@ -174,17 +2245,17 @@ async def receive_postback(request: Request):
         sub2=sub2,
         status=status,
     )
+    if duplicate:
+        log_event("postback", "Повтор постбэка (только stat_lt_income)", {"sub1": sub1, "sub6": sub6})
+        return _duplicate_plan(record)
 
-    # === Обработка sub6 ===
-    if sub6 and sub6.isdigit():
-        filename = get_today_filename()
-        with open(filename, "a") as f:
-            f.write(f"{sub6}\n")
-        logging.info(f"Получен и сохранён sub6: {sub6}")
-    else:
-        logging.warning(f"Некорректный sub6 (пропущен): {sub6}")
+    # === sub6 ===
+    if not (sub6 and sub6.isdigit()):
+        log_event("postback", "Некорректный sub6 (пропущен)", sub6, logging.WARNING)
+        sub6 = None
 
-    # === Обработка krolik (если слово встречается в sub1) ===
+    # === Сумма партнёру (маршрут по ключевому слову в sub1) ===
+    partner = None
     if (
         sub1
         and sub5
@@ -192,45 +2263,196 @@ async def receive_postback(request: Request):
         and sum_value not in ("0", "0.0", "0.00")  # sum не равен 0
         and status == "1"
     ):
-        sub1_lower = sub1.lower()
-    
-        if "krolik" in sub1_lower or "banknota" in sub1_lower:
-            save_daily_sum(KROLIK_FILE, sub5, sum_value)
-        elif "karakoz" in sub1_lower or "karas" in sub1_lower:
-            save_daily_sum(KARAKOZ_FILE, sub5, sum_value)
-        elif "1russ" in sub1_lower or "darya" in sub1_lower or "vadimtop" in sub1_lower or "clickchirik" in sub1_lower:
-            save_daily_sum(ONERUSS_FILE, sub5, sum_value)
-        elif "vydavayka" in sub1_lower:
-            save_daily_sum(VYDAVAYKA_FILE, sub5, sum_value)
-        elif "insta" in sub1_lower or "kud" in sub1_lower:
-            save_daily_sum(INSTA_FILE, sub5, sum_value)
-        elif "utkavalutkarf" in sub1_lower:
-            save_daily_sum(UTKAVALUTKA_FILE, sub5, sum_value)
-        elif "monzi" in sub1_lower:
-            save_daily_sum(MONZI_FILE, sub5, sum_value)
-        elif "lisicka" in sub1_lower:
-            save_daily_sum(LISICKA_FILE, sub5, sum_value)
-        elif "ptichka" in sub1_lower:
-            save_daily_sum(PTICHKA_FILE, sub5, sum_value)
-        elif "kupr" in sub1_lower:
-            save_daily_sum(KUPR_FILE, sub5, sum_value)
-        elif "nalickinrf" in sub1_lower:
-            save_daily_sum(NALICKINRF_FILE, sub5, sum_value)
-        elif "zarplatkinrf" in sub1_lower:
-            save_daily_sum(ZARPLATKINRF_FILE, sub5, sum_value)
-        elif "zaymdozp" in sub1_lower:
-            save_daily_sum(ZAYMDOZP_FILE, sub5, sum_value)
-        elif "pchelkazaim" in sub1_lower:
-            save_daily_sum(PCHELKA_FILE, sub5, sum_value)
-        elif "orel" in sub1_lower:
-            save_daily_sum(OREL_FILE, sub5, sum_value)
+        partner_file = partner_router.route(sub1)
+        if partner_file is not None:
+            partner = (partner_file, sub5, sum_value)
     else:
-        logging.warning(
-            f"Пропущен постбэк: sub1={sub1}, sub5={sub5}, sum={sum_value}, status={status}"
+        log_event(
+            "postback", "Пропущен постбэк",
+            {"sub1": sub1, "sub5": sub5, "sum": sum_value, "status": status}, logging.WARNING,
+        )
+
+    key = _postback_identity(params) if postback_dedup is not None else None
+    return {"record": record, "sub6": sub6, "partner": partner, "key": key, "duplicate": False}
+
+
+def apply_postbacks(plans: list) -> list:
+    """Выполняет планы prepare_postback: по одной записи в журнал stat_lt_income и
+    в файл sub6 на весь набор, суммы партнёров — в DailySumAggregator.
+    Возвращает результат для каждого плана."""
+    single = len(plans) == 1
+
+    stat_file = save_stat_income_records([plan["record"] for plan in plans])
+    if single:
+        log_event("postback", f"[{stat_file.name}] Добавлена запись", plans[0]["record"])
+
+    with_sub6 = [plan for plan in plans if plan["sub6"] is not None]
+    saved = sub6_index.append_many([plan["sub6"] for plan in with_sub6]) if with_sub6 else []
+    sub6_saved = {id(plan): ok for plan, ok in zip(with_sub6, saved)}
+    if single and with_sub6:
+        sub6 = with_sub6[0]["sub6"]
+        if saved[0]:
+            log_event("postback", "Получен и сохранён sub6", sub6)
+        else:
+            log_event("postback", "sub6 уже записан сегодня (пропущен)", sub6)
+
+    results = []
+    for plan in plans:
+        result = {"status": "ok"}
+        if plan["duplicate"]:
+            result["duplicate"] = True
+        if plan["sub6"] is not None and not sub6_saved[id(plan)]:
+            result["sub6_duplicate"] = True
+        if plan["partner"] is not None:
+            partner_file, sub5, sum_value = plan["partner"]
+            save_daily_sum(partner_file, sub5, sum_value, log=single)
+            result["partner"] = partner_file.stem
+        results.append(result)
+
+    if not single:
+        logging.info(
+            f"[{stat_file.name}] Пакет постбэков: {len(plans)} записей, sub6: {sum(saved)}, "
+            f"партнёрам: {sum(1 for plan in plans if plan['partner'] is not None)}, "
+            f"повторов: {sum(1 for plan in plans if plan['duplicate'])}"
         )
+    return results
+
+
+def process_postback(params: dict) -> bool:
+    """Проверка, запись и запоминание одного постбэка.
+    False — повтор: записан только в stat_lt_income с пометкой duplicate."""
+    plan = prepare_postback(params)
+    apply_postbacks([plan])
+    remember_postbacks([plan])
+    return not plan["duplicate"]
+
 
+@app.api_route("/postback", methods=["GET", "POST"])
+async def receive_postback(request: Request):
+    params = dict(request.query_params)
+
+    # В потоке: ожидание flock при нескольких воркерах не должно останавливать event loop
+    if not await asyncio.to_thread(process_postback, params):
+        return {"status": "ok", "duplicate": True}
     return {"status": "ok"}
 
+
+POSTBACK_BATCH_MAX = int(os.getenv("POSTBACK_BATCH_MAX", "10000"))
+
+
+def _parse_postback_batch(body: bytes, content_type: str) -> list:
+    """Элементы пакета: JSON-массив (application/json) или NDJSON (по объекту на строку)."""
+    if "application/json" in content_type:
+        items = json_loads(body)
+        if not isinstance(items, list):
+            raise ValueError("expected a JSON array")
+        return items
+    items = []
+    for line in body.splitlines():
+        if line.strip():
+            items.append(json_loads(line))
+    return items
+
+
+@app.post("/postback/batch")
+async def receive_postback_batch(request: Request):
+    """
+    Пакетная загрузка постбэков: JSON-массив или NDJSON, каждый элемент — объект
+    с теми же полями, что query-параметры /postback (sub1, sub2, sub5, sub6, sum, status, date).
+    Проверки и маршрутизация — как у /postback, но журнал stat_lt_income и файл sub6
+    дописываются одной записью на весь пакет.
+    Ответ: results — по элементу на каждый входной объект, в том же порядке.
+    """
+    body = await request.body()
+    try:
+        items = _parse_postback_batch(body, request.headers.get("content-type", ""))
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": f"bad batch: {e}"}, status_code=400)
+    if len(items) > POSTBACK_BATCH_MAX:
+        return JSONResponse(
+            {"status": "error", "message": f"batch is larger than {POSTBACK_BATCH_MAX} items"}, status_code=413
+        )
+
+    results = await asyncio.to_thread(process_postback_batch, items)
+    return {"status": "ok", "count": len(items), "results": results}
+
+
+def process_postback_batch(items: list) -> list:
+    """Проверки, маршрутизация и запись пакета (в потоке: flock и хеширование на каждый
+    элемент не должны держать event loop). Ключи дедупликации запоминаются только после
+    записи всего пакета; повтор внутри самого пакета распознаётся по уже принятым ключам
+    и, как любой повтор, пишется только в stat_lt_income с пометкой duplicate."""
+    results: list = [None] * len(items)
+    plans, positions, keys = [], [], set()
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {"status": "error", "message": "expected an object"}
+            continue
+        # Значения приводим к строкам, как у query-параметров одиночного постбэка
+        params = {str(k): str(v) for k, v in item.items() if v is not None}
+        plan = prepare_postback(params)
+        if plan["key"] is not None:
+            if plan["key"] in keys:
+                plan = _duplicate_plan(plan["record"])
+            else:
+                keys.add(plan["key"])
+        plans.append(plan)
+        positions.append(i)
+
+    if plans:
+        for i, result in zip(positions, apply_postbacks(plans)):
+            results[i] = result
+        remember_postbacks(plans)
+    return results
+
+
+# === Параметры запроса ===
+FORM_CONTENT_TYPES = ("application/x-www-form-urlencoded", "multipart/form-data")
+
+
+async def read_request_params(request: Request, aliases: Optional[dict] = None) -> dict:
+    """
+    Параметры запроса за один проход: тело разбирается один раз по content-type
+    (форма — как форма, иначе JSON-объект, даже без заголовка), query-параметры дополняют
+    ключи, которых нет в теле. aliases переименовывает ключи ({"bannerId": "banner_id"});
+    если в одном источнике есть оба написания, побеждает основное.
+    """
+    aliases = aliases or {}
+    params: dict = {}
+
+    def put(key: str, value, from_query: bool) -> None:
+        name = aliases.get(key, key)
+        # Непустое значение не перекрывается ни query, ни псевдонимом из того же тела
+        if params.get(name) and (from_query or name != key):
+            return
+        params[name] = value
+
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith(FORM_CONTENT_TYPES):
+        try:
+            form = await request.form()
+            for key, value in form.items():
+                put(key.strip(), value, from_query=False)
+        except Exception as e:
+            logging.warning(f"[{request.url.path}] Form parse error: {e}")
+    else:
+        body = await request.body()
+        if body.strip():
+            try:
+                parsed = json_loads(body)
+            except json.JSONDecodeError as e:
+                parsed = None
+                if "application/json" in content_type:
+                    logging.warning(f"[{request.url.path}] JSON parse error: {e}")
+            if isinstance(parsed, dict):
+                for key, value in parsed.items():
+                    put(key, value, from_query=False)
+
+    for key, value in request.query_params.items():
+        put(key, value, from_query=True)
+    return params
+
+
 # --- TRAFFIC_BH endpoint/helpers ---
 
 TRAFFIC_DIR = DATA_DIR / "traffic_bh"
@@ -242,16 +2464,301 @@ def _get_traffic_filename() -> Path:
     today = datetime.datetime.now().strftime("%Y-%m-%d")
     return TRAFFIC_DIR / f"traffic_bh_{today}.jsonl"
 
-def append_traffic_record(banner_id: str, user_id: str, extra: Optional[dict] = None) -> None:
-    """Добавляет одну запись в jsonl файл с временной меткой."""
+# Групповая запись (group commit): обработчик кладёт строку в очередь, фоновая задача
+# владеет открытым файлом, пишет накопившиеся строки одним write и делает fsync
+# по политике TRAFFIC_FSYNC_POLICY:
+#   always   — fsync после каждой пачки; запись подтверждается только после fsync
+#   interval — fsync не реже раза в TRAFFIC_FSYNC_INTERVAL_MS
+#   count    — fsync каждые TRAFFIC_FSYNC_EVERY записей
+#   none     — без fsync, сброс на диск оставляется ОС
+# Окно потери данных (что может пропасть при падении):
+#   - процесс упал: записи в очереди, ещё не записанные в файл (не больше TRAFFIC_QUEUE_MAX;
+#     при TRAFFIC_WAIT_COMMIT=1 ни одна из них ещё не подтверждена клиенту);
+#   - упала ОС/питание: плюс записанное после последнего fsync — 0 для always,
+#     до TRAFFIC_FSYNC_INTERVAL_MS для interval, до TRAFFIC_FSYNC_EVERY-1 записей для count,
+#     до периода writeback ОС (обычно ~30 с) для none.
+# TRAFFIC_WAIT_COMMIT=1 — ответ отдаётся после записи пачки (и fsync, если он положен
+# политикой для этой пачки); 0 — сразу после постановки в очередь.
+TRAFFIC_FSYNC_POLICY = os.getenv("TRAFFIC_FSYNC_POLICY", "always")
+TRAFFIC_FSYNC_INTERVAL_MS = int(os.getenv("TRAFFIC_FSYNC_INTERVAL_MS", "50"))
+TRAFFIC_FSYNC_EVERY = int(os.getenv("TRAFFIC_FSYNC_EVERY", "100"))
+TRAFFIC_WAIT_COMMIT = os.getenv("TRAFFIC_WAIT_COMMIT", "1") == "1"
+TRAFFIC_QUEUE_MAX = int(os.getenv("TRAFFIC_QUEUE_MAX", "10000"))
+TRAFFIC_BATCH_MAX = int(os.getenv("TRAFFIC_BATCH_MAX", "1000"))
+
+
+# === Индекс traffic_bh ===
+# Рядом с каждым дневным файлом TrafficWriter дописывает индекс traffic_bh_YYYY-MM-DD.idx:
+# по строке на запись — "смещение<TAB>длина<TAB>минута суток<TAB>banner_id". Из него строятся
+# диапазоны байтов по минутам и списки смещений по banner_id, так что запрос за час по одному
+# баннеру читает из файла данных только свои строки (через mmap).
+# Если индекса у файла нет (файлы до появления индекса), он строится одним проходом:
+# для прошлых дней — при первом запросе, для текущего — когда TrafficWriter открывает файл.
+def get_traffic_index_file(data_file: Path) -> Path:
+    return data_file.with_suffix(".idx")
+
+
+def _traffic_index_key(line) -> tuple:
+    """(минута суток, banner_id) записи traffic_bh."""
+    record = json_loads(line)
+    ts = datetime.datetime.fromisoformat(record["timestamp"])
+    return ts.hour * 60 + ts.minute, str(record.get("banner_id", ""))
+
+
+def _traffic_index_line(offset: int, length: int, minute: int, banner_id: str) -> bytes:
+    banner_id = banner_id.replace("\t", " ").replace("\n", " ")
+    return f"{offset}\t{length}\t{minute}\t{banner_id}\n".encode("utf-8")
+
+
+def _scan_traffic_index(data_file: Path, out, end: Optional[int] = None) -> int:
+    """Пишет в out индекс строк data_file до смещения end. Возвращает число записей."""
+    count = 0
+    offset = 0
+    with open(data_file, "rb") as f:
+        for raw in f:
+            if (end is not None and offset + len(raw) > end) or not raw.endswith(b"\n"):
+                break
+            try:
+                minute, banner_id = _traffic_index_key(raw)
+            except (ValueError, KeyError, TypeError):
+                offset += len(raw)
+                continue  # повреждённая строка — в индекс не попадает
+            out.write(_traffic_index_line(offset, len(raw), minute, banner_id))
+            offset += len(raw)
+            count += 1
+    return count
+
+
+def build_traffic_index(data_file: Path) -> None:
+    """Строит индекс файла, в который больше не пишут (прошлый день), атомарно.
+    Строить могут одновременно несколько воркеров — у каждого свой временный файл."""
+    index_file = get_traffic_index_file(data_file)
+    tmp_file = index_file.with_name(f"{index_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_file, "wb") as out:
+        count = _scan_traffic_index(data_file, out)
+    os.replace(tmp_file, index_file)
+    logging.info(f"[{data_file.name}] Построен индекс: {count} записей")
+
+
+class TrafficWriter:
+    """Фоновая задача, пишущая jsonl-файлы traffic_bh пачками."""
+
+    POLICIES = ("always", "interval", "count", "none")
+
+    def __init__(self, policy: str, interval_ms: int, every: int, wait_commit: bool,
+                 queue_max: int, batch_max: int):
+        if policy not in self.POLICIES:
+            raise ValueError(f"TRAFFIC_FSYNC_POLICY должен быть одним из {self.POLICIES}: {policy}")
+        self.policy = policy
+        self.interval = interval_ms / 1000
+        self.every = max(1, every)
+        self.wait_commit = wait_commit
+        self.queue_max = queue_max
+        self.batch_max = max(1, batch_max)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._file = None
+        self._index = None
+        self._file_path: Optional[Path] = None
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    # --- файловые операции (выполняются в отдельном потоке) ---
+
+    def _open(self, file_path: Path):
+        if self._file_path != file_path:
+            self._close()
+            self._file = open(file_path, "ab")
+            self._file_path = file_path
+            self._index = self._open_index(file_path)
+        return self._file
+
+    def _open_index(self, file_path: Path):
+        """Индекс файла для дописывания. Если его ещё нет, тот, кто его создал
+        (O_EXCL — один из воркеров), индексирует уже записанные строки."""
+        index_file = get_traffic_index_file(file_path)
+        # Под блокировкой файла данных: другой воркер не допишет строки между созданием
+        # индекса и его заполнением (иначе они попали бы в индекс дважды)
+        with self._locked():
+            try:
+                fd = os.open(index_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o644)
+                created = True
+            except FileExistsError:
+                fd = os.open(index_file, os.O_WRONLY | os.O_APPEND)
+                created = False
+            index = os.fdopen(fd, "ab")
+            size = os.fstat(self._file.fileno()).st_size
+            if created and size:
+                count = _scan_traffic_index(file_path, index, end=size)
+                index.flush()
+                logging.info(f"[{file_path.name}] Проиндексированы прежние записи: {count}")
+        return index
+
+    @contextmanager
+    def _locked(self):
+        """flock открытого файла данных: пачка и её строки индекса дописываются одним куском
+        относительно других воркеров, поэтому смещения в индексе не перемешиваются."""
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def _fsync(self) -> None:
+        if self._file is None or not self._unsynced:
+            return
+        try:
+            os.fsync(self._file.fileno())
+            if self._index is not None:
+                os.fsync(self._index.fileno())
+        except Exception:
+            # fsync может не поддерживаться в некоторых FS — не критично
+            pass
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+            self._fsync()
+            self._file.close()
+            self._file = None
+            self._file_path = None
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    @metrics.timed("traffic_commit")
+    def _commit(self, batch: list) -> None:
+        """Пишет пачку (по файлам в порядке поступления) и делает fsync по политике."""
+        by_file: dict[Path, list] = {}
+        for file_path, line, key, _ in batch:
+            by_file.setdefault(file_path, []).append((line.encode("utf-8"), key))
+        last_path = batch[-1][0]
+        for file_path, lines in by_file.items():
+            f = self._open(file_path)
+            data = b"".join(raw for raw, _ in lines)
+            with self._locked():
+                f.write(data)
+                f.flush()
+                # Дописывание (O_APPEND) ставит позицию в конец нашей записи — отсюда смещения строк
+                offset = f.tell() - len(data)
+                index_lines = []
+                for raw, key in lines:
+                    try:
+                        minute, banner_id = key if key is not None else _traffic_index_key(raw)
+                    except (ValueError, KeyError, TypeError):
+                        offset += len(raw)
+                        continue
+                    index_lines.append(_traffic_index_line(offset, len(raw), minute, banner_id))
+                    offset += len(raw)
+                self._index.write(b"".join(index_lines))
+                self._index.flush()
+            metrics.add_bytes("traffic_bh", "write", len(data))
+            self._unsynced += len(lines)
+            if file_path != last_path:
+                # Файл сменился (полночь) — прошлый закрываем с fsync
+                self._close()
+
+        if self.policy == "always":
+            self._fsync()
+        elif self.policy == "count" and self._unsynced >= self.every:
+            self._fsync()
+        elif self.policy == "interval" and time.monotonic() - self._synced_at >= self.interval:
+            self._fsync()
+
+    def _sync_if_due(self) -> None:
+        if self.policy == "interval" and time.monotonic() - self._synced_at >= self.interval:
+            self._fsync()
+
+    # --- асинхронная часть ---
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue(maxsize=self.queue_max)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        await asyncio.to_thread(self._close)
+
+    async def write(self, file_path: Path, line: str, index_key: Optional[tuple] = None) -> None:
+        """Ставит строку в очередь; при wait_commit ждёт, пока пачка с ней будет записана.
+        index_key — (минута суток, banner_id) для индекса; без него строка разбирается при записи."""
+        if self._task is None or self._task.done():
+            self.start()
+        future = asyncio.get_running_loop().create_future() if self.wait_commit else None
+        await self._queue.put((file_path, line, index_key, future))
+        if future is not None:
+            await future
+
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            timeout = None
+            if self.policy == "interval" and self._unsynced:
+                timeout = max(0.0, self.interval - (time.monotonic() - self._synced_at))
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self._sync_if_due)
+                continue
+
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.batch_max or self._queue.empty():
+                    break
+                item = self._queue.get_nowait()
+            stopping = item is None
+
+            if not batch:
+                continue
+            try:
+                await asyncio.to_thread(self._commit, batch)
+            except Exception as e:
+                logging.exception(f"Ошибка записи traffic_bh ({len(batch)} записей): {e}")
+                for *_, future in batch:
+                    if future is not None and not future.done():
+                        future.set_exception(e)
+                continue
+            for *_, future in batch:
+                if future is not None and not future.done():
+                    future.set_result(None)
+
+
+traffic_writer = TrafficWriter(
+    TRAFFIC_FSYNC_POLICY, TRAFFIC_FSYNC_INTERVAL_MS, TRAFFIC_FSYNC_EVERY,
+    TRAFFIC_WAIT_COMMIT, TRAFFIC_QUEUE_MAX, TRAFFIC_BATCH_MAX,
+)
+startup_report.mark("traffic_bh")
+
+
+@on_startup
+async def _start_traffic_writer() -> None:
+    traffic_writer.start()
+
+
+@on_shutdown
+async def _stop_traffic_writer() -> None:
+    await traffic_writer.stop()
+
+
+@metrics.timed("traffic_append")
+async def append_traffic_record(banner_id: str, user_id: str, extra: Optional[dict] = None) -> None:
+    """Добавляет одну запись в jsonl файл с временной меткой (через TrafficWriter)."""
     if extra is None:
         extra = {}
 
     # Временная метка с часовым поясом сервера (ISO 8601)
-    ts = datetime.datetime.now().astimezone().isoformat()
+    now = datetime.datetime.now().astimezone()
 
     record = {
-        "timestamp": ts,
+        "timestamp": now.isoformat(),
         "banner_id": banner_id,
         "user_id": user_id,
     }
@@ -260,84 +2767,287 @@ def append_traffic_record(banner_id: str, user_id: str, extra: Optional[dict] =
 
     file_path = _get_traffic_filename()
     try:
-        # Открываем в append и пишем одну строку JSON
-        with open(file_path, "a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
-            f.flush()
-            try:
-                os.fsync(f.fileno())
-            except Exception:
-                # fsync может не поддерживаться в некоторых FS — не критично
-                pass
-        logging.info(f"[traffic_bh] saved: {record}")
+        await traffic_writer.write(file_path, json_dumps(record) + "\n", (now.hour * 60 + now.minute, banner_id))
+        log_event("traffic_bh", "[traffic_bh] saved", record)
     except Exception as e:
         logging.exception(f"Ошибка записи в {file_path}: {e}")
         raise
 
+TRAFFIC_PARAM_ALIASES = {"bannerId": "banner_id", "userId": "user_id"}
+
+
 @app.post("/traffic_bh")
 async def receive_traffic_bh(request: Request):
     """
     Ожидает POST с banner_id и user_id.
     Поддерживается: JSON body, form-data/x-www-form-urlencoded и query params (на случай простого GET-теста).
     """
-    # Попробуем несколько источников параметров (JSON -> form -> query)
-    banner_id = None
-    user_id = None
-    extra = {}
+    params = await read_request_params(request, TRAFFIC_PARAM_ALIASES)
+    banner_id = params.pop("banner_id", None)
+    user_id = params.pop("user_id", None)
+    # любые дополнительные поля (из тела и query) идут в запись как есть
+    extra = params
+
+    # Валидация
+    if not banner_id or not user_id:
+        log_event(
+            "traffic_bh", "Пропущен traffic_bh постбэк",
+            {"banner_id": banner_id, "user_id": user_id}, logging.WARNING,
+        )
+        return JSONResponse({"status": "error", "message": "banner_id and user_id are required"}, status_code=400)
 
-    # 1) JSON body
+    # Сохраняем
     try:
-        body = await request.json()
-        if isinstance(body, dict):
-            banner_id = body.get("banner_id") or body.get("bannerId")
-            user_id = body.get("user_id") or body.get("userId")
-            # любые дополнительные поля положим в extra
-            for k, v in body.items():
-                if k not in ("banner_id", "bannerId", "user_id", "userId"):
-                    extra[k] = v
-    except Exception:
-        # не JSON — пропускаем
-        pass
+        await append_traffic_record(str(banner_id), str(user_id), extra if extra else None)
+    except Exception as e:
+        # логируем ошибку и возвращаем 500
+        logging.exception(f"Не удалось сохранить traffic_bh запись: {e}")
+        return JSONResponse({"status": "error", "message": "failed to save record"}, status_code=500)
 
-    # 2) если не в JSON — пробуем form data / x-www-form-urlencoded
-    if not banner_id or not user_id:
+    return {"status": "ok"}
+TRAFFIC_INDEX_MAX_DAYS = int(os.getenv("TRAFFIC_INDEX_MAX_DAYS", "7"))
+TRAFFIC_QUERY_MAX_DAYS = 31
+TRAFFIC_QUERY_MAX_LIMIT = 100000
+
+
+class TrafficDayIndex:
+    """Индекс одного дня в памяти: диапазон байтов по минутам и смещения по banner_id."""
+
+    __slots__ = ("minutes", "postings", "covered", "offset")
+
+    def __init__(self):
+        self.minutes: dict = {}   # минута -> [начало, конец) строк этой минуты
+        self.postings: dict = {}  # banner_id -> (смещения, длины, минуты)
+        self.covered = 0          # конец последней проиндексированной строки
+        self.offset = 0           # прочитано байт файла индекса
+
+    def feed(self, chunk: bytes) -> None:
+        for line in chunk.splitlines():
+            offset, length, minute, banner_id = line.decode("utf-8").split("\t", 3)
+            offset, length, minute = int(offset), int(length), int(minute)
+            end = offset + length
+            span = self.minutes.get(minute)
+            if span is None:
+                self.minutes[minute] = [offset, end]
+            else:
+                span[0] = min(span[0], offset)
+                span[1] = max(span[1], end)
+            posting = self.postings.get(banner_id)
+            if posting is None:
+                posting = self.postings[banner_id] = (array("Q"), array("I"), array("H"))
+            posting[0].append(offset)
+            posting[1].append(length)
+            posting[2].append(minute)
+            self.covered = max(self.covered, end)
+
+
+class TrafficIndex:
+    """Запросы к файлам traffic_bh по времени, banner_id и user_id через индексы дней."""
+
+    def __init__(self, max_days: int):
+        self.max_days = max_days
+        self._days: "OrderedDict[datetime.date, TrafficDayIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def data_file(day: datetime.date) -> Path:
+        return TRAFFIC_DIR / f"traffic_bh_{day:%Y-%m-%d}.jsonl"
+
+    def _refresh(self, day: datetime.date) -> Optional[TrafficDayIndex]:
+        """Индекс дня, дочитанный до конца файла индекса. None — индекса нет (сегодня,
+        записей с момента запуска ещё не было): тогда день читается целиком."""
+        index_file = get_traffic_index_file(self.data_file(day))
+        if not index_file.exists():
+            if day >= datetime.date.today():
+                return None
+            build_traffic_index(self.data_file(day))
+
+        with self._lock:
+            entry = self._days.get(day)
+            if entry is None:
+                entry = self._days[day] = TrafficDayIndex()
+            self._days.move_to_end(day)
+            while len(self._days) > self.max_days:
+                self._days.popitem(last=False)
+
+            size = index_file.stat().st_size
+            if size < entry.offset:
+                entry = self._days[day] = TrafficDayIndex()  # индекс пересоздан
+            if size > entry.offset:
+                with open(index_file, "rb") as f:
+                    f.seek(entry.offset)
+                    chunk = f.read(size - entry.offset)
+                cut = chunk.rfind(b"\n") + 1
+                entry.feed(chunk[:cut])
+                entry.offset += cut
+                metrics.add_bytes("traffic_bh_index", "read", cut)
+            return entry
+
+    @staticmethod
+    def _regions(entry: Optional[TrafficDayIndex], size: int, minute_from: int, minute_to: int,
+                 banner_id: Optional[str]) -> list:
+        """Участки файла данных [начало, конец), которые нужно прочитать."""
+        if entry is None:
+            return [(0, size)]
+        regions = []
+        if banner_id is not None:
+            posting = entry.postings.get(banner_id)
+            if posting is not None:
+                regions = sorted({
+                    (offset, offset + length)
+                    for offset, length, minute in zip(*posting)
+                    if minute_from <= minute <= minute_to
+                })
+        else:
+            spans = [span for minute, span in entry.minutes.items() if minute_from <= minute <= minute_to]
+            if spans:
+                regions = [(min(span[0] for span in spans), max(span[1] for span in spans))]
+        if size > entry.covered:
+            # Строки, записанные после последней записи индекса (другой воркер ещё не дописал)
+            regions.append((entry.covered, size))
+        return regions
+
+    def query(self, start: datetime.datetime, end: datetime.datetime, banner_id: Optional[str],
+              user_id: Optional[str], limit: int) -> dict:
+        records = []
+        scanned = 0
+        day = start.date()
+        while day <= end.date() and len(records) <= limit:
+            data_file = self.data_file(day)
+            columnar_file = get_columnar_file(data_file)
+            if columnar_file.exists():
+                # День уже переложен в колоночный формат (columnar_compact.py)
+                scanned += self._query_columnar(columnar_file, start, end, banner_id, user_id, limit, records)
+            elif data_file.exists():
+                scanned += self._query_jsonl(day, data_file, start, end, banner_id, user_id, limit, records)
+            day += datetime.timedelta(days=1)
+        truncated = len(records) > limit
+        del records[limit:]
+        metrics.add_bytes("traffic_bh_query", "read", scanned)
+        return {"count": len(records), "truncated": truncated, "scanned_bytes": scanned, "records": records}
+
+    def _query_jsonl(self, day, data_file, start, end, banner_id, user_id, limit, records) -> int:
+        """Дописывает в records подходящие записи дня (не больше limit + 1). Возвращает прочитанные байты."""
+        scanned = 0
+        entry = self._refresh(day)
+        minute_from = start.hour * 60 + start.minute if day == start.date() else 0
+        minute_to = end.hour * 60 + end.minute if day == end.date() else 24 * 60 - 1
+        with open(data_file, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            regions = self._regions(entry, size, minute_from, minute_to, banner_id) if size else []
+            if not regions:
+                return 0
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                for region_start, region_end in regions:
+                    chunk = mm[region_start:region_end]
+                    scanned += len(chunk)
+                    for line in chunk.split(b"\n"):
+                        record = self._match(line, start, end, banner_id, user_id)
+                        if record is not None:
+                            records.append(record)
+                            if len(records) > limit:
+                                return scanned
+        return scanned
+
+    def _query_columnar(self, columnar_file, start, end, banner_id, user_id, limit, records) -> int:
+        """То же для колоночного файла: фильтры по колонкам времени и кодам словаря,
+        записи целиком собираются только для подошедших строк."""
+        cf = ColumnarFile(columnar_file)
+        rows = range(cf.rows)
+        exact_time = "timestamp" in cf.columns and cf.column_type("timestamp") == "ts"
+        if exact_time:
+            micro = datetime.timedelta(microseconds=1)
+            low, high = (start - _COLUMNAR_EPOCH_UTC) // micro, (end - _COLUMNAR_EPOCH_UTC) // micro
+            micros = cf.numbers("timestamp")
+            rows = [row for row in rows if low <= micros[row] <= high]
+        for name, wanted in (("banner_id", banner_id), ("user_id", user_id)):
+            if wanted is None:
+                continue
+            if name not in cf.columns:
+                return cf.bytes_read
+            if cf.column_type(name) == "dict":
+                dictionary, codes = cf.codes(name)
+                targets = {code for code, value in enumerate(dictionary) if code and str(value) == wanted}
+                rows = [row for row in rows if codes[row] in targets]
+            else:
+                values = cf.column(name)
+                rows = [row for row in rows if str(values[row]) == wanted]
+        for record in cf.scan(rows=rows):
+            if exact_time or self._accept(record, start, end, banner_id, user_id):
+                records.append(record)
+                if len(records) > limit:
+                    break
+        return cf.bytes_read
+
+    @classmethod
+    def _match(cls, line: bytes, start, end, banner_id, user_id) -> Optional[dict]:
+        if not line.strip():
+            return None
         try:
-            form = await request.form()
-            if not banner_id:
-                banner_id = form.get("banner_id") or form.get("bannerId")
-            if not user_id:
-                user_id = form.get("user_id") or form.get("userId")
-            for k in form.keys():
-                if k not in ("banner_id", "bannerId", "user_id", "userId"):
-                    extra[k] = form.get(k)
-        except Exception:
-            pass
+            record = json_loads(line)
+        except ValueError:
+            return None  # оборванная строка на границе участка или повреждённая запись
+        return record if cls._accept(record, start, end, banner_id, user_id) else None
 
-    # 3) query params (fallback)
-    params = dict(request.query_params)
-    if not banner_id:
-        banner_id = params.get("banner_id") or params.get("bannerId")
-    if not user_id:
-        user_id = params.get("user_id") or params.get("userId")
-    # добавим query params в extra (необязательно)
-    for k, v in params.items():
-        if k not in ("banner_id", "bannerId", "user_id", "userId"):
-            extra.setdefault(k, v)
+    @staticmethod
+    def _accept(record, start, end, banner_id, user_id) -> bool:
+        try:
+            ts = datetime.datetime.fromisoformat(record["timestamp"])
+        except (ValueError, KeyError, TypeError):
+            return False
+        if not start <= ts <= end:
+            return False
+        if banner_id is not None and str(record.get("banner_id")) != banner_id:
+            return False
+        if user_id is not None and str(record.get("user_id")) != user_id:
+            return False
+        return True
 
-    # Валидация
-    if not banner_id or not user_id:
-        logging.warning(f"Пропущен traffic_bh постбэк: banner_id={banner_id}, user_id={user_id}")
-        return {"status": "error", "message": "banner_id and user_id are required"}, 400
 
-    # Сохраняем
-    try:
-        append_traffic_record(str(banner_id), str(user_id), extra if extra else None)
-    except Exception as e:
-        # логируем ошибку и возвращаем 500
-        logging.exception(f"Не удалось сохранить traffic_bh запись: {e}")
-        return {"status": "error", "message": "failed to save record"}, 500
+traffic_index = TrafficIndex(TRAFFIC_INDEX_MAX_DAYS)
+
+
+def _parse_query_datetime(value: str) -> datetime.datetime:
+    """Момент из query (ISO 8601); без часового пояса — время сервера."""
+    return datetime.datetime.fromisoformat(value).astimezone()
+
+
+@app.get("/traffic_bh/query")
+async def query_traffic_bh(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    banner_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    limit: int = 1000,
+):
+    """
+    Записи traffic_bh за период с фильтром по banner_id и user_id.
+    - start/end: ISO 8601 (2026-10-17T10:00 или с часовым поясом); по умолчанию — с начала
+      сегодняшнего дня до текущего момента. Без часового пояса — время сервера.
+    - limit: не больше 100000 записей; truncated=true, если подошло больше.
+    """
+    try:
+        now = datetime.datetime.now().astimezone()
+        start_at = _parse_query_datetime(start) if start else now.replace(hour=0, minute=0, second=0, microsecond=0)
+        end_at = _parse_query_datetime(end) if end else now
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": f"bad datetime: {e}"}, status_code=400)
+
+    if start_at > end_at:
+        return JSONResponse({"status": "error", "message": "start is after end"}, status_code=400)
+    if (end_at.date() - start_at.date()).days >= TRAFFIC_QUERY_MAX_DAYS:
+        return JSONResponse(
+            {"status": "error", "message": f"period is longer than {TRAFFIC_QUERY_MAX_DAYS} days"}, status_code=400
+        )
+    if not 1 <= limit <= TRAFFIC_QUERY_MAX_LIMIT:
+        return JSONResponse(
+            {"status": "error", "message": f"limit must be between 1 and {TRAFFIC_QUERY_MAX_LIMIT}"}, status_code=400
+        )
+
+    result = await asyncio.to_thread(traffic_index.query, start_at, end_at, banner_id, user_id, limit)
+    return {"status": "ok", **result}
+
 
-    return {"status": "ok"}
 # --- /TRAFFIC_BH end ---
 
 
@@ -345,25 +3055,67 @@ async def receive_traffic_bh(request: Request):
 AB_TEST_DIR = DATA_DIR / "ab_test"
 AB_TEST_DIR.mkdir(parents=True, exist_ok=True)
 
-# Счётчики для round-robin распределения веток (потокобезопасные)
-# Ключ: "account_name:count" — отдельный счётчик для каждой комбинации
-_branch_counters: dict[str, int] = {}
-_branch_lock = threading.Lock()
+# Счётчики для round-robin распределения веток.
+# Хранятся в SQLite (AB_BRANCH_COUNTERS_FILE), поэтому общие для всех воркеров uvicorn
+# и переживают перезапуск. Ключ: "account_name:count" — отдельный счётчик для каждой комбинации
+AB_BRANCH_COUNTERS_FILE = Path(os.getenv("AB_BRANCH_COUNTERS_FILE", str(AB_TEST_DIR / "branch_counters.sqlite3")))
+
+
+class BranchCounterStore:
+    """Атомарные счётчики в SQLite: инкремент и чтение в одной транзакции BEGIN IMMEDIATE,
+    которая берёт блокировку записи на всю БД — между процессами тоже."""
+
+    def __init__(self, db_file: Path):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS branch_counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def increment(self, key: str) -> int:
+        """Увеличивает счётчик и возвращает его прежнее значение (0 для нового ключа)."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO branch_counters (key, value) VALUES (?, 1) "
+                "ON CONFLICT (key) DO UPDATE SET value = value + 1",
+                (key,),
+            )
+            value = conn.execute("SELECT value FROM branch_counters WHERE key = ?", (key,)).fetchone()[0]
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return value - 1
+
+    def values(self) -> dict:
+        return dict(self._connect().execute("SELECT key, value FROM branch_counters ORDER BY key"))
+
+
+branch_counters = BranchCounterStore(AB_BRANCH_COUNTERS_FILE)
 
 
-def _get_ab_test_file(account_name: str) -> Path:
-    """Возвращает путь к файлу для конкретного аккаунта."""
+def _ab_account_key(account_name: str) -> str:
+    """Безопасное имя аккаунта (имя файла / ключ в БД)."""
     # Очищаем имя от потенциально опасных символов
     safe_name = "".join(c for c in account_name if c.isalnum() or c in ("_", "-"))
-    if not safe_name:
-        safe_name = "default"
-    return AB_TEST_DIR / f"{safe_name}.json"
+    return safe_name or "default"
 
 
 def _get_next_branch(account_name: str, count: int) -> int:
     """
     Возвращает следующую ветку для round-robin распределения.
-    Потокобезопасно.
+    Безопасно для потоков и процессов (см. BranchCounterStore).
     
     Счётчик хранится отдельно для каждой комбинации account_name + count,
     чтобы при смене count распределение начиналось заново с ветки 1.
@@ -371,11 +3123,8 @@ def _get_next_branch(account_name: str, count: int) -> int:
     # Ключ включает count, чтобы при смене количества веток счёт начинался заново
     counter_key = f"{account_name}:{count}"
     
-    with _branch_lock:
-        current = _branch_counters.get(counter_key, 0)
-        next_branch = (current % count) + 1  # Ветки от 1 до count
-        _branch_counters[counter_key] = current + 1
-        return next_branch
+    current = branch_counters.increment(counter_key)
+    return (current % count) + 1  # Ветки от 1 до count
 
 
 # Часовой пояс UTC+4
@@ -405,22 +3154,33 @@ def _load_ab_data(file_path: Path) -> dict:
             "total_users": 100,
             "by_branch": {1: 50, 2: 50},
             "by_step": {"0": 100, "1": 80, "2.1": 30, "2.2": 25}
-        }
+        },
+        "cold": {"users": 10, "segments": ["seg_000000.jsonl"], "next": 1, "checked_at": 0}
     }
+    "cold" — холодные пользователи (см. AbColdTier); в users их нет, в stats они учтены.
     """
     if file_path.exists():
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(file_path, "rb") as f:
+                raw = f.read()
+            metrics.add_bytes("ab_test", "read", len(raw))
+            return json_loads(raw)
         except json.JSONDecodeError:
             logging.warning(f"Файл {file_path} повреждён, пересоздаём.")
     return {"users": {}, "stats": {"total_users": 0, "by_branch": {}, "by_step": {}}}
 
 
 def _save_ab_data(file_path: Path, data: dict) -> None:
-    """Сохраняет данные A/B теста."""
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    """Сохраняет данные A/B теста (атомарно: tmp + rename)."""
+    payload = json_dumps_bytes(data, JSON_INDENT)
+    tmp_file = file_path.with_name(file_path.name + ".tmp")
+    with open(tmp_file, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, file_path)
+    _fsync_dir(file_path.parent)
+    metrics.add_bytes("ab_test", "write", len(payload))
 
 
 def _update_stats(data: dict) -> None:
@@ -428,13 +3188,14 @@ def _update_stats(data: dict) -> None:
     users = data.get("users", {})
     
     total_users = len(users)
-    by_branch: dict[int, int] = {}
+    # Ключи строковые — так же, как после чтения из JSON
+    by_branch: dict[str, int] = {}
     by_step: dict[str, int] = {}
     
     for user_data in users.values():
         branch = user_data.get("branch")
         if branch:
-            by_branch[branch] = by_branch.get(branch, 0) + 1
+            by_branch[str(branch)] = by_branch.get(str(branch), 0) + 1
         
         for step_record in user_data.get("steps", []):
             step_key = str(step_record["step"])
@@ -447,6 +3208,1066 @@ def _update_stats(data: dict) -> None:
     }
 
 
+# AB_STATS_VERIFY=1 — после каждого инкрементального обновления сверять статистику
+# с полным пересчётом (O(всех шагов) на событие, только для отладки)
+AB_STATS_VERIFY = os.getenv("AB_STATS_VERIFY", "0") == "1"
+
+
+def _bump_stats(data: dict, step: float, branch: Optional[int] = None, is_new_user: bool = False) -> None:
+    """Инкрементально обновляет статистику: новый шаг и, для нового пользователя, его ветка."""
+    stats = data.get("stats")
+    if not isinstance(stats, dict) or not all(k in stats for k in ("total_users", "by_branch", "by_step")):
+        # Старый или повреждённый блок статистики — один раз пересчитываем целиком
+        _update_stats(data)
+        return
+
+    if is_new_user:
+        stats["total_users"] += 1
+        if branch:
+            by_branch = stats["by_branch"]
+            by_branch[str(branch)] = by_branch.get(str(branch), 0) + 1
+
+    step_key = str(step)
+    by_step = stats["by_step"]
+    by_step[step_key] = by_step.get(step_key, 0) + 1
+
+
+def _verify_stats(data: dict, account_name: str) -> bool:
+    """Сверяет инкрементальную статистику с полным пересчётом; при расхождении исправляет."""
+    actual = data.get("stats")
+    _update_stats(data)
+    if actual == data["stats"]:
+        return True
+    logging.warning(
+        f"[ab_test/{account_name}] Статистика разошлась с пересчётом: "
+        f"было {actual}, пересчитано {data['stats']}"
+    )
+    return False
+
+
+# === Воронка A/B теста ===
+# По каждой ветке хранится: сколько уникальных пользователей дошло до шага (reached),
+# переходы "шаг>шаг" (transitions) и скетч времени до следующего шага (time_to_next).
+# Скетч — логарифмическая гистограмма (как DDSketch): относительная ошибка квантилей
+# не больше FUNNEL_SKETCH_ACCURACY, число корзин ограничено диапазоном
+# [_SKETCH_MIN, _SKETCH_MAX] секунд, поэтому память не зависит от числа пользователей.
+FUNNEL_SKETCH_ACCURACY = float(os.getenv("FUNNEL_SKETCH_ACCURACY", "0.02"))
+_SKETCH_GAMMA = (1 + FUNNEL_SKETCH_ACCURACY) / (1 - FUNNEL_SKETCH_ACCURACY)
+_SKETCH_LOG_GAMMA = math.log(_SKETCH_GAMMA)
+_SKETCH_MIN = 0.01
+_SKETCH_MAX = 1e8
+
+
+def _sketch_key(value: float) -> str:
+    """Корзина скетча для значения (строка — ключ в JSON/БД); "zero" — всё, что меньше _SKETCH_MIN."""
+    if value < _SKETCH_MIN:
+        return "zero"
+    return str(math.ceil(math.log(min(value, _SKETCH_MAX)) / _SKETCH_LOG_GAMMA))
+
+
+def _sketch_quantile(buckets: dict, q: float) -> Optional[float]:
+    """Квантиль по корзинам {ключ: количество}."""
+    total = sum(buckets.values())
+    if not total:
+        return None
+    rank = q * (total - 1)
+    seen = buckets.get("zero", 0)
+    if rank < seen:
+        return 0.0
+    for index in sorted(int(k) for k in buckets if k != "zero"):
+        seen += buckets[str(index)]
+        if rank < seen:
+            return round(2 * _SKETCH_GAMMA ** index / (_SKETCH_GAMMA + 1), 2)
+    return None
+
+
+def _empty_funnel_branch() -> dict:
+    return {"reached": {}, "transitions": {}, "time_to_next": {}}
+
+
+def _funnel_add(
+    funnel: dict,
+    branch: int,
+    prev_step: Optional[float],
+    step: float,
+    time_from_prev: Optional[float],
+    first_visit: bool,
+) -> None:
+    """Учитывает одно событие в воронке."""
+    data = funnel.setdefault("branches", {}).setdefault(str(branch), _empty_funnel_branch())
+    if first_visit:
+        data["reached"][str(step)] = data["reached"].get(str(step), 0) + 1
+    if prev_step is not None:
+        key = f"{prev_step}>{step}"
+        data["transitions"][key] = data["transitions"].get(key, 0) + 1
+        if time_from_prev is not None:
+            buckets = data["time_to_next"].setdefault(str(prev_step), {})
+            bucket = _sketch_key(time_from_prev)
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+
+
+def _build_funnel(data: dict) -> dict:
+    """Полный пересчёт воронки по данным аккаунта (для аккаунтов, созданных до появления воронки)."""
+    funnel = {"branches": {}}
+    for user_data in data.get("users", {}).values():
+        branch = user_data.get("branch", 1)
+        seen = set()
+        prev_step = None
+        for step_record in user_data.get("steps", []):
+            step = step_record["step"]
+            _funnel_add(funnel, branch, prev_step, step, step_record.get("time_from_prev"), step not in seen)
+            seen.add(step)
+            prev_step = step
+    return funnel
+
+
+def _funnel_report(funnel: dict) -> dict:
+    """Конверсия по шагам и p50/p90/p99 времени до следующего шага для каждой ветки."""
+    report = {}
+    for branch, data in sorted(funnel.get("branches", {}).items()):
+        steps = []
+        first_users = prev_users = None
+        for step_key in sorted(data["reached"], key=float):
+            users = data["reached"][step_key]
+            buckets = data["time_to_next"].get(step_key, {})
+            steps.append({
+                "step": step_key,
+                "users": users,
+                "conversion_from_prev": round(users / prev_users, 4) if prev_users else None,
+                "conversion_from_start": round(users / first_users, 4) if first_users else None,
+                "time_to_next": {
+                    "count": sum(buckets.values()),
+                    "p50": _sketch_quantile(buckets, 0.5),
+                    "p90": _sketch_quantile(buckets, 0.9),
+                    "p99": _sketch_quantile(buckets, 0.99),
+                },
+            })
+            if first_users is None:
+                first_users = users
+            prev_users = users
+        report[branch] = {"steps": steps, "transitions": data["transitions"]}
+    return report
+
+
+# === Хранилища A/B теста ===
+# AB_TEST_BACKEND=json   — один JSON-файл на аккаунт (AB_TEST_DIR/<account>.json), как раньше
+# AB_TEST_BACKEND=sqlite — AB_TEST_DIR/ab_test.sqlite3 (WAL), пользователи и шаги
+#                          проиндексированы по (account, user_id); событие трогает только
+#                          строки одного пользователя.
+# Перенос данных между форматами — ab_test_migrate.py.
+AB_TEST_BACKEND = os.getenv("AB_TEST_BACKEND", "json")
+AB_TEST_DB_FILE = AB_TEST_DIR / "ab_test.sqlite3"
+
+# Горячие и холодные пользователи (JSON-хранилище). Событие читает и пишет только горячий
+# файл аккаунта, поэтому его цена зависит от числа активных пользователей, а не от возраста
+# аккаунта. Пользователи в горячем файле упорядочены по последнему событию (LRU); те, кто
+# неактивен дольше AB_COLD_AFTER_DAYS, и самые давние сверх AB_HOT_MAX_USERS уходят
+# в неизменяемые холодные сегменты (проверка не чаще раза в AB_TIER_CHECK_INTERVAL секунд).
+# Холодные пользователи учтены в stats, видны в /traffic_bh/ab_test/user/... и при новом
+# событии возвращаются в горячие. Сегменты разбиты по уровням (size-tiered): когда сегментов
+# одного уровня становится больше AB_COLD_MAX_SEGMENTS, фоновый поток сливает их в один
+# сегмент следующего уровня — событие слияния не ждёт, а каждый пользователь переписывается
+# O(log) раз за жизнь аккаунта, а не при каждом слиянии.
+# Память процесса: разобранные горячие файлы последних AB_CACHE_ACCOUNTS аккаунтов,
+# то есть не больше AB_CACHE_ACCOUNTS * AB_HOT_MAX_USERS пользователей.
+# AB_TIERING=0 — не переносить пользователей (уже холодные остаются доступны).
+# Только для JSON-хранилища: в SQLite (AB_TEST_BACKEND=sqlite) пользователи лежат
+# в индексированных таблицах, событие читает лишь строки своего пользователя, а память
+# ограничена кешем страниц SQLite, поэтому разделение на горячих и холодных там не нужно.
+AB_TIERING = os.getenv("AB_TIERING", "1") == "1"
+AB_HOT_MAX_USERS = int(os.getenv("AB_HOT_MAX_USERS", "50000"))
+AB_COLD_AFTER_DAYS = float(os.getenv("AB_COLD_AFTER_DAYS", "7"))
+AB_TIER_CHECK_INTERVAL = float(os.getenv("AB_TIER_CHECK_INTERVAL", "60"))
+AB_COLD_MAX_SEGMENTS = int(os.getenv("AB_COLD_MAX_SEGMENTS", "8"))
+AB_CACHE_ACCOUNTS = int(os.getenv("AB_CACHE_ACCOUNTS", "16"))
+
+_AB_NEVER_SEEN = datetime.datetime.min.replace(tzinfo=UTC_PLUS_4)
+
+
+def _ab_segment_level(name: str) -> int:
+    """Уровень холодного сегмента: seg_NNNNNN.jsonl — 0, seg_L<уровень>_NNNNNN.jsonl — слитые."""
+    if name.startswith("seg_L"):
+        return int(name[5:].split("_", 1)[0])
+    return 0
+
+
+def _ab_last_seen(user_data: dict) -> datetime.datetime:
+    """Время последнего события пользователя (без пояса — UTC+4, как пишет сервис)."""
+    try:
+        moment = datetime.datetime.fromisoformat(user_data.get("last_seen") or "")
+    except (TypeError, ValueError):
+        return _AB_NEVER_SEEN
+    return moment if moment.tzinfo is not None else moment.replace(tzinfo=UTC_PLUS_4)
+
+
+class AbColdTier:
+    """Холодные пользователи одного аккаунта: неизменяемые сегменты
+    AB_TEST_DIR/cold/<account>/seg_NNNNNN.jsonl. Строка сегмента — "<user_id в JSON>\\t<данные>",
+    строки отсортированы по ключу, поэтому пользователь ищется бинарным поиском по mmap
+    без чтения сегмента целиком. Список сегментов (от старых к новым) хранится в горячем файле;
+    более новый сегмент перекрывает старые.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    @staticmethod
+    def key(user_id: str) -> bytes:
+        return json_dumps(user_id).encode("utf-8")
+
+    @staticmethod
+    def _search(mm, key: bytes) -> Optional[bytes]:
+        lo, hi = 0, len(mm)  # обе границы — начала строк
+        while lo < hi:
+            start = mm.rfind(b"\n", 0, (lo + hi) // 2) + 1
+            end = mm.find(b"\n", start)
+            if end == -1:
+                end = len(mm)
+            tab = mm.find(b"\t", start, end)
+            line_key = mm[start:tab]
+            if line_key == key:
+                return mm[tab + 1:end]
+            if line_key < key:
+                lo = end + 1
+            else:
+                hi = start
+        return None
+
+    def find(self, segments: list, user_id: str) -> Optional[dict]:
+        key = self.key(user_id)
+        for name in reversed(segments):
+            with open(self.directory / name, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if not size:
+                    continue
+                with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                    raw = self._search(mm, key)
+            if raw is not None:
+                metrics.add_bytes("ab_test_cold", "read", len(raw))
+                return json_loads(raw)
+        return None
+
+    def _write(self, name: str, lines) -> int:
+        """Пишет сегмент из уже отсортированных строк (атомарно). Возвращает число строк."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.directory / (name + ".tmp")
+        count = 0
+        with open(tmp_file, "wb") as f:
+            for line in lines:
+                f.write(line)
+                count += 1
+            size = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.directory / name)
+        _fsync_dir(self.directory)
+        metrics.add_bytes("ab_test_cold", "write", size)
+        return count
+
+    def write_segment(self, name: str, users: dict) -> None:
+        lines = sorted(self.key(user_id) + b"\t" + json_dumps_bytes(data) + b"\n" for user_id, data in users.items())
+        self._write(name, lines)
+
+    def _iter_lines(self, index: int, name: str):
+        with open(self.directory / name, "rb") as f:
+            for line in f:
+                yield line[:line.index(b"\t")], -index, line
+
+    def merge(self, segments: list, name: str, hot_users) -> int:
+        """Сливает сегменты в один потоково (k-way merge отсортированных файлов): из копий
+        пользователя остаётся самая новая, пользователи, вернувшиеся в горячие (hot_users —
+        их user_id), выбрасываются. Возвращает число строк нового сегмента."""
+        hot_keys = {self.key(user_id) for user_id in hot_users}
+        streams = [self._iter_lines(index, segment) for index, segment in enumerate(segments)]
+
+        def merged():
+            previous = None
+            for key, _, line in heapq.merge(*streams):
+                if key != previous and key not in hot_keys:
+                    yield line
+                previous = key
+
+        return self._write(name, merged())
+
+    def iter_users(self, segments: list) -> dict:
+        """Все холодные пользователи {user_id: данные} (для экспорта и полных пересчётов)."""
+        users = {}
+        for name in segments:
+            with open(self.directory / name, "rb") as f:
+                for line in f:
+                    key, _, raw = line.rstrip(b"\n").partition(b"\t")
+                    users[json_loads(key)] = json_loads(raw)
+        return users
+
+    def remove(self, names: list) -> None:
+        for name in names:
+            (self.directory / name).unlink(missing_ok=True)
+
+
+class JsonAbSession:
+    """Операции над одним аккаунтом в JSON-хранилище (горячий файл читается и пишется целиком)."""
+
+    def __init__(self, data: dict, funnel_loader=None, cold: Optional[AbColdTier] = None):
+        self.data = data
+        self.generation: Optional[str] = None  # выставляется хранилищем после записи
+        self._funnel_loader = funnel_loader
+        self._cold = cold
+        self.funnel: Optional[dict] = None  # читается только при первом обращении
+
+    def _cold_segments(self) -> list:
+        return self.data.get("cold", {}).get("segments", [])
+
+    def find_user(self, user_id: str) -> Optional[dict]:
+        users = self.data["users"]
+        user_data = users.get(user_id)
+        if user_data is None and self._cold is not None and self._cold_segments():
+            user_data = self._cold.find(self._cold_segments(), user_id)
+            if user_data is not None:
+                # Вернулся холодный пользователь — снова горячий (копия в сегменте устаревает)
+                users[user_id] = user_data
+                self.data["cold"]["users"] -= 1
+        if user_data is None:
+            return None
+        return {
+            "banner_id": user_data.get("banner_id"),
+            "branch": user_data.get("branch", 1),
+            "last_step": user_data["steps"][-1] if user_data.get("steps") else None,
+        }
+
+    def add_user(self, user_id: str, user_data: dict) -> None:
+        self.data["users"][user_id] = user_data
+
+    def append_step(self, user_id: str, step_record: dict, banner_id: str) -> None:
+        users = self.data["users"]
+        user_data = users[user_id] = users.pop(user_id)  # в конец: порядок users — порядок LRU
+        user_data["steps"].append(step_record)
+        user_data["last_seen"] = step_record["timestamp"]
+        if banner_id:
+            user_data["banner_id"] = banner_id
+
+    def has_step(self, user_id: str, step: float) -> bool:
+        return any(r["step"] == step for r in self.data["users"][user_id].get("steps", []))
+
+    def record_funnel(self, branch: int, prev_step, step: float, time_from_prev, first_visit: bool) -> None:
+        if self.funnel is None:
+            self.funnel = self._funnel_loader(self.data)
+        _funnel_add(self.funnel, branch, prev_step, step, time_from_prev, first_visit)
+
+    def bump_stats(self, step: float, branch: Optional[int], is_new_user: bool) -> None:
+        _bump_stats(self.data, step, branch, is_new_user)
+
+    def verify_stats(self, account_name: str) -> bool:
+        if not self._cold_segments():
+            return _verify_stats(self.data, account_name)
+        full = {"users": {**self._cold.iter_users(self._cold_segments()), **self.data["users"]},
+                "stats": self.data.get("stats")}
+        result = _verify_stats(full, account_name)
+        self.data["stats"] = full["stats"]
+        return result
+
+    def users_count(self) -> int:
+        return len(self.data["users"]) + self.data.get("cold", {}).get("users", 0)
+
+    def snapshot(self) -> tuple:
+        """(stats, users_count) после изменений сессии — для кеша статистики."""
+        return copy.deepcopy(self.data["stats"]), self.users_count()
+
+
+class JsonAbStore:
+    """Прежний формат: AB_TEST_DIR/<account>.json — горячие пользователи, статистика по всем
+    и блок "cold" (сегменты холодных пользователей в AB_TEST_DIR/cold/<account>/, их число)."""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        # Разобранные горячие файлы последних аккаунтов: account -> (generation, data)
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._merging: set = set()  # аккаунты, для которых уже запущен поток слияния
+
+    def _file(self, account_name: str) -> Path:
+        return self.directory / f"{_ab_account_key(account_name)}.json"
+
+    def _funnel_file(self, account_name: str) -> Path:
+        return self.directory / "funnel" / f"{_ab_account_key(account_name)}.json"
+
+    def _cold(self, account_name: str) -> AbColdTier:
+        return AbColdTier(self.directory / "cold" / _ab_account_key(account_name))
+
+    def _load(self, account_name: str) -> dict:
+        """Горячий файл аккаунта: из кеша, если файл не менялся с нашей записи, иначе с диска.
+        Вызывающий не должен менять результат вне сессии."""
+        key = _ab_account_key(account_name)
+        generation = self.generation(account_name)
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == generation and generation is not None:
+                self._cache.move_to_end(key)
+                return cached[1]
+        return _load_ab_data(self._file(account_name))
+
+    def _remember(self, account_name: str, generation: Optional[str], data: dict) -> None:
+        if generation is None or AB_CACHE_ACCOUNTS <= 0:
+            return
+        with self._cache_lock:
+            self._cache[_ab_account_key(account_name)] = (generation, data)
+            self._cache.move_to_end(_ab_account_key(account_name))
+            while len(self._cache) > AB_CACHE_ACCOUNTS:
+                self._cache.popitem(last=False)
+
+    def _forget(self, account_name: str) -> None:
+        with self._cache_lock:
+            self._cache.pop(_ab_account_key(account_name), None)
+
+    def _full_data(self, account_name: str, data: dict) -> dict:
+        """Данные со всеми пользователями (холодные + горячие) в прежней структуре."""
+        segments = data.get("cold", {}).get("segments", [])
+        if not segments:
+            return data
+        users = self._cold(account_name).iter_users(segments)
+        users.update(data.get("users", {}))
+        return {"users": users, "stats": data.get("stats", {})}
+
+    def _load_funnel(self, account_name: str, data: dict) -> dict:
+        funnel_file = self._funnel_file(account_name)
+        if funnel_file.exists():
+            try:
+                with open(funnel_file, "rb") as f:
+                    raw = f.read()
+                metrics.add_bytes("ab_test_funnel", "read", len(raw))
+                return json_loads(raw)
+            except json.JSONDecodeError:
+                logging.warning(f"Файл {funnel_file} повреждён, пересчитываем воронку.")
+        # Воронки ещё нет (аккаунт создан раньше) — один раз считаем по всем пользователям
+        return _build_funnel(self._full_data(account_name, data))
+
+    def _save_funnel(self, account_name: str, funnel: dict) -> None:
+        funnel_file = self._funnel_file(account_name)
+        funnel_file.parent.mkdir(exist_ok=True)
+        payload = json_dumps_bytes(funnel)
+        tmp_file = funnel_file.with_name(funnel_file.name + ".tmp")
+        with open(tmp_file, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, funnel_file)
+        _fsync_dir(funnel_file.parent)
+        metrics.add_bytes("ab_test_funnel", "write", len(payload))
+
+    def _tier(self, account_name: str, data: dict) -> None:
+        """Переносит в новый холодный сегмент (уровня 0) пользователей, неактивных дольше
+        AB_COLD_AFTER_DAYS, и самых давних сверх AB_HOT_MAX_USERS."""
+        users = data["users"]
+        cold = data.get("cold")
+        if cold is None:
+            # Файл до разделения на горячих и холодных: один раз упорядочиваем по last_seen
+            cold = data["cold"] = {"users": 0, "segments": [], "next": 0, "checked_at": 0}
+            data["users"] = users = dict(sorted(users.items(), key=lambda item: _ab_last_seen(item[1])))
+        now = time.time()
+        if len(users) <= AB_HOT_MAX_USERS and now - cold["checked_at"] < AB_TIER_CHECK_INTERVAL:
+            return
+        cold["checked_at"] = now
+
+        cutoff = datetime.datetime.now(UTC_PLUS_4) - datetime.timedelta(days=AB_COLD_AFTER_DAYS)
+        evicted = {}
+        for user_id, user_data in users.items():
+            if len(users) - len(evicted) <= AB_HOT_MAX_USERS and _ab_last_seen(user_data) >= cutoff:
+                break  # дальше только более свежие
+            evicted[user_id] = user_data
+        if not evicted:
+            return
+        for user_id in evicted:
+            del users[user_id]
+
+        name = f"seg_{cold['next']:06d}.jsonl"
+        cold["next"] += 1
+        self._cold(account_name).write_segment(name, evicted)
+        cold["segments"].append(name)
+        cold["users"] += len(evicted)
+        logging.info(f"[ab_test/{account_name}] В холодный сегмент {name}: {len(evicted)} пользователей")
+
+    @staticmethod
+    def _merge_plan(cold: Optional[dict]) -> Optional[list]:
+        """Сегменты самого низкого переполненного уровня (или None). Уровни в списке не растут
+        от старых к новым, поэтому сегменты одного уровня идут подряд."""
+        by_level: dict[int, list] = {}
+        for name in (cold or {}).get("segments", []):
+            by_level.setdefault(_ab_segment_level(name), []).append(name)
+        for level in sorted(by_level):
+            if len(by_level[level]) > AB_COLD_MAX_SEGMENTS:
+                return by_level[level]
+        return None
+
+    def _schedule_merge(self, account_name: str) -> None:
+        key = _ab_account_key(account_name)
+        with self._cache_lock:
+            if key in self._merging:
+                return
+            self._merging.add(key)
+        threading.Thread(target=self._merge_cold, args=(account_name,), name="ab-cold-merge", daemon=True).start()
+
+    def _merge_cold(self, account_name: str) -> None:
+        """Фоновое слияние холодных сегментов аккаунта, пока есть переполненный уровень.
+        Сливаются неизменяемые файлы без блокировки аккаунта; под ней только подменяется
+        список сегментов. Число холодных пользователей слияние не меняет."""
+        file_path = self._file(account_name)
+        tier = self._cold(account_name)
+        try:
+            # Одно слияние аккаунта за раз и между воркерами
+            with file_lock(tier.directory):
+                while True:
+                    data = _load_ab_data(file_path)
+                    plan = self._merge_plan(data.get("cold"))
+                    if plan is None:
+                        return
+                    number = plan[0].rsplit("_", 1)[1]
+                    name = f"seg_L{_ab_segment_level(plan[0]) + 1}_{number}"
+                    # Копии пользователей, горячих сейчас, устарели; кто станет горячим позже,
+                    # перекрыт горячим файлом, а кто успеет снова остыть — более новым сегментом
+                    count = tier.merge(plan, name, data["users"])
+
+                    with file_lock(file_path):
+                        data = self._load(account_name)
+                        self._forget(account_name)
+                        segments = data.get("cold", {}).get("segments", [])
+                        start = segments.index(plan[0]) if plan[0] in segments else -1
+                        if start < 0 or segments[start:start + len(plan)] != plan:
+                            tier.remove([name])  # аккаунт переимпортирован, пока сливали
+                            return
+                        data["cold"]["segments"] = segments[:start] + [name] + segments[start + len(plan):]
+                        _save_ab_data(file_path, data)
+                        self._remember(account_name, self.generation(account_name), data)
+                    tier.remove(plan)
+                    logging.info(f"[ab_test/{account_name}] Слито сегментов: {len(plan)} -> {name} ({count} строк)")
+        except Exception as e:
+            logging.exception(f"[ab_test/{account_name}] Не удалось слить холодные сегменты: {e}")
+        finally:
+            with self._cache_lock:
+                self._merging.discard(_ab_account_key(account_name))
+
+    @contextmanager
+    def session(self, account_name: str):
+        file_path = self._file(account_name)
+        # Вся сессия (чтение, изменения, запись горячего файла, сегментов и воронки) — под
+        # блокировкой аккаунта, поэтому события одного аккаунта из разных воркеров не теряются
+        with file_lock(file_path):
+            # Сессия меняет данные на месте: из кеша забираем, обратно кладём после записи
+            data = self._load(account_name)
+            self._forget(account_name)
+            session = JsonAbSession(data, lambda d: self._load_funnel(account_name, d), self._cold(account_name))
+            if not self._funnel_file(account_name).exists():
+                # Воронку по старым данным считаем до изменений сессии, иначе событие учтётся дважды
+                session.funnel = _build_funnel(self._full_data(account_name, data))
+            yield session
+            if AB_TIERING:
+                self._tier(account_name, data)
+            _save_ab_data(file_path, data)
+            if session.funnel is not None:
+                self._save_funnel(account_name, session.funnel)
+            session.generation = self.generation(account_name)
+            self._remember(account_name, session.generation, data)
+        if AB_TIERING and self._merge_plan(data.get("cold")) is not None:
+            self._schedule_merge(account_name)
+
+    def get_funnel(self, account_name: str) -> Optional[dict]:
+        if not self.exists(account_name):
+            return None
+        funnel_file = self._funnel_file(account_name)
+        if funnel_file.exists():
+            return self._load_funnel(account_name, {})
+        with file_lock(self._file(account_name)):
+            if funnel_file.exists():  # пока ждали блокировку, собрал другой воркер
+                return self._load_funnel(account_name, {})
+            funnel = _build_funnel(self._full_data(account_name, self._load(account_name)))
+            self._save_funnel(account_name, funnel)
+        return funnel
+
+    def exists(self, account_name: str) -> bool:
+        return self._file(account_name).exists()
+
+    def generation(self, account_name: str) -> Optional[str]:
+        """Версия данных аккаунта: меняется при каждой записи файла. None — аккаунта нет."""
+        try:
+            st = self._file(account_name).stat()
+        except FileNotFoundError:
+            return None
+        return f"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"
+
+    def accounts(self) -> list:
+        return sorted(p.stem for p in self.directory.glob("*.json"))
+
+    def get_stats(self, account_name: str) -> Optional[tuple]:
+        """(stats, users_count) или None, если аккаунта нет."""
+        if not self.exists(account_name):
+            return None
+        data = self._load(account_name)
+        return copy.deepcopy(data.get("stats", {})), len(data.get("users", {})) + data.get("cold", {}).get("users", 0)
+
+    def get_user(self, account_name: str, user_id: str) -> Optional[dict]:
+        if not self.exists(account_name):
+            return None
+        # Разделяемая блокировка: сегменты, перечисленные в горячем файле, не удалит слияние
+        with file_lock(self._file(account_name), shared=True):
+            data = self._load(account_name)
+            user_data = data.get("users", {}).get(user_id)
+            segments = data.get("cold", {}).get("segments", [])
+            if user_data is None and segments:
+                user_data = self._cold(account_name).find(segments, user_id)
+            return copy.deepcopy(user_data)
+
+    def export_account(self, account_name: str) -> dict:
+        """Все пользователи (горячие и холодные) в прежней структуре users + stats."""
+        with file_lock(self._file(account_name), shared=True):
+            data = self._full_data(account_name, self._load(account_name))
+            return copy.deepcopy({"users": data.get("users", {}), "stats": data.get("stats", {})})
+
+    def import_account(self, account_name: str, data: dict) -> None:
+        with file_lock(self._file(account_name)):
+            self._forget(account_name)
+            old_segments = _load_ab_data(self._file(account_name)).get("cold", {}).get("segments", [])
+            # Все пользователи — горячие; холодные отделятся при следующем событии
+            _save_ab_data(self._file(account_name), {key: value for key, value in data.items() if key != "cold"})
+            self._cold(account_name).remove(old_segments)
+            self._save_funnel(account_name, _build_funnel(data))
+
+
+_AB_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    account TEXT PRIMARY KEY,
+    total_users INTEGER NOT NULL DEFAULT 0,
+    generation INTEGER NOT NULL DEFAULT 0,
+    -- 1 — таблица funnel учитывает всех пользователей аккаунта (см. SqliteAbStore._ensure_funnel)
+    funnel_built INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    banner_id TEXT,
+    branch INTEGER,
+    first_seen TEXT,
+    last_seen TEXT,
+    UNIQUE (account, user_id)
+);
+-- step без типа: 0 и 0.0 хранятся как пришли, чтобы экспорт совпадал с JSON
+CREATE TABLE IF NOT EXISTS steps (
+    user_pk INTEGER NOT NULL REFERENCES users (id),
+    seq INTEGER NOT NULL,
+    step,
+    timestamp TEXT,
+    time_from_prev REAL,
+    PRIMARY KEY (user_pk, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stats (
+    id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (account, kind, key)
+);
+-- kind: reached (key — шаг), transition ("шаг>шаг"), time_to_next ("шаг|корзина")
+CREATE TABLE IF NOT EXISTS funnel (
+    account TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (account, branch, kind, key)
+) WITHOUT ROWID;
+"""
+
+
+class SqliteAbSession:
+    """Операции над одним аккаунтом внутри транзакции SQLite."""
+
+    def __init__(self, conn: sqlite3.Connection, account: str):
+        self.conn = conn
+        self.account = account
+        self._user_pk: dict[str, int] = {}
+        self.generation: Optional[str] = None  # выставляется хранилищем перед COMMIT
+
+    def find_user(self, user_id: str) -> Optional[dict]:
+        row = self.conn.execute(
+            "SELECT id, banner_id, branch FROM users WHERE account = ? AND user_id = ?",
+            (self.account, user_id),
+        ).fetchone()
+        if row is None:
+            return None
+        self._user_pk[user_id] = row[0]
+        last = self.conn.execute(
+            "SELECT seq, step, timestamp, time_from_prev FROM steps WHERE user_pk = ? ORDER BY seq DESC LIMIT 1",
+            (row[0],),
+        ).fetchone()
+        last_step = None
+        if last is not None:
+            last_step = {"seq": last[0], "step": last[1], "timestamp": last[2], "time_from_prev": last[3]}
+        return {"banner_id": row[1], "branch": row[2] if row[2] is not None else 1, "last_step": last_step}
+
+    def add_user(self, user_id: str, user_data: dict) -> None:
+        self.conn.execute("INSERT OR IGNORE INTO accounts (account) VALUES (?)", (self.account,))
+        cur = self.conn.execute(
+            "INSERT INTO users (account, user_id, banner_id, branch, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.account, user_id, user_data.get("banner_id"), user_data.get("branch"),
+             user_data.get("first_seen"), user_data.get("last_seen")),
+        )
+        self._user_pk[user_id] = cur.lastrowid
+        self.conn.executemany(
+            "INSERT INTO steps (user_pk, seq, step, timestamp, time_from_prev) VALUES (?, ?, ?, ?, ?)",
+            [(cur.lastrowid, seq, r["step"], r.get("timestamp"), r.get("time_from_prev"))
+             for seq, r in enumerate(user_data.get("steps", []))],
+        )
+
+    def append_step(self, user_id: str, step_record: dict, banner_id: str) -> None:
+        user_pk = self._user_pk.get(user_id)
+        if user_pk is None:
+            self.find_user(user_id)
+            user_pk = self._user_pk[user_id]
+        self.conn.execute(
+            "INSERT INTO steps (user_pk, seq, step, timestamp, time_from_prev) "
+            "SELECT ?, COALESCE(MAX(seq), -1) + 1, ?, ?, ? FROM steps WHERE user_pk = ?",
+            (user_pk, step_record["step"], step_record["timestamp"], step_record["time_from_prev"], user_pk),
+        )
+        self.conn.execute(
+            "UPDATE users SET last_seen = ?, banner_id = COALESCE(NULLIF(?, ''), banner_id) WHERE id = ?",
+            (step_record["timestamp"], banner_id, user_pk),
+        )
+
+    def has_step(self, user_id: str, step: float) -> bool:
+        if user_id not in self._user_pk:
+            self.find_user(user_id)
+        return self.conn.execute(
+            "SELECT 1 FROM steps WHERE user_pk = ? AND step = ? LIMIT 1", (self._user_pk[user_id], step)
+        ).fetchone() is not None
+
+    def record_funnel(self, branch: int, prev_step, step: float, time_from_prev, first_visit: bool) -> None:
+        delta = {"branches": {}}
+        _funnel_add(delta, branch, prev_step, step, time_from_prev, first_visit)
+        SqliteAbStore.add_funnel(self.conn, self.account, delta)
+
+    def _incr(self, kind: str, key: str) -> None:
+        self.conn.execute(
+            "INSERT INTO stats (account, kind, key, value) VALUES (?, ?, ?, 1) "
+            "ON CONFLICT (account, kind, key) DO UPDATE SET value = value + 1",
+            (self.account, kind, key),
+        )
+
+    def bump_stats(self, step: float, branch: Optional[int], is_new_user: bool) -> None:
+        if is_new_user:
+            self.conn.execute("UPDATE accounts SET total_users = total_users + 1 WHERE account = ?", (self.account,))
+            if branch:
+                self._incr("branch", str(branch))
+        self._incr("step", str(step))
+
+    def stats(self) -> dict:
+        return SqliteAbStore.read_stats(self.conn, self.account)
+
+    def snapshot(self) -> tuple:
+        """(stats, users_count) после изменений сессии — для кеша статистики."""
+        users_count = self.conn.execute(
+            "SELECT COUNT(*) FROM users WHERE account = ?", (self.account,)
+        ).fetchone()[0]
+        return self.stats(), users_count
+
+    def verify_stats(self, account_name: str) -> bool:
+        """Сверка с полным пересчётом по таблицам users/steps; при расхождении исправляет."""
+        actual = self.stats()
+        expected = {"total_users": 0, "by_branch": {}, "by_step": {}}
+        expected["total_users"] = self.conn.execute(
+            "SELECT COUNT(*) FROM users WHERE account = ?", (self.account,)
+        ).fetchone()[0]
+        for branch, n in self.conn.execute(
+            "SELECT branch, COUNT(*) FROM users WHERE account = ? AND branch GROUP BY branch", (self.account,)
+        ):
+            expected["by_branch"][str(branch)] = n
+        for step, n in self.conn.execute(
+            "SELECT s.step, COUNT(*) FROM steps s JOIN users u ON u.id = s.user_pk "
+            "WHERE u.account = ? GROUP BY s.step", (self.account,)
+        ):
+            expected["by_step"][str(step)] = n
+
+        if actual == expected:
+            return True
+        logging.warning(
+            f"[ab_test/{account_name}] Статистика разошлась с пересчётом: было {actual}, пересчитано {expected}"
+        )
+        self.conn.execute("UPDATE accounts SET total_users = ? WHERE account = ?",
+                          (expected["total_users"], self.account))
+        self.conn.execute("DELETE FROM stats WHERE account = ?", (self.account,))
+        for kind, values in (("branch", expected["by_branch"]), ("step", expected["by_step"])):
+            for key, n in values.items():
+                self.conn.execute("INSERT INTO stats (account, kind, key, value) VALUES (?, ?, ?, ?)",
+                                  (self.account, kind, key, n))
+        return False
+
+
+class SqliteAbStore:
+    """SQLite в режиме WAL; одно соединение на поток."""
+
+    def __init__(self, db_file: Path):
+        self.db_file = db_file
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(_AB_SQLITE_SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(accounts)")}
+            if "generation" not in columns:
+                conn.execute("ALTER TABLE accounts ADD COLUMN generation INTEGER NOT NULL DEFAULT 0")
+            if "funnel_built" not in columns:
+                conn.execute("ALTER TABLE accounts ADD COLUMN funnel_built INTEGER NOT NULL DEFAULT 0")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def session(self, account_name: str):
+        conn = self._connect()
+        account = _ab_account_key(account_name)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._ensure_funnel(conn, account)
+            session = SqliteAbSession(conn, account)
+            yield session
+            # Каждая сессия — запись: поднимаем версию аккаунта в той же транзакции
+            conn.execute("INSERT OR IGNORE INTO accounts (account) VALUES (?)", (account,))
+            conn.execute("UPDATE accounts SET generation = generation + 1 WHERE account = ?", (account,))
+            session.generation = str(self.generation(account))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _ensure_funnel(self, conn: sqlite3.Connection, account: str) -> None:
+        """В начале сессии записи: новый аккаунт сразу помечается funnel_built, у аккаунта,
+        созданного до появления воронки, она один раз пересчитывается по всем пользователям
+        (до изменений сессии, иначе её событие учлось бы дважды). Признак — явный флаг,
+        а не пустота таблицы: дельты событий после обновления её уже заполняют."""
+        row = conn.execute("SELECT funnel_built FROM accounts WHERE account = ?", (account,)).fetchone()
+        if row is None:
+            conn.execute("INSERT INTO accounts (account, funnel_built) VALUES (?, 1)", (account,))
+            return
+        if row[0]:
+            return
+        conn.execute("DELETE FROM funnel WHERE account = ?", (account,))
+        self.add_funnel(conn, account, _build_funnel(self.export_account(account)))
+        conn.execute("UPDATE accounts SET funnel_built = 1 WHERE account = ?", (account,))
+        logging.info(f"[ab_test/{account}] Воронка пересчитана по всем пользователям")
+
+    def exists(self, account_name: str) -> bool:
+        return self._connect().execute(
+            "SELECT 1 FROM accounts WHERE account = ?", (_ab_account_key(account_name),)
+        ).fetchone() is not None
+
+    def accounts(self) -> list:
+        return [row[0] for row in self._connect().execute("SELECT account FROM accounts ORDER BY account")]
+
+    def generation(self, account_name: str) -> Optional[str]:
+        """Версия данных аккаунта (растёт с каждой сессией записи). None — аккаунта нет."""
+        row = self._connect().execute(
+            "SELECT generation FROM accounts WHERE account = ?", (_ab_account_key(account_name),)
+        ).fetchone()
+        return str(row[0]) if row else None
+
+    @staticmethod
+    def read_stats(conn: sqlite3.Connection, account: str) -> dict:
+        row = conn.execute("SELECT total_users FROM accounts WHERE account = ?", (account,)).fetchone()
+        stats = {"total_users": row[0] if row else 0, "by_branch": {}, "by_step": {}}
+        for kind, key, value in conn.execute(
+            "SELECT kind, key, value FROM stats WHERE account = ? ORDER BY id", (account,)
+        ):
+            stats["by_branch" if kind == "branch" else "by_step"][key] = value
+        return stats
+
+    @staticmethod
+    def add_funnel(conn: sqlite3.Connection, account: str, funnel: dict) -> None:
+        """Прибавляет значения воронки (в формате _funnel_add) к таблице funnel."""
+        rows = []
+        for branch, data in funnel.get("branches", {}).items():
+            for step_key, n in data["reached"].items():
+                rows.append((account, branch, "reached", step_key, n))
+            for key, n in data["transitions"].items():
+                rows.append((account, branch, "transition", key, n))
+            for step_key, buckets in data["time_to_next"].items():
+                for bucket, n in buckets.items():
+                    rows.append((account, branch, "time_to_next", f"{step_key}|{bucket}", n))
+        conn.executemany(
+            "INSERT INTO funnel (account, branch, kind, key, value) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (account, branch, kind, key) DO UPDATE SET value = value + excluded.value",
+            rows,
+        )
+
+    def get_funnel(self, account_name: str) -> Optional[dict]:
+        if not self.exists(account_name):
+            return None
+        account = _ab_account_key(account_name)
+        conn = self._connect()
+        built = conn.execute("SELECT funnel_built FROM accounts WHERE account = ?", (account,)).fetchone()
+        if not built[0]:
+            # Аккаунт создан раньше воронки — пересчёт в пустой сессии записи
+            with self.session(account):
+                pass
+        rows = conn.execute("SELECT branch, kind, key, value FROM funnel WHERE account = ?", (account,)).fetchall()
+
+        funnel = {"branches": {}}
+        for branch, kind, key, value in rows:
+            data = funnel["branches"].setdefault(branch, _empty_funnel_branch())
+            if kind == "reached":
+                data["reached"][key] = value
+            elif kind == "transition":
+                data["transitions"][key] = value
+            else:
+                step_key, bucket = key.rsplit("|", 1)
+                data["time_to_next"].setdefault(step_key, {})[bucket] = value
+        return funnel
+
+    def get_stats(self, account_name: str) -> Optional[tuple]:
+        if not self.exists(account_name):
+            return None
+        account = _ab_account_key(account_name)
+        conn = self._connect()
+        users_count = conn.execute("SELECT COUNT(*) FROM users WHERE account = ?", (account,)).fetchone()[0]
+        return self.read_stats(conn, account), users_count
+
+    @staticmethod
+    def _user_dict(conn: sqlite3.Connection, row: tuple) -> dict:
+        user_pk, banner_id, branch, first_seen, last_seen = row
+        steps = [
+            {"step": step, "timestamp": ts, "time_from_prev": tfp}
+            for step, ts, tfp in conn.execute(
+                "SELECT step, timestamp, time_from_prev FROM steps WHERE user_pk = ? ORDER BY seq", (user_pk,)
+            )
+        ]
+        return {"banner_id": banner_id, "branch": branch, "steps": steps,
+                "first_seen": first_seen, "last_seen": last_seen}
+
+    def get_user(self, account_name: str, user_id: str) -> Optional[dict]:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT id, banner_id, branch, first_seen, last_seen FROM users WHERE account = ? AND user_id = ?",
+            (_ab_account_key(account_name), user_id),
+        ).fetchone()
+        return self._user_dict(conn, row) if row else None
+
+    def export_account(self, account_name: str) -> dict:
+        """Данные аккаунта в прежней JSON-структуре (см. _load_ab_data)."""
+        account = _ab_account_key(account_name)
+        conn = self._connect()
+        users = {}
+        for row in conn.execute(
+            "SELECT user_id, id, banner_id, branch, first_seen, last_seen FROM users WHERE account = ? ORDER BY id",
+            (account,),
+        ).fetchall():
+            users[row[0]] = self._user_dict(conn, row[1:])
+        return {"users": users, "stats": self.read_stats(conn, account)}
+
+    def import_account(self, account_name: str, data: dict) -> None:
+        """Заменяет данные аккаунта содержимым JSON-структуры."""
+        account = _ab_account_key(account_name)
+        with self.session(account) as session:
+            conn = session.conn
+            conn.execute(
+                "DELETE FROM steps WHERE user_pk IN (SELECT id FROM users WHERE account = ?)", (account,)
+            )
+            conn.execute("DELETE FROM users WHERE account = ?", (account,))
+            conn.execute("DELETE FROM stats WHERE account = ?", (account,))
+            conn.execute("DELETE FROM funnel WHERE account = ?", (account,))
+            conn.execute("DELETE FROM accounts WHERE account = ?", (account,))
+            conn.execute("INSERT INTO accounts (account, funnel_built) VALUES (?, 1)", (account,))
+
+            for user_id, user_data in data.get("users", {}).items():
+                session.add_user(user_id, user_data)
+
+            stats = data.get("stats") or {}
+            if not all(k in stats for k in ("total_users", "by_branch", "by_step")):
+                recomputed = {"users": data.get("users", {})}
+                _update_stats(recomputed)
+                stats = recomputed["stats"]
+            conn.execute("UPDATE accounts SET total_users = ? WHERE account = ?", (stats["total_users"], account))
+            for kind, values in (("branch", stats["by_branch"]), ("step", stats["by_step"])):
+                for key, n in values.items():
+                    conn.execute("INSERT INTO stats (account, kind, key, value) VALUES (?, ?, ?, ?)",
+                                 (account, kind, str(key), n))
+            self.add_funnel(conn, account, _build_funnel(data))
+
+
+def _create_ab_store():
+    if AB_TEST_BACKEND == "sqlite":
+        return SqliteAbStore(AB_TEST_DB_FILE)
+    if AB_TEST_BACKEND != "json":
+        raise ValueError(f"AB_TEST_BACKEND должен быть json или sqlite: {AB_TEST_BACKEND}")
+    return JsonAbStore(AB_TEST_DIR)
+
+
+ab_store = _create_ab_store()
+
+
+class AbStatsCache:
+    """Кеш блока stats по аккаунтам, привязанный к версии данных (generation).
+
+    Проверка актуальности — один stat() файла или один SELECT по первичному ключу;
+    пользователи при попадании в кеш не читаются. Свои записи процесс кладёт в кеш сразу
+    (prime), записи других воркеров видны по смене generation.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._entries: dict[str, tuple] = {}
+
+    @staticmethod
+    def etag(account_name: str, generation: str) -> str:
+        return f'"{_ab_account_key(account_name)}-{generation}"'
+
+    @staticmethod
+    def not_modified(if_none_match: str, etag: str) -> bool:
+        """Совпадает ли If-None-Match с etag: "*" или список меток через запятую,
+        каждая сравнивается целиком (слабое сравнение — префикс W/ не учитывается)."""
+        if if_none_match.strip() == "*":
+            return True
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == etag:
+                return True
+        return False
+
+    def prime(self, account_name: str, generation: Optional[str], stats: dict, users_count: int) -> None:
+        if generation is None:
+            return
+        with self._lock:
+            self._entries[_ab_account_key(account_name)] = (generation, stats, users_count)
+
+    def get(self, account_name: str) -> Optional[tuple]:
+        """(generation, stats, users_count) или None, если аккаунта нет."""
+        key = _ab_account_key(account_name)
+        generation = self.store.generation(account_name)
+        if generation is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == generation:
+            return entry
+
+        result = self.store.get_stats(account_name)
+        if result is None:
+            return None
+        # Версия прочитана до данных: если между ними прошла запись, более новые данные
+        # окажутся под старой версией — следующий запрос промахнётся и перечитает их
+        entry = (generation, result[0], result[1])
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+
+ab_stats_cache = AbStatsCache(ab_store)
+startup_report.mark("ab_test")
+
+
+@metrics.timed("ab_test_event")
 def process_ab_test_event(
     banner_id: str,
     user_id: str,
@@ -461,71 +4282,74 @@ def process_ab_test_event(
     - branch: номер ветки (присваивается ТОЛЬКО при первом step=0, потом не меняется)
     - is_new_user: True если это новый пользователь
     """
-    file_path = _get_ab_test_file(account_name)
-    data = _load_ab_data(file_path)
-    
     now = datetime.datetime.now(UTC_PLUS_4)
     now_iso = now.isoformat()
     
-    is_new_user = user_id not in data["users"]
-    
-    if is_new_user:
-        # Новый пользователь — присваиваем ветку только здесь
-        if step == 0 and count and count > 0:
-            branch = _get_next_branch(account_name, count)
-        else:
-            branch = 1  # По умолчанию ветка 1
-        
-        data["users"][user_id] = {
-            "banner_id": banner_id,
-            "branch": branch,
-            "steps": [
-                {"step": step, "timestamp": now_iso, "time_from_prev": None}
-            ],
-            "first_seen": now_iso,
-            "last_seen": now_iso
-        }
-    else:
-        # Существующий пользователь — ВСЕГДА сохраняем его изначальную ветку
-        user_data = data["users"][user_id]
-        branch = user_data.get("branch", 1)  # Ветка НЕ меняется, даже если пришёл step=0 с другим count
-        
-        # Вычисляем время от предыдущего шага
-        time_from_prev = None
-        if user_data["steps"]:
-            last_step = user_data["steps"][-1]
-            try:
-                last_time = datetime.datetime.fromisoformat(last_step["timestamp"])
-                time_from_prev = round((now - last_time).total_seconds(), 2)
-            except Exception:
-                pass
+    with ab_store.session(account_name) as session:
+        user = session.find_user(user_id)
+        is_new_user = user is None
         
-        # Добавляем новый шаг (включая повторный step=0 если вдруг пришёл)
-        user_data["steps"].append({
-            "step": step,
-            "timestamp": now_iso,
-            "time_from_prev": time_from_prev
-        })
-        user_data["last_seen"] = now_iso
+        if is_new_user:
+            # Новый пользователь — присваиваем ветку только здесь
+            if step == 0 and count and count > 0:
+                branch = _get_next_branch(account_name, count)
+            else:
+                branch = 1  # По умолчанию ветка 1
+            
+            session.add_user(user_id, {
+                "banner_id": banner_id,
+                "branch": branch,
+                "steps": [
+                    {"step": step, "timestamp": now_iso, "time_from_prev": None}
+                ],
+                "first_seen": now_iso,
+                "last_seen": now_iso
+            })
+            session.record_funnel(branch, None, step, None, first_visit=True)
+        else:
+            # Существующий пользователь — ВСЕГДА сохраняем его изначальную ветку
+            branch = user["branch"]  # Ветка НЕ меняется, даже если пришёл step=0 с другим count
+            
+            # Вычисляем время от предыдущего шага
+            time_from_prev = None
+            if user["last_step"]:
+                try:
+                    last_time = datetime.datetime.fromisoformat(user["last_step"]["timestamp"])
+                    time_from_prev = round((now - last_time).total_seconds(), 2)
+                except Exception:
+                    pass
+            
+            prev_step = user["last_step"]["step"] if user["last_step"] else None
+            first_visit = not session.has_step(user_id, step)
+            
+            # Добавляем новый шаг (включая повторный step=0 если вдруг пришёл);
+            # banner_id обновляется, если изменился (не должно, но на всякий)
+            session.append_step(user_id, {
+                "step": step,
+                "timestamp": now_iso,
+                "time_from_prev": time_from_prev
+            }, banner_id)
+            session.record_funnel(branch, prev_step, step, time_from_prev, first_visit)
         
-        # Обновляем banner_id если изменился (не должно, но на всякий)
-        if banner_id and banner_id != user_data.get("banner_id"):
-            user_data["banner_id"] = banner_id
-    
-    # Пересчитываем статистику
-    _update_stats(data)
+        # Обновляем статистику на дельту события
+        session.bump_stats(step, branch, is_new_user)
+        if AB_STATS_VERIFY:
+            session.verify_stats(account_name)
+        stats, users_count = session.snapshot()
     
-    # Сохраняем
-    _save_ab_data(file_path, data)
+    ab_stats_cache.prime(account_name, session.generation, stats, users_count)
     
-    logging.info(
-        f"[ab_test/{account_name}] user={user_id}, banner={banner_id}, "
-        f"step={step}, branch={branch}, new={is_new_user}"
+    log_event(
+        "ab_test", f"[ab_test/{account_name}]",
+        {"user": user_id, "banner": banner_id, "step": step, "branch": branch, "new": is_new_user},
     )
     
     return {"branch": branch, "is_new_user": is_new_user}
 
 
+AB_TEST_PARAM_ALIASES = {**TRAFFIC_PARAM_ALIASES, "accountName": "account_name"}
+
+
 @app.post("/traffic_bh/ab_test")
 async def receive_ab_test(request: Request):
     """
@@ -543,46 +4367,20 @@ async def receive_ab_test(request: Request):
     - branch: Номер ветки пользователя (int)
     - is_new_user: Новый ли пользователь (bool)
     """
-    # Собираем все параметры в один словарь
-    all_params = {}
-    
-    # 1) Query params (всегда доступны)
-    all_params.update(dict(request.query_params))
-    
-    # 2) Определяем тип контента и читаем body
-    content_type = request.headers.get("content-type", "")
-    
-    if "application/json" in content_type:
-        # JSON body
-        try:
-            body = await request.json()
-            if isinstance(body, dict):
-                all_params.update(body)
-        except Exception as e:
-            logging.warning(f"[ab_test] JSON parse error: {e}")
-    else:
-        # Form data (multipart/form-data или x-www-form-urlencoded)
-        try:
-            form = await request.form()
-            for key in form.keys():
-                # Убираем лишние пробелы из ключей (на всякий случай)
-                clean_key = key.strip()
-                all_params[clean_key] = form.get(key)
-        except Exception as e:
-            logging.warning(f"[ab_test] Form parse error: {e}")
-    
+    all_params = await read_request_params(request, AB_TEST_PARAM_ALIASES)
+
     # Извлекаем нужные параметры
-    banner_id = all_params.get("banner_id") or all_params.get("bannerId")
-    user_id = all_params.get("user_id") or all_params.get("userId")
+    banner_id = all_params.get("banner_id")
+    user_id = all_params.get("user_id")
     step = all_params.get("step")
-    account_name = all_params.get("account_name") or all_params.get("accountName")
+    account_name = all_params.get("account_name")
     count = all_params.get("count")
 
     # Преобразование типов
     try:
         step = float(step) if step is not None else None
     except (ValueError, TypeError):
-        return {"status": "error", "message": "step must be a number"}, 400
+        return JSONResponse({"status": "error", "message": "step must be a number"}, status_code=400)
 
     try:
         count = int(count) if count is not None else None
@@ -602,14 +4400,16 @@ async def receive_ab_test(request: Request):
             missing.append("account_name")
         
         logging.warning(f"Пропущен ab_test постбэк, отсутствуют: {missing}, all_params={all_params}")
-        return {
+        return JSONResponse({
             "status": "error",
             "message": f"Missing required parameters: {', '.join(missing)}"
-        }, 400
+        }, status_code=400)
 
     # Обрабатываем событие
     try:
-        result = process_ab_test_event(
+        # В потоке: блокировка аккаунта (flock / BEGIN IMMEDIATE) ждётся вне event loop
+        result = await asyncio.to_thread(
+            process_ab_test_event,
             banner_id=str(banner_id),
             user_id=str(user_id),
             step=step,
@@ -618,7 +4418,7 @@ async def receive_ab_test(request: Request):
         )
     except Exception as e:
         logging.exception(f"Ошибка обработки ab_test: {e}")
-        return {"status": "error", "message": "failed to process event"}, 500
+        return JSONResponse({"status": "error", "message": "failed to process event"}, status_code=500)
 
     return {
         "status": "ok",
@@ -628,22 +4428,49 @@ async def receive_ab_test(request: Request):
 
 
 @app.get("/traffic_bh/ab_test/stats/{account_name}")
-async def get_ab_test_stats(account_name: str):
+async def get_ab_test_stats(account_name: str, request: Request):
     """
     Получить статистику A/B теста для аккаунта.
+    Ответ кешируется по версии данных аккаунта; поддерживается ETag / If-None-Match (304).
     """
-    file_path = _get_ab_test_file(account_name)
+    # В потоке: промах кеша читает файл аккаунта или SQLite
+    entry = await asyncio.to_thread(ab_stats_cache.get, account_name)
+    
+    if entry is None:
+        return JSONResponse({"status": "error", "message": "account not found"}, status_code=404)
+    
+    generation, stats, users_count = entry
+    etag = ab_stats_cache.etag(account_name, generation)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    
+    if ab_stats_cache.not_modified(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
     
-    if not file_path.exists():
-        return {"status": "error", "message": "account not found"}, 404
+    return JSONResponse({
+        "status": "ok",
+        "account": account_name,
+        "stats": stats,
+        "users_count": users_count
+    }, headers=headers)
+
+
+@app.get("/traffic_bh/ab_test/funnel/{account_name}")
+async def get_ab_test_funnel(account_name: str):
+    """
+    Воронка A/B теста по веткам: сколько пользователей дошло до каждого шага,
+    конверсия от предыдущего шага и от первого, переходы между шагами и
+    p50/p90/p99 времени до следующего шага (секунды, точность ±FUNNEL_SKETCH_ACCURACY).
+    Размер ответа и время расчёта зависят только от числа шагов, не от числа пользователей.
+    """
+    funnel = await asyncio.to_thread(ab_store.get_funnel, account_name)
     
-    data = _load_ab_data(file_path)
+    if funnel is None:
+        return JSONResponse({"status": "error", "message": "account not found"}, status_code=404)
     
     return {
         "status": "ok",
         "account": account_name,
-        "stats": data.get("stats", {}),
-        "users_count": len(data.get("users", {}))
+        "branches": _funnel_report(funnel)
     }
 
 
@@ -652,16 +4479,13 @@ async def get_ab_test_user(account_name: str, user_id: str):
     """
     Получить данные конкретного пользователя.
     """
-    file_path = _get_ab_test_file(account_name)
+    if not await asyncio.to_thread(ab_store.exists, account_name):
+        return JSONResponse({"status": "error", "message": "account not found"}, status_code=404)
     
-    if not file_path.exists():
-        return {"status": "error", "message": "account not found"}, 404
-    
-    data = _load_ab_data(file_path)
-    user_data = data.get("users", {}).get(user_id)
+    user_data = await asyncio.to_thread(ab_store.get_user, account_name, user_id)
     
     if not user_data:
-        return {"status": "error", "message": "user not found"}, 404
+        return JSONResponse({"status": "error", "message": "user not found"}, status_code=404)
     
     return {
         "status": "ok",
@@ -672,33 +4496,145 @@ async def get_ab_test_user(account_name: str, user_id: str):
 # === /A/B TEST end ===
 
 
+# === /metrics ===
+
+def _file_size_samples(kind: str, paths, relative_to: Optional[Path] = None) -> list:
+    samples = []
+    for path in paths:
+        name = str(path.relative_to(relative_to)) if relative_to is not None else path.name
+        try:
+            samples.append(((("kind", kind), ("file", name)), path.stat().st_size))
+        except FileNotFoundError:
+            continue
+    return samples
+
+
+@metrics.collector
+def _collect_file_sizes() -> list:
+    """Размеры текущих файлов хранилищ (файлы, в которые пишет сегодняшний трафик)."""
+    today = datetime.date.today()
+    stat_file = get_stat_income_file()
+    samples = _file_size_samples("stat_income", [stat_file, get_stat_income_journal(stat_file)])
+    samples += _file_size_samples("sub6", [get_today_filename()])
+    samples += _file_size_samples("traffic_bh", [_get_traffic_filename()])
+    partner_files = [path / f"day_{today:%Y-%m-%d}.json" for path in PARTNERS_DIR.iterdir() if path.is_dir()]
+    samples += _file_size_samples("partners", partner_files, relative_to=PARTNERS_DIR)
+    if AB_TEST_BACKEND == "sqlite":
+        ab_files = [AB_TEST_DB_FILE, AB_TEST_DB_FILE.with_name(AB_TEST_DB_FILE.name + "-wal")]
+    else:
+        ab_files = sorted(AB_TEST_DIR.glob("*.json"))
+    samples += _file_size_samples("ab_test", ab_files)
+    samples += _file_size_samples("ab_branch_counters", [AB_BRANCH_COUNTERS_FILE])
+    return [("leads_file_size_bytes", "gauge", "Size of current storage files", samples)]
+
+
+@metrics.collector
+def _collect_state() -> list:
+    families = [
+        ("leads_ab_branch_counter", "gauge", "A/B round-robin branch counters",
+         [((("key", key),), value) for key, value in branch_counters.values().items()]),
+        ("leads_partner_pending_updates", "gauge", "Partner sum updates not yet flushed to disk",
+         [((), daily_sums._pending_count)]),
+        ("leads_traffic_queue_size", "gauge", "traffic_bh records waiting for TrafficWriter",
+         [((), traffic_writer._queue.qsize() if traffic_writer._queue is not None else 0)]),
+        ("leads_sub6_index_values", "gauge", "sub6 values held in the in-memory index",
+         [((), sum(len(entry.values) for entry in list(sub6_index._days.values())))]),
+        ("leads_log_dropped_total", "counter", "Log events dropped by sampling/rate limits",
+         [((("channel", channel),), count) for channel, count in log_sampler.dropped.items()]),
+        ("leads_startup_seconds", "gauge", "Startup time by component (imports and init)",
+         [((("component", name),), seconds) for name, seconds in list(startup_report.components.items())]),
+        ("leads_process_info", "gauge", "Worker process serving this scrape",
+         [((("pid", os.getpid()), ("version", VERSION)), 1)]),
+    ]
+    if postback_dedup is not None:
+        families.append(("leads_postback_dedup_total", "counter", "Postback dedup lookups by result", [
+            ((("result", "duplicate"),), postback_dedup.hits),
+            ((("result", "new"),), postback_dedup.misses),
+        ]))
+    return families
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики процесса в текстовом формате Prometheus."""
+    body = await asyncio.to_thread(metrics.render)
+    return Response(body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/")
 async def root():
     return {"status": "running"}
 
-# === VK Checker Mini App ===
-import sys
+# === Подключаемые приложения ===
+# VK Checker, Auto ADS и VK Checker v4 импортируются не при старте, а при первом запросе к
+# своему префиксу (или фоновым прогревом через SUBAPPS_WARMUP_DELAY секунд после старта),
+# чтобы перезапуск воркера не ждал их импорта и постбэки принимались сразу.
+# SUBAPPS_WARMUP_DELAY=-1 — без прогрева, только по первому запросу.
 sys.path.append("/opt")  # добавляем корень, где лежит vk_checker
 
-try:
-    from vk_checker.webapp.app import app as vk_checker_app
-    app.mount("/dashboard", vk_checker_app)
-    logging.info("VK Checker подключён к /dashboard")
-except Exception as e:
-    logging.warning(f"VK Checker не найден или не загружен: {e}")
+SUBAPPS_WARMUP_DELAY = float(os.getenv("SUBAPPS_WARMUP_DELAY", "5"))
 
-# === SKY ADS ===
-try:
-    from auto_ads.app import app as auto_ads_app
-    app.mount("/auto_ads", auto_ads_app)
-    logging.info("Auto ADS подключён к /auto_ads/api")
-except Exception as e:
-    logging.warning(f"Auto ADS не найден или ошибка загрузки: {e}")
 
-# === VK CHECKER V4 ===
-try:
-    from vk_checker.v4.webapp.app import app as vk_checker_v4_app
-    app.mount("/vk_checker_v4", vk_checker_v4_app)
-    logging.info("VK Checker подключён к /vk_checker_v4")
-except Exception as e:
-    logging.warning(f"VK Checker_v4 не найден или не загружен: {e}")
+class LazySubApp:
+    """ASGI-приложение, импортирующее настоящее приложение при первом обращении."""
+
+    def __init__(self, prefix: str, module: str, title: str, attr: str = "app"):
+        self.prefix = prefix
+        self.module = module
+        self.title = title
+        self.attr = attr
+        self.app = None
+        self.error: Optional[Exception] = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Импортирует приложение (один раз; ошибка импорта тоже запоминается)."""
+        with self._lock:
+            if self.app is None and self.error is None:
+                started = time.perf_counter()
+                try:
+                    self.app = getattr(importlib.import_module(self.module), self.attr)
+                    logging.info(f"{self.title} подключён к {self.prefix}")
+                except Exception as e:
+                    self.error = e
+                    logging.warning(f"{self.title} не найден или не загружен: {e}")
+                startup_report.add(f"subapp:{self.prefix}", time.perf_counter() - started)
+        return self.app
+
+    async def __call__(self, scope, receive, send):
+        sub_app = self.app
+        if sub_app is None and self.error is None:
+            sub_app = await asyncio.to_thread(self.load)
+        if sub_app is None:
+            # Как раньше, когда приложение не удавалось смонтировать
+            await JSONResponse({"detail": "Not Found"}, status_code=404)(scope, receive, send)
+            return
+        await sub_app(scope, receive, send)
+
+
+subapps = [
+    LazySubApp("/dashboard", "vk_checker.webapp.app", "VK Checker"),
+    LazySubApp("/auto_ads", "auto_ads.app", "Auto ADS"),
+    LazySubApp("/vk_checker_v4", "vk_checker.v4.webapp.app", "VK Checker_v4"),
+]
+for subapp in subapps:
+    app.mount(subapp.prefix, subapp)
+
+startup_report.mark("routes")
+
+
+_subapps_warmup_task: Optional[asyncio.Task] = None
+
+
+async def _warm_up_subapps() -> None:
+    await asyncio.sleep(SUBAPPS_WARMUP_DELAY)
+    for subapp in subapps:
+        await asyncio.to_thread(subapp.load)
+
+
+@on_startup
+async def _report_startup() -> None:
+    logging.info(startup_report.summary())
+    global _subapps_warmup_task
+    if SUBAPPS_WARMUP_DELAY >= 0:
+        _subapps_warmup_task = asyncio.get_running_loop().create_task(_warm_up_subapps())
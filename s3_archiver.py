@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+Архивация всех данных сервиса в S3.
+
+Обходит DATA_DIR целиком (traffic_bh/, stat_lt_income/, ab_test/, partners/, файлы партнёров,
+leads_sub6_*.txt), сжимает каждый файл потоком (gzip или zstd) и загружает его multipart-загрузкой
+с параллельной отправкой частей. Файл целиком в память не читается: в памяти не больше
+--workers + 1 частей.
+
+Локальный манифест (DATA_DIR/.s3_archive_manifest.json) хранит размер, mtime и sha256 каждого
+загруженного файла — неизменившиеся файлы пропускаются. Незавершённые загрузки тоже пишутся
+в манифест (UploadId и параметры сжатия), и следующий запуск продолжает их с места обрыва:
+готовые части берутся из list_parts, а сжатие детерминированное, поэтому часть с совпавшим
+ETag (MD5) не отправляется повторно.
+
+Активные append-only файлы архивируются по размеру на момент хеширования — то, что
+дописано во время загрузки, уйдёт следующим запуском. SQLite-базы копируются через backup API,
+чтобы в архив попал согласованный снимок.
+
+Запуск:
+    python s3_archiver.py                      # gzip, части по 8 МБ, 4 потока
+    python s3_archiver.py --codec zstd         # нужен пакет zstandard
+    python s3_archiver.py --dry-run            # только показать, что будет загружено
+"""
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Optional
+
+import boto3
+from dotenv import load_dotenv
+
+try:
+    import zstandard
+except ImportError:  # zstd — опционально
+    zstandard = None
+
+# === Логи ===
+LOG_FILE = os.getenv("LEADS_ARCHIVE_LOG_FILE", "/opt/leads_postback/archive.log")
+
+# === Настройки ===
+load_dotenv()
+S3_ENDPOINT = os.getenv("S3_ENDPOINT")
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
+S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
+S3_ARCHIVE_PREFIX = os.getenv("S3_ARCHIVE_PREFIX", "archive")
+
+DATA_DIR = Path(os.getenv("LEADS_DATA_DIR", "/opt/leads_postback/data"))
+MANIFEST_FILE = DATA_DIR / ".s3_archive_manifest.json"
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # минимум S3 для всех частей, кроме последней
+READ_CHUNK = 1024 * 1024
+
+CODECS = {"gzip": ".gz", "zstd": ".zst"}
+
+# Временные и служебные файлы, которые не архивируем
+SKIP_SUFFIXES = (".tmp", ".lock", ".sqlite3-wal", ".sqlite3-shm", ".sqlite3-journal")
+
+
+def make_s3_client():
+    return boto3.client(
+        "s3",
+        endpoint_url=S3_ENDPOINT,
+        aws_access_key_id=S3_ACCESS_KEY,
+        aws_secret_access_key=S3_SECRET_KEY,
+    )
+
+
+# === Манифест ===
+
+def load_manifest(path: Path) -> dict:
+    if path.exists():
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            manifest.setdefault("files", {})
+            manifest.setdefault("uploads", {})
+            return manifest
+        except json.JSONDecodeError:
+            logging.warning(f"Манифест {path} повреждён, начинаем заново.")
+    return {"files": {}, "uploads": {}}
+
+
+def save_manifest(path: Path, manifest: dict) -> None:
+    tmp_file = path.with_name(path.name + ".tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file, path)
+
+
+# === Сжатие ===
+
+class _Compressor:
+    """Единый интерфейс потокового сжатия. gzip пишется с mtime=0 — вывод детерминирован,
+    что нужно для продолжения загрузки по частям."""
+
+    def __init__(self, codec: str):
+        self.codec = codec
+        if codec == "gzip":
+            self._buffer = _ChunkSink()
+            self._gz = gzip.GzipFile(fileobj=self._buffer, mode="wb", compresslevel=6, mtime=0)
+        elif codec == "zstd":
+            if zstandard is None:
+                raise RuntimeError("Для --codec zstd установите пакет zstandard")
+            self._zc = zstandard.ZstdCompressor(level=10).compressobj()
+        else:
+            raise ValueError(f"Неизвестный кодек: {codec}")
+
+    def compress(self, data: bytes) -> bytes:
+        if self.codec == "gzip":
+            self._gz.write(data)
+            return self._buffer.take()
+        return self._zc.compress(data)
+
+    def finish(self) -> bytes:
+        if self.codec == "gzip":
+            self._gz.close()
+            return self._buffer.take()
+        return self._zc.flush()
+
+
+class _ChunkSink:
+    """Минимальный file-like объект, собирающий вывод GzipFile."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_compressed_parts(path: Path, size: int, codec: str, part_size: int):
+    """Читает первые size байт файла, сжимает и отдаёт части сжатого потока по part_size байт."""
+    compressor = _Compressor(codec)
+    pending = bytearray()
+    remaining = size
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(READ_CHUNK, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            pending += compressor.compress(chunk)
+            while len(pending) >= part_size:
+                yield bytes(pending[:part_size])
+                del pending[:part_size]
+    pending += compressor.finish()
+    while len(pending) > part_size:
+        yield bytes(pending[:part_size])
+        del pending[:part_size]
+    # Последняя часть может быть любого размера; пустой файл тоже даёт одну (заголовок кодека)
+    yield bytes(pending)
+
+
+# === Обход данных ===
+
+def file_sha256(path: Path, size: int) -> str:
+    h = hashlib.sha256()
+    remaining = size
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(READ_CHUNK, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def iter_data_files(data_dir: Path, only_dirs: Optional[list] = None):
+    """Все файлы данных (относительный путь, абсолютный путь) в стабильном порядке."""
+    roots = [data_dir / d for d in only_dirs] if only_dirs else [data_dir]
+    for root in roots:
+        if root.is_file():
+            paths = [root]
+        else:
+            paths = sorted(p for p in root.rglob("*") if p.is_file())
+        for path in paths:
+            if path.name.startswith(".") or path.name.endswith(SKIP_SUFFIXES):
+                continue
+            yield path.relative_to(data_dir).as_posix(), path
+
+
+def _sqlite_snapshot(path: Path) -> Path:
+    """Согласованная копия SQLite-базы во временном файле."""
+    fd, tmp_name = tempfile.mkstemp(prefix=path.stem + "_", suffix=".sqlite3")
+    os.close(fd)
+    src = sqlite3.connect(path)
+    dst = sqlite3.connect(tmp_name)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    return Path(tmp_name)
+
+
+# === Загрузка ===
+
+class Archiver:
+    def __init__(self, s3, bucket: str, prefix: str, data_dir: Path, manifest_path: Path,
+                 codec: str = "gzip", part_size: int = 8 * 1024 * 1024, workers: int = 4):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size должен быть не меньше {MIN_PART_SIZE} байт")
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.data_dir = data_dir
+        self.manifest_path = manifest_path
+        self.codec = codec
+        self.part_size = part_size
+        self.workers = max(1, workers)
+        self.manifest = load_manifest(manifest_path)
+
+    def object_key(self, rel_path: str) -> str:
+        key = f"{rel_path}{CODECS[self.codec]}"
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def _save(self) -> None:
+        save_manifest(self.manifest_path, self.manifest)
+
+    def _resume_parts(self, key: str, sha256: str) -> tuple:
+        """UploadId и уже загруженные части прерванной загрузки, если её можно продолжить."""
+        state = self.manifest["uploads"].get(key)
+        if not state:
+            return None, {}
+        if (state.get("sha256"), state.get("codec"), state.get("part_size")) != (sha256, self.codec, self.part_size):
+            # Файл или параметры изменились — старую загрузку отменяем
+            self._abort(key, state["upload_id"])
+            return None, {}
+        try:
+            parts = {}
+            kwargs = {"Bucket": self.bucket, "Key": key, "UploadId": state["upload_id"]}
+            while True:
+                resp = self.s3.list_parts(**kwargs)
+                for part in resp.get("Parts", []):
+                    parts[part["PartNumber"]] = part["ETag"]
+                if not resp.get("IsTruncated"):
+                    break
+                kwargs["PartNumberMarker"] = resp["NextPartNumberMarker"]
+        except Exception as e:
+            logging.warning(f"Загрузку {key} продолжить нельзя ({e}), начинаем заново")
+            self.manifest["uploads"].pop(key, None)
+            return None, {}
+        logging.info(f"↻ {key}: продолжаем загрузку, готово частей: {len(parts)}")
+        return state["upload_id"], parts
+
+    def _abort(self, key: str, upload_id: str) -> None:
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+        except Exception as e:
+            logging.warning(f"Не удалось отменить загрузку {key}: {e}")
+        self.manifest["uploads"].pop(key, None)
+
+    def _upload_part(self, key: str, upload_id: str, number: int, body: bytes) -> str:
+        resp = self.s3.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body)
+        return resp["ETag"]
+
+    def upload_file(self, rel_path: str, source: Path, size: int, sha256: str) -> None:
+        key = self.object_key(rel_path)
+        upload_id, done = self._resume_parts(key, sha256)
+        if upload_id is None:
+            resp = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=key,
+                Metadata={"sha256": sha256, "source-size": str(size), "codec": self.codec},
+            )
+            upload_id = resp["UploadId"]
+            self.manifest["uploads"][key] = {
+                "upload_id": upload_id, "sha256": sha256, "codec": self.codec,
+                "part_size": self.part_size,
+            }
+            self._save()
+
+        etags = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            in_flight = {}
+            for number, body in enumerate(iter_compressed_parts(source, size, self.codec, self.part_size), start=1):
+                known = done.get(number)
+                if known and known.strip('"') == hashlib.md5(body).hexdigest():
+                    etags[number] = known
+                    continue
+                if len(in_flight) >= self.workers:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        etags[in_flight.pop(future)] = future.result()
+                in_flight[pool.submit(self._upload_part, key, upload_id, number, body)] = number
+            for future, number in in_flight.items():
+                etags[number] = future.result()
+
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": n, "ETag": etags[n]} for n in sorted(etags)]},
+        )
+        self.manifest["uploads"].pop(key, None)
+
+    def archive(self, only_dirs: Optional[list] = None, dry_run: bool = False) -> dict:
+        """Загружает новые и изменившиеся файлы. Возвращает счётчики uploaded/skipped/failed."""
+        result = {"uploaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+        for rel_path, path in iter_data_files(self.data_dir, only_dirs):
+            snapshot = None
+            try:
+                st = path.stat()
+                entry = self.manifest["files"].get(rel_path)
+                is_sqlite = path.suffix == ".sqlite3"
+                if not is_sqlite and entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns \
+                        and entry.get("codec") == self.codec:
+                    result["skipped"] += 1
+                    continue
+
+                source, size = path, st.st_size
+                if is_sqlite:
+                    snapshot = _sqlite_snapshot(path)
+                    source, size = snapshot, snapshot.stat().st_size
+                sha256 = file_sha256(source, size)
+
+                if entry and entry["sha256"] == sha256 and entry.get("codec") == self.codec:
+                    entry["mtime_ns"] = st.st_mtime_ns
+                    result["skipped"] += 1
+                    continue
+
+                if dry_run:
+                    logging.info(f"[dry-run] {rel_path} ({size} байт) -> {self.object_key(rel_path)}")
+                    result["uploaded"] += 1
+                    continue
+
+                self.upload_file(rel_path, source, size, sha256)
+                self.manifest["files"][rel_path] = {
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                    "sha256": sha256,
+                    "codec": self.codec,
+                    "key": self.object_key(rel_path),
+                    "uploaded_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                }
+                self._save()
+                result["uploaded"] += 1
+                result["bytes"] += size
+                logging.info(f"✅ {rel_path} -> {self.object_key(rel_path)}")
+            except Exception as e:
+                result["failed"] += 1
+                logging.exception(f"❌ Ошибка архивации {rel_path}: {e}")
+                self._save()
+            finally:
+                if snapshot is not None:
+                    snapshot.unlink(missing_ok=True)
+        if not dry_run:
+            self._save()
+        return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--codec", choices=sorted(CODECS), default="gzip")
+    parser.add_argument("--part-size", type=int, default=8, help="размер части, МБ (не меньше 5)")
+    parser.add_argument("--workers", type=int, default=4, help="параллельных загрузок частей")
+    parser.add_argument("--dir", action="append", dest="dirs", help="только эти подкаталоги/файлы DATA_DIR")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.FileHandler(LOG_FILE),
+            logging.StreamHandler()
+        ]
+    )
+
+    archiver = Archiver(
+        make_s3_client(), S3_BUCKET, S3_ARCHIVE_PREFIX, DATA_DIR, MANIFEST_FILE,
+        codec=args.codec, part_size=args.part_size * 1024 * 1024, workers=args.workers,
+    )
+    result = archiver.archive(args.dirs, dry_run=args.dry_run)
+    logging.info(
+        f"Архивация завершена: загружено {result['uploaded']}, пропущено {result['skipped']}, "
+        f"ошибок {result['failed']}, байт {result['bytes']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+"""
+Общая настройка тестов: main.py и upload_to_s3.py читают пути из окружения при импорте,
+поэтому временный DATA_DIR и логи задаются до первого импорта.
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="leads_tests_"))
+
+os.environ["LEADS_DATA_DIR"] = str(TMP / "data")
+os.environ["LEADS_LOG_FILE"] = str(TMP / "postback.log")
+os.environ["LEADS_UPLOAD_LOG_FILE"] = str(TMP / "upload.log")
+os.environ.setdefault("POSTBACK_DEDUP", "1")  # по умолчанию выключена, тесты её проверяют
+
+sys.path.insert(0, str(ROOT))
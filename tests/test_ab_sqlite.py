@@ -0,0 +1,41 @@
+"""SQLite-хранилище A/B: воронка аккаунта, созданного до таблицы funnel, досчитывается один раз."""
+import main
+
+
+def _events(account: str) -> None:
+    for user_id, steps in (("u1", (0, 1, 2)), ("u2", (0, 1)), ("u3", (0,))):
+        for step in steps:
+            main.process_ab_test_event("7", user_id, step, account, 2)
+
+
+def _reached(funnel: dict) -> int:
+    """Сколько раз пользователи достигали шагов, по всем веткам."""
+    return sum(sum(branch["reached"].values()) for branch in funnel["branches"].values())
+
+
+def test_funnel_backfill_for_existing_account(tmp_path, monkeypatch):
+    db_file = tmp_path / "ab_test.sqlite3"
+    monkeypatch.setattr(main, "ab_store", main.SqliteAbStore(db_file))
+    _events("acc")
+    expected = main.ab_store.get_funnel("acc")
+
+    # База версии без воронки: пользователи есть, funnel пуст и флаг не выставлен
+    conn = main.ab_store._connect()
+    conn.execute("DELETE FROM funnel")
+    conn.execute("UPDATE accounts SET funnel_built = 0")
+
+    monkeypatch.setattr(main, "ab_store", main.SqliteAbStore(db_file))
+    assert main.ab_store.get_funnel("acc") == expected
+
+    # Досчёт не повторяется: новое событие учитывается ровно один раз
+    main.process_ab_test_event("7", "u3", 1, "acc", 2)
+    monkeypatch.setattr(main, "ab_store", main.SqliteAbStore(db_file))
+    assert _reached(main.ab_store.get_funnel("acc")) == _reached(expected) + 1
+
+
+def test_new_account_does_not_rebuild_funnel(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "ab_store", main.SqliteAbStore(tmp_path / "ab_test.sqlite3"))
+    _events("fresh")
+    row = main.ab_store._connect().execute("SELECT funnel_built FROM accounts WHERE account = 'fresh'").fetchone()
+    assert row == (1,)
+    assert _reached(main.ab_store.get_funnel("fresh")) == 6
@@ -0,0 +1,73 @@
+"""Колоночный формат: round-trip записей и перекладка закрытой недели stat_lt_income."""
+import json
+
+import pytest
+
+import columnar_compact
+import main
+
+
+def _records(count: int, offset: int = 0) -> list:
+    return [
+        main.make_stat_income_record("krolik_vk", str(i), f"2020-03-0{2 + i % 5} 10:00:0{i % 10}", f"{i}.5", str(offset + i),
+                                     status="1" if i % 3 else "")
+        for i in range(count)
+    ]
+
+
+def test_columnar_round_trip(tmp_path):
+    records = _records(50)
+    records[3]["extra"] = "поле только в одной записи"
+    del records[7]["sub2"]
+    records[9] = main.make_stat_income_record("krolik_vk", "9", "2020-03-02 10:00:09", "9.5", "9", duplicate=True)
+    col = tmp_path / "week.col"
+    main.write_columnar(col, records, "stat_lt_income")
+
+    columnar = main.ColumnarFile(col)
+    assert columnar.rows == len(records)
+    assert list(columnar.scan()) == records
+    assert list(columnar.scan(["sub6", "sum"])) == [{"sub6": r["sub6"], "sum": r["sum"]} for r in records]
+
+
+@pytest.fixture
+def sealed_week():
+    stat_file = main.STAT_INCOME_DIR / "stat_lt_income_2020_W10.json"
+    stat_file.write_bytes(main.json_dumps_bytes(_records(20)))
+    yield stat_file
+    for path in (stat_file, main.get_columnar_file(stat_file), main.get_stat_income_journal(stat_file)):
+        path.unlink(missing_ok=True)
+
+
+def _week(stat_file) -> list:
+    return json.loads("".join(main.iter_stat_income_json(stat_file)))
+
+
+def test_compacted_week_reads_back(sealed_week):
+    records = _week(sealed_week)
+    columnar_compact.compact_file("stat_lt_income", sealed_week, keep_source=False, pending=set())
+    assert not sealed_week.exists()
+    assert _week(sealed_week) == records
+
+
+def test_week_with_journal_is_not_compacted(sealed_week):
+    journal = main.get_stat_income_journal(sealed_week)
+    journal.write_bytes(main.json_dumps_bytes(_records(1, offset=100)[0]) + b"\n")
+    with pytest.raises(ValueError):
+        columnar_compact.compact_file("stat_lt_income", sealed_week, keep_source=False, pending=set())
+    assert not main.get_columnar_file(sealed_week).exists()
+
+
+def test_late_journal_after_compaction_stays_visible(sealed_week):
+    columnar_compact.compact_file("stat_lt_income", sealed_week, keep_source=False, pending=set())
+    late = _records(2, offset=100)
+    with main.file_lock(sealed_week), open(main.get_stat_income_journal(sealed_week), "ab") as f:
+        f.write(b"".join(main.json_dumps_bytes(record) + b"\n" for record in late))
+
+    expected = _records(20) + late
+    assert _week(sealed_week) == expected
+    main.compact_stat_income(sealed_week)
+    assert not main.get_columnar_file(sealed_week).exists()
+    assert _week(sealed_week) == expected
+
+    columnar_compact.compact_file("stat_lt_income", sealed_week, keep_source=False, pending=set())
+    assert _week(sealed_week) == expected
@@ -0,0 +1,67 @@
+"""Дедупликация постбэков: ключ запоминается только после успешной записи,
+повтор остаётся в stat_lt_income с пометкой duplicate."""
+import json
+import uuid
+
+import pytest
+
+import main
+
+
+def _postback(**params) -> dict:
+    return {"sub1": "krolik_vk", "sub5": "1", "sub6": str(uuid.uuid4().int % 10 ** 12), "sum": "100", "status": "1",
+            **params}
+
+
+def _stored(sub6: str) -> list:
+    records = json.loads("".join(main.iter_stat_income_json(main.get_stat_income_file())))
+    return [record for record in records if record["sub6"] == sub6]
+
+
+def _fail_write(*args, **kwargs):
+    raise OSError("диск недоступен")
+
+
+def test_retry_after_failed_write_is_not_duplicate(monkeypatch):
+    params = _postback()
+    with monkeypatch.context() as m:
+        m.setattr(main, "save_stat_income_records", _fail_write)
+        with pytest.raises(OSError):
+            main.process_postback(params)
+
+    assert main.process_postback(params) is True
+    assert [record.get("duplicate", False) for record in _stored(params["sub6"])] == [False]
+
+
+def test_duplicate_is_recorded_with_flag():
+    params = _postback()
+    assert main.process_postback(params) is True
+    assert main.process_postback(params) is False
+
+    assert [record.get("duplicate", False) for record in _stored(params["sub6"])] == [False, True]
+    sub6_lines = main.get_today_filename().read_text().splitlines()
+    assert sub6_lines.count(params["sub6"]) == 1
+
+
+def test_postback_without_sub6_is_not_deduplicated():
+    sub2 = uuid.uuid4().hex
+    params = _postback(sub2=sub2, sub6="")
+    assert main.process_postback(params) is True
+    assert main.process_postback(params) is True
+
+    records = json.loads("".join(main.iter_stat_income_json(main.get_stat_income_file())))
+    assert [record.get("duplicate", False) for record in records if record["sub2"] == sub2] == [False, False]
+
+
+def test_batch_retry_after_failed_write_is_not_duplicate(monkeypatch):
+    first, second = _postback(), _postback()
+    with monkeypatch.context() as m:
+        m.setattr(main, "save_stat_income_records", _fail_write)
+        with pytest.raises(OSError):
+            main.process_postback_batch([first, second])
+
+    results = main.process_postback_batch([first, second, first])
+    assert [result.get("duplicate", False) for result in results] == [False, False, True]
+    assert main.process_postback_batch([second]) == [{"status": "ok", "duplicate": True}]
+    assert [record.get("duplicate", False) for record in _stored(first["sub6"])] == [False, True]
+    assert [record.get("duplicate", False) for record in _stored(second["sub6"])] == [False, True]
@@ -0,0 +1,56 @@
+"""stat_lt_income: записи журнала и свёрнутого JSON отдаются /stat_lt_income в порядке поступления."""
+import asyncio
+import json
+import uuid
+
+import main
+
+
+def _get(path: str, query: str = "") -> tuple:
+    """GET к приложению напрямую через ASGI. Возвращает (статус, тело)."""
+    messages = []
+    requests = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        await asyncio.sleep(3600)  # клиент не отключается; ответ отменит ожидание
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+        "headers": [], "client": ("test", 0), "server": ("test", 80),
+    }
+    asyncio.run(main.app(scope, receive, send))
+    return messages[0]["status"], b"".join(m.get("body", b"") for m in messages[1:])
+
+
+def _save(tag: str, i: int) -> None:
+    main.save_stat_income("krolik_vk", str(i), "2020-03-02 10:00:00", f"{i}.5", f"{tag}{i}", status="1")
+
+
+def test_journal_compaction_and_read_back():
+    tag = uuid.uuid4().hex[:8]
+    stat_file = main.get_stat_income_file()
+    for i in range(3):
+        _save(tag, i)
+    main.compact_stat_income(stat_file)
+    assert not main.get_stat_income_journal(stat_file).exists()
+    for i in range(3, 5):
+        _save(tag, i)
+
+    status, body = _get("/stat_lt_income")
+    assert status == 200
+    records = [record for record in json.loads(body) if record["sub6"].startswith(tag)]
+    assert [record["sub6"] for record in records] == [f"{tag}{i}" for i in range(5)]
+    assert records[0] == {
+        "sub1": "krolik_vk", "sub2": "", "sub5": "0", "sub6": f"{tag}0", "sum": "0.5", "status": "1",
+        "date": "2020-03-02 10:00:00",
+    }
+
+    week = stat_file.stem.removeprefix("stat_lt_income_")
+    assert _get("/stat_lt_income", f"week={week}")[1] == body
+    assert _get("/stat_lt_income", "week=1999_W01")[0] == 404
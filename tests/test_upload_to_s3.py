@@ -0,0 +1,86 @@
+"""upload_to_s3.py: состояние синхронизации после ежедневной консолидации."""
+import datetime
+
+import pytest
+
+import upload_to_s3
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.puts = []
+        self.uploads = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+        self.puts.append(Key)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key):
+        self.objects[Key] = Fileobj.read()
+        self.uploads.append(Key)
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete["Objects"]:
+            self.objects.pop(item["Key"], None)
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(upload_to_s3, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(upload_to_s3, "TRAFFIC_DIR", tmp_path / "traffic_bh")
+    monkeypatch.setattr(upload_to_s3, "SYNC_STATE_FILE", tmp_path / ".s3_sync_state.json")
+    return tmp_path
+
+
+def test_sync_state_kept_after_consolidation(data_dir):
+    s3 = FakeS3()
+    sub6 = data_dir / f"leads_sub6_{datetime.date.today():%d.%m.%Y}.txt"
+    key = upload_to_s3.sub6_key(sub6)
+    sub6.write_text("1\n2\n")
+
+    upload_to_s3.run_sync(s3)
+    assert len(s3.puts) == 1
+    upload_to_s3.run_daily(s3)
+    assert s3.uploads == [key]
+    assert s3.objects == {key: b"1\n2\n"}
+    assert upload_to_s3.load_state()[sub6.name] == {"key": key, "offset": 4, "deltas": [], "consolidated": 4}
+
+    # Без изменений файла — ни новых дельт, ни повторной загрузки
+    upload_to_s3.run_sync(s3)
+    upload_to_s3.run_daily(s3)
+    assert len(s3.puts) == 1
+    assert s3.uploads == [key]
+
+    # Дописанное после консолидации уходит одной дельтой и попадает в следующий итоговый объект
+    with open(sub6, "a") as f:
+        f.write("3\n")
+    upload_to_s3.run_sync(s3)
+    assert s3.puts[-1] == f"{key}.deltas/000000_4-6"
+    assert s3.objects[s3.puts[-1]] == b"3\n"
+    upload_to_s3.run_daily(s3)
+    assert s3.uploads == [key, key]
+    assert s3.objects == {key: b"1\n2\n3\n"}
+    assert upload_to_s3.load_state()[sub6.name]["consolidated"] == 6
+
+
+def test_consolidation_uploads_only_measured_size(data_dir):
+    sub6 = data_dir / f"leads_sub6_{datetime.date.today():%d.%m.%Y}.txt"
+    key = upload_to_s3.sub6_key(sub6)
+    sub6.write_text("1\n2\n")
+
+    class AppendingS3(FakeS3):
+        def upload_fileobj(self, Fileobj, Bucket, Key):
+            # Сервис дописывает строку, пока идёт загрузка
+            with open(sub6, "a") as f:
+                f.write("3\n")
+            super().upload_fileobj(Fileobj, Bucket, Key)
+
+    s3 = AppendingS3()
+    upload_to_s3.run_daily(s3)
+    assert s3.objects == {key: b"1\n2\n"}
+    assert upload_to_s3.load_state()[sub6.name]["offset"] == 4
+
+    # Дописанное во время загрузки уходит следующей дельтой, ничего не теряется и не повторяется
+    upload_to_s3.run_sync(s3)
+    assert s3.objects[s3.puts[-1]] == b"3\n"
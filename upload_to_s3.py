@@ -1,13 +1,35 @@
 #!/usr/bin/env python3
-import os
+"""
+Выгрузка leads_sub6 (и traffic_bh) в S3.
+
+    python upload_to_s3.py           # ежедневный запуск: итоговые объекты + файл sub6 на завтра
+    python upload_to_s3.py --sync    # внутридневная синхронизация (cron раз в несколько минут)
+
+--sync отправляет только новый «хвост» append-only файлов (leads_sub6_*.txt, traffic_bh_*.jsonl)
+отдельными delta-объектами <итоговый ключ>.deltas/<seq>_<от>-<до>. Отправленное смещение
+каждого файла хранится в DATA_DIR/.s3_sync_state.json; хвост обрезается по последнему \\n,
+чтобы строка не разрывалась между дельтами.
+
+Ежедневный запуск загружает итоговый объект с прежним ключом (leads_sub6/leads_sub6_DD.MM.YYYY.txt,
+traffic_bh/traffic_bh_YYYY-MM-DD.jsonl для завершившихся дней) целиком и удаляет дельты.
+Загружается ровно измеренный перед загрузкой размер файла, он же остаётся смещением
+в состоянии (consolidated — размер загруженного файла):
+следующая синхронизация шлёт только дописанное после неё, а файл консолидируется повторно,
+только если вырос. Записи о старых файлах, уже выгруженных полностью, удаляются.
+"""
+import argparse
 import datetime
-import boto3
+import fcntl
+import json
 import logging
+import os
 from pathlib import Path
+
+import boto3
 from dotenv import load_dotenv
 
 # === Логи ===
-LOG_FILE = "/opt/leads_postback/upload.log"
+LOG_FILE = os.getenv("LEADS_UPLOAD_LOG_FILE", "/opt/leads_postback/upload.log")
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
@@ -24,31 +46,216 @@ S3_BUCKET = os.getenv("S3_BUCKET")
 S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
 S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
 
-DATA_DIR = Path("/opt/leads_postback/data")
+DATA_DIR = Path(os.getenv("LEADS_DATA_DIR", "/opt/leads_postback/data"))
 DATA_DIR.mkdir(parents=True, exist_ok=True)
+TRAFFIC_DIR = DATA_DIR / "traffic_bh"
+
+SYNC_STATE_FILE = DATA_DIR / ".s3_sync_state.json"
+SYNC_LOCK_FILE = DATA_DIR / ".s3_sync.lock"
+
+
+def make_s3_client():
+    return boto3.client(
+        "s3",
+        endpoint_url=S3_ENDPOINT,
+        aws_access_key_id=S3_ACCESS_KEY,
+        aws_secret_access_key=S3_SECRET_KEY,
+    )
+
+
+def sub6_key(path: Path) -> str:
+    return f"leads_sub6/{path.name}"
+
+
+def traffic_key(path: Path) -> str:
+    return f"traffic_bh/{path.name}"
+
+
+def sync_targets() -> list:
+    """Append-only файлы, которые синхронизируются внутри дня: (путь, итоговый ключ).
+    Берутся только вчерашние и сегодняшние файлы — старые уже выгружены ежедневным запуском."""
+    now = datetime.datetime.now()
+    targets = []
+    for day in (now - datetime.timedelta(days=1), now):
+        sub6 = DATA_DIR / f"leads_sub6_{day:%d.%m.%Y}.txt"
+        traffic = TRAFFIC_DIR / f"traffic_bh_{day:%Y-%m-%d}.jsonl"
+        targets += [(sub6, sub6_key(sub6)), (traffic, traffic_key(traffic))]
+    return [(path, key) for path, key in targets if path.exists()]
+
+
+# === Состояние синхронизации ===
+
+def load_state() -> dict:
+    if SYNC_STATE_FILE.exists():
+        try:
+            with open(SYNC_STATE_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            logging.warning(f"Файл {SYNC_STATE_FILE.name} повреждён, синхронизация начнётся с нуля.")
+    return {}
+
+
+def save_state(state: dict) -> None:
+    tmp_file = SYNC_STATE_FILE.with_name(SYNC_STATE_FILE.name + ".tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file, SYNC_STATE_FILE)
+
+
+# === Внутридневная синхронизация ===
+
+def sync_file(s3, state: dict, path: Path, final_key: str) -> int:
+    """Отправляет новый хвост файла одной дельтой. Возвращает число отправленных байт."""
+    entry = state.setdefault(path.name, {"key": final_key, "offset": 0, "deltas": []})
+    size = path.stat().st_size
+    if size < entry["offset"]:
+        # Файл пересоздан — начинаем заново, старые дельты уберёт консолидация
+        logging.warning(f"⚠️ {path.name} стал короче отправленного ({size} < {entry['offset']}), сбрасываем")
+        entry["offset"] = 0
+        entry.pop("consolidated", None)
+    if size == entry["offset"]:
+        return 0
+
+    with open(path, "rb") as f:
+        f.seek(entry["offset"])
+        data = f.read(size - entry["offset"])
+    cut = data.rfind(b"\n") + 1
+    if cut == 0:
+        return 0  # нет ни одной завершённой строки
+    data = data[:cut]
+
+    start, end = entry["offset"], entry["offset"] + len(data)
+    delta_key = f"{final_key}.deltas/{len(entry['deltas']):06d}_{start}-{end}"
+    s3.put_object(Bucket=S3_BUCKET, Key=delta_key, Body=data)
+    entry["deltas"].append({"key": delta_key, "start": start, "end": end})
+    entry["offset"] = end
+    save_state(state)
+    logging.info(f"⬆️ {path.name}: дельта {start}-{end} -> {delta_key}")
+    return len(data)
+
+
+def run_sync(s3) -> None:
+    state = load_state()
+    sent = 0
+    for path, final_key in sync_targets():
+        try:
+            sent += sync_file(s3, state, path, final_key)
+        except Exception as e:
+            logging.error(f"❌ Ошибка синхронизации {path.name}: {e}")
+    logging.info(f"Синхронизация завершена, отправлено байт: {sent}")
+
+
+# === Консолидация ===
+
+class BoundedReader:
+    """Файл, читаемый только до limit байт: дописанное во время загрузки в объект не попадёт."""
+
+    def __init__(self, f, limit: int):
+        self.f = f
+        self.remaining = limit
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def needs_consolidation(state: dict, path: Path) -> bool:
+    """Итоговый объект устарел: файл ещё не консолидировался или вырос после этого."""
+    entry = state.get(path.name)
+    if entry is None or "consolidated" not in entry:
+        return True
+    return path.stat().st_size != entry["consolidated"]
+
+
+def consolidate_file(s3, state: dict, path: Path, final_key: str) -> None:
+    """Загружает итоговый объект с прежним ключом и удаляет дельты файла.
+    Размер файла запоминается как consolidated и как смещение синхронизации."""
+    entry = state.get(path.name, {})
+    deltas = entry.get("deltas", [])
+
+    # Загружается ровно [0, size): дописанное во время загрузки уйдёт следующей дельтой
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        s3.upload_fileobj(BoundedReader(f, size), S3_BUCKET, final_key)
+    logging.info(f"✅ Файл {path} успешно загружен в S3 как {final_key}")
+
+    if deltas:
+        keys = [{"Key": d["key"]} for d in deltas]
+        for i in range(0, len(keys), 1000):
+            s3.delete_objects(Bucket=S3_BUCKET, Delete={"Objects": keys[i:i + 1000], "Quiet": True})
+    state[path.name] = {"key": final_key, "offset": size, "deltas": [], "consolidated": size}
+    save_state(state)
+
+
+def prune_state(state: dict) -> None:
+    """Убирает записи о файлах, которые больше не синхронизируются (старше вчерашнего дня
+    или удалены) и уже полностью выгружены."""
+    active = {path.name for path, _ in sync_targets()}
+    for name in [n for n in state if n not in active]:
+        entry = state[name]
+        path = (TRAFFIC_DIR if name.startswith("traffic_bh_") else DATA_DIR) / name
+        if not path.exists() or path.stat().st_size == entry.get("consolidated"):
+            del state[name]
+    save_state(state)
+
+
+def run_daily(s3) -> None:
+    state = load_state()
+
+    today = datetime.datetime.now().strftime("%d.%m.%Y")
+    filename = DATA_DIR / f"leads_sub6_{today}.txt"
+
+    if filename.exists():
+        try:
+            if needs_consolidation(state, filename):
+                consolidate_file(s3, state, filename, sub6_key(filename))
+        except Exception as e:
+            logging.error(f"❌ Ошибка при загрузке в S3: {e}")
+    else:
+        logging.info("⚠️ Файл за день отсутствует — пропуск загрузки.")
+
+    # Остальные файлы с дельтами: traffic_bh завершившихся дней и sub6 прошлых дней,
+    # дописанные после ежедневной выгрузки
+    today_traffic = f"traffic_bh_{datetime.datetime.now():%Y-%m-%d}.jsonl"
+    for name in sorted(state):
+        if name.startswith("traffic_bh_") and name < today_traffic:
+            path, key = TRAFFIC_DIR / name, traffic_key(TRAFFIC_DIR / name)
+        elif name.startswith("leads_sub6_") and name != filename.name:  # сегодняшний — выше
+            path, key = DATA_DIR / name, sub6_key(DATA_DIR / name)
+        else:
+            continue
+        if not path.exists() or not needs_consolidation(state, path):
+            continue
+        try:
+            consolidate_file(s3, state, path, key)
+        except Exception as e:
+            logging.error(f"❌ Ошибка при загрузке {name} в S3: {e}")
+    prune_state(state)
+
+    # Создаём новый файл на завтра
+    tomorrow = (datetime.datetime.now() + datetime.timedelta(days=1)).strftime("%d.%m.%Y")
+    new_file = DATA_DIR / f"leads_sub6_{tomorrow}.txt"
+    new_file.touch(exist_ok=True)
+    logging.info(f"🆕 Создан файл на завтра: {new_file}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sync", action="store_true", help="отправить только новые хвосты файлов")
+    args = parser.parse_args()
+
+    # Синхронизация и ежедневный запуск не должны пересекаться (общий файл состояния)
+    with open(SYNC_LOCK_FILE, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        s3 = make_s3_client()
+        if args.sync:
+            run_sync(s3)
+        else:
+            run_daily(s3)
 
-s3 = boto3.client(
-    "s3",
-    endpoint_url=S3_ENDPOINT,
-    aws_access_key_id=S3_ACCESS_KEY,
-    aws_secret_access_key=S3_SECRET_KEY,
-)
 
-today = datetime.datetime.now().strftime("%d.%m.%Y")
-filename = DATA_DIR / f"leads_sub6_{today}.txt"
-
-if filename.exists():
-    s3_key = f"leads_sub6/leads_sub6_{today}.txt"
-    try:
-        s3.upload_file(str(filename), S3_BUCKET, s3_key)
-        logging.info(f"✅ Файл {filename} успешно загружен в S3 как {s3_key}")
-    except Exception as e:
-        logging.error(f"❌ Ошибка при загрузке в S3: {e}")
-else:
-    logging.info("⚠️ Файл за день отсутствует — пропуск загрузки.")
-
-# Создаём новый файл на завтра
-tomorrow = (datetime.datetime.now() + datetime.timedelta(days=1)).strftime("%d.%m.%Y")
-new_file = DATA_DIR / f"leads_sub6_{tomorrow}.txt"
-new_file.touch(exist_ok=True)
-logging.info(f"🆕 Создан файл на завтра: {new_file}")
+if __name__ == "__main__":
+    main()